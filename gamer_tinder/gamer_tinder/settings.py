@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/4.0/ref/settings/
 
 from pathlib import Path
 import os
+from django.core.exceptions import ImproperlyConfigured
 from loguru import logger
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -78,12 +79,41 @@ WSGI_APPLICATION = 'gamer_tinder.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.0/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# DB_ENGINE=postgresql включает PostgreSQL, иначе используется SQLite.
+# Соединения постоянные (CONN_MAX_AGE): бот ходит в БД из пула
+# BOT_DB_WORKERS потоков, каждый держит свое соединение, так что
+# пул потоков и есть пул соединений. max_connections сервера должно
+# хватать на BOT_DB_WORKERS на каждый процесс бота плюс веб-сервер.
+# За PgBouncer в режиме transaction нужно выставить DB_PGBOUNCER=1.
+DB_ENGINE = os.getenv('DB_ENGINE', 'sqlite3')
+
+if DB_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.getenv('DB_NAME', 'gamer_tinder'),
+            'USER': os.getenv('DB_USER', 'gamer_tinder'),
+            'PASSWORD': os.getenv('DB_PASSWORD', ''),
+            'HOST': os.getenv('DB_HOST', 'localhost'),
+            'PORT': os.getenv('DB_PORT', '5432'),
+            'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', 600)),
+            'DISABLE_SERVER_SIDE_CURSORS': os.getenv('DB_PGBOUNCER') == '1',
+        }
     }
-}
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.getenv('DB_NAME', BASE_DIR / 'db.sqlite3'),
+            'CONN_MAX_AGE': None,
+            # сколько секунд писатель ждет блокировку вместо
+            # "database is locked"; WAL - DB_SQLITE_WAL ниже
+            'OPTIONS': {'timeout': int(os.getenv('DB_BUSY_TIMEOUT', 20))},
+        }
+    }
+# WAL для SQLite (см. signals.setup_sqlite): режим сохраняется в файле
+# БД, поэтому включается явно на сервере, а не на файле из репозитория
+DB_SQLITE_WAL = os.getenv('DB_SQLITE_WAL') == '1'
 
 
 # Password validation
@@ -131,6 +161,136 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = 'media/'
 
 STEAM_NAME_MAX_LEN = 32
+# сколько кандидатов в тиммейты подгружается из БД за раз
+TEAMMATES_PAGE_SIZE = 20
+# кэш игроков в процессе бота: сколько записей и сколько секунд хранить
+PLAYER_CACHE_SIZE = int(os.getenv('PLAYER_CACHE_SIZE', 10000))
+PLAYER_CACHE_TTL = 1200
+# как часто отложенные изменения игроков пишутся в БД, секунд
+PLAYER_WRITE_INTERVAL = float(os.getenv('PLAYER_WRITE_INTERVAL', 1))
+# как часто пишутся счетчики активности игроков, секунд
+ACTIVITY_WRITE_INTERVAL = 30
+# сколько игроков в одном UPDATE при записи счетчиков
+ACTIVITY_WRITE_BATCH = 500
+
+# ранжирование кандидатов в поиске: каждые RANK_RECENCY_SCALE секунд
+# без активности стоят одного очка рейтинга, доля отвеченных
+# приглашений дает до RANK_ACCEPT_WEIGHT очков, каждый показ без
+# реакции отнимает RANK_SHOWN_PENALTY, каждый общий жанр с любимой
+# игрой ищущего добавляет до RANK_GENRE_WEIGHT (жанры переранжируются
+# в окне из RANK_GENRE_WINDOW страниц лучших кандидатов)
+RANK_RECENCY_SCALE = 86400
+RANK_ACCEPT_WEIGHT = 3
+RANK_SHOWN_PENALTY = 0.25
+RANK_GENRE_WEIGHT = 1
+RANK_GENRE_WINDOW = 8
+# активность чаще раза в столько секунд рейтинг не меняет
+RANK_ACTIVITY_RESOLUTION = 300
+
+# история показов в поиске: два фильтра Блума по SEEN_FILTER_BYTES на
+# игрока, текущий сменяется после SEEN_FILTER_CAPACITY показов или
+# SEEN_WINDOW / 2 секунд; SEEN_CACHE_SIZE историй держится в памяти
+SEEN_FILTER_BYTES = 2048
+SEEN_FILTER_HASHES = 7
+SEEN_FILTER_CAPACITY = 1000
+SEEN_WINDOW = 30 * 86400
+SEEN_CACHE_SIZE = 5000
+# сколько игр помещается на одну страницу клавиатуры выбора игры
+GAMES_PAGE_SIZE = 30
+# как часто (в секундах) каталог игр сверяется с БД: игры меняют
+# в админке, то есть в другом процессе, и сигналы сюда не доходят
+GAMES_CATALOGUE_CHECK = int(os.getenv('GAMES_CATALOGUE_CHECK', 10))
+
+# в какой размер вписывается миниатюра постера и сколько постеров
+# показывается альбомом над клавиатурой выбора игры (0 - не показывать)
+POSTER_THUMB_SIZE = (320, 320)
+GAMES_PICKER_POSTERS = int(os.getenv('GAMES_PICKER_POSTERS', 10))
+
+# где хранится состояние диалогов: в памяти процесса
+# (tgamer_app.storage.InMemoryStateBackend) или в БД, чтобы его видели
+# все процессы бота и оно переживало перезапуск
+# (tgamer_app.storage.DatabaseStateBackend)
+BOT_STATE_BACKEND = {
+    'BACKEND': os.getenv('BOT_STATE_BACKEND',
+                         'tgamer_app.storage.InMemoryStateBackend'),
+}
+
+TELEGRAM_API_URL = os.getenv('TG_API_URL', 'https://api.telegram.org')
+# адрес вебхука, который регистрирует manage.py set_webhook,
+# {token} заменяется на TG_API_KEY
+BOT_WEBHOOK_URL = os.getenv('BOT_WEBHOOK_URL',
+                            'https://authdemka.ru/bot/{token}/')
+# размер пула потоков, через который бот ходит в БД
+BOT_DB_WORKERS = int(os.getenv('BOT_DB_WORKERS', 8))
+# воркеры очереди апдейтов вебхука и ее общий размер
+BOT_UPDATE_WORKERS = int(os.getenv('BOT_UPDATE_WORKERS', 16))
+BOT_UPDATE_QUEUE_SIZE = int(os.getenv('BOT_UPDATE_QUEUE_SIZE', 10000))
+# сколько последних update_id помнить, чтобы не обработать
+# повторную доставку вебхука дважды
+BOT_UPDATE_DEDUP_SIZE = 10000
+# входящие команды чата (текст с "/" и inline-кнопки): в секунду
+# и с каким запасом, сверх - отбрасываются; одинаковые команды,
+# ждущие обработки, склеиваются в одну
+BOT_INBOUND_RATE_PER_CHAT = 1
+BOT_INBOUND_BURST_PER_CHAT = 5
+BOT_INBOUND_COALESCE = True
+# многопроцессный режим: сколько процессов-воркеров обслуживают чаты
+# (0 - все в процессе с вебхуком), где лежат их сокеты и как часто
+# воркеры перечитывают индекс поиска из БД
+BOT_WORKER_PROCESSES = int(os.getenv('BOT_WORKER_PROCESSES', 0))
+BOT_WORKER_SOCKET_DIR = os.getenv('BOT_WORKER_SOCKET_DIR',
+                                  '/tmp/gamer_tinder')
+BOT_INDEX_REFRESH = 60
+# через сколько секунд простоя сессия чата отпускает загруженное
+# состояние (страницу кандидатов и т.п.), оно остается в бэкенде
+BOT_SESSION_COMPACT_AFTER = int(os.getenv('BOT_SESSION_COMPACT_AFTER', 60))
+
+# исходящие сообщения: лимиты Telegram (сообщений в секунду на бота
+# и на чат), размер очереди, число повторов и пул HTTP-соединений.
+# Общий лимит Telegram на бота TELEGRAM_SEND_RATE_LIMIT делится между
+# ответами бота и рассылками: рассылки идут своим процессом или потоком
+# со своим диспетчером, и вместе они не должны его превышать
+TELEGRAM_SEND_RATE_LIMIT = 30
+BROADCAST_SEND_RATE = int(os.getenv('BROADCAST_SEND_RATE', 10))
+BOT_SEND_RATE_GLOBAL = int(os.getenv(
+    'BOT_SEND_RATE_GLOBAL', TELEGRAM_SEND_RATE_LIMIT - BROADCAST_SEND_RATE))
+if BOT_SEND_RATE_GLOBAL + BROADCAST_SEND_RATE > TELEGRAM_SEND_RATE_LIMIT:
+    raise ImproperlyConfigured(
+        'BOT_SEND_RATE_GLOBAL + BROADCAST_SEND_RATE must not exceed '
+        f'{TELEGRAM_SEND_RATE_LIMIT} messages per second')
+BOT_SEND_RATE_PER_CHAT = 1
+BOT_SEND_BURST_PER_CHAT = 3
+BOT_SEND_BUCKETS_MAX = 10000
+BOT_SEND_QUEUE_SIZE = 10000
+BOT_SEND_RETRIES = 3
+BOT_HTTP_POOL_SIZE = 32
+# приглашения: первое получателю уходит сразу, остальные копятся
+# и приходят одним сообщением не чаще раза в столько секунд
+BOT_INVITE_DIGEST_WINDOW = int(os.getenv('BOT_INVITE_DIGEST_WINDOW', 60))
+# сколько приглашений перечислять в одном сообщении
+BOT_INVITE_DIGEST_MAX = 20
+# через сколько секунд приглашения, взятые в отправку упавшим
+# процессом, отправляются заново; так же часто их ищет каждый процесс
+BOT_INVITE_CLAIM_LEASE = int(os.getenv('BOT_INVITE_CLAIM_LEASE', 300))
+
+# рассылки (manage.py broadcast): получателей в одной пачке, после
+# каждой пачки прогресс сохраняется в БД; скорость - BROADCAST_SEND_RATE
+BROADCAST_CHUNK_SIZE = 500
+
+# диапазоны tg_id синтетических пользователей (manage.py bench
+# и загрузка синтетических игроков). Настоящие id Telegram бывают
+# и в этих диапазонах, поэтому стенд работает только на отдельной
+# пустой БД, а синтетических игроков грузят только в тестовую
+BENCH_CHATS_START = 2_000_000_000
+BENCH_PLAYERS_START = 2_100_000_000
+
+# админка: дальше скольких строк не считать результаты фильтра,
+# без фильтра число игроков берется из статистики БД
+ADMIN_COUNT_LIMIT = 10000
+
+# с каких адресов можно забирать метрики (/bot/metrics/)
+METRICS_ALLOWED_IPS = os.getenv('METRICS_ALLOWED_IPS',
+                                '127.0.0.1,::1').split(',')
 
 logger.add(os.path.join(BASE_DIR,'gamer_tinder.log'),
            format='{time}, {level}, {message}',
@@ -1,17 +1,190 @@
+import threading
+from django.conf import settings
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import DatabaseError, connection
+from django.utils.functional import cached_property
 from django.utils.html import format_html
-from .models import Game, Player
+from loguru import logger
+from .cache import player_cache
+from .matchmaking import game_index
+from .models import Broadcast, Game, Invite, Player, PlayerGame
+from . import msgs
+
+
+def estimate_rows(model):
+    '''
+    Число строк таблицы из статистики планировщика (PostgreSQL)
+    или ANALYZE (SQLite), None - статистики нет
+    '''
+    table = model._meta.db_table
+    try:
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute('SELECT reltuples FROM pg_class '
+                               'WHERE oid = %s::regclass', [table])
+            elif connection.vendor == 'sqlite':
+                cursor.execute('SELECT stat FROM sqlite_stat1 '
+                               'WHERE tbl = %s LIMIT 1', [table])
+            else:
+                return None
+            row = cursor.fetchone()
+    except DatabaseError:
+        # в SQLite без ANALYZE таблицы sqlite_stat1 нет
+        return None
+    if row is None:
+        return None
+    estimate = int(str(row[0]).split()[0].split('.')[0])
+    # PostgreSQL до первого ANALYZE отдает -1
+    return estimate if estimate >= 0 else None
+
+
+class EstimatedCountPaginator(Paginator):
+    '''
+    Не делает COUNT(*) по всей таблице: без фильтров число строк
+    берется из статистики БД, с фильтрами считается не дальше
+    ADMIN_COUNT_LIMIT строк, и страниц показывается столько же
+    '''
+    @cached_property
+    def count(self):
+        qs = self.object_list
+        limit = settings.ADMIN_COUNT_LIMIT
+        if not qs.query.where:
+            estimate = estimate_rows(qs.model)
+            if estimate is not None and estimate > limit:
+                return estimate
+        return qs.order_by()[:limit].count()
+
+
+def refresh_search_index() -> None:
+    '''
+    Перечитывает индекс поиска в фоне после массовых изменений игроков
+    через update(): сигналы при этом не срабатывают. Процессы-воркеры
+    сами перечитывают индекс раз в BOT_INDEX_REFRESH секунд.
+    '''
+    player_cache.clear()
+    if not game_index.is_warm:
+        return
+
+    def run():
+        try:
+            game_index.warm()
+        except Exception:
+            logger.exception('Error while refreshing search index')
+        finally:
+            connection.close()
+    threading.Thread(target=run, name='index-refresh', daemon=True).start()
 
 
 @admin.register(Game)
 class GameAdmin(admin.ModelAdmin):
     list_display = ('image_tag', 'title')
+    actions = ('announce',)
 
+    @admin.display(description='Постер')
     def image_tag(self, obj):
-        return format_html(f'<img src="{obj.poster.url}" style="width:' +
-                           '140; height:190px;" />')
+        # в списке только миниатюры, пока ее нет - без картинки
+        if not obj.thumbnail:
+            return '-'
+        return format_html('<img src="{}" loading="lazy" '
+                           'style="max-width:140px; max-height:190px;" />',
+                           obj.thumbnail.url)
+
+    @admin.action(description='Анонсировать игру всем игрокам')
+    def announce(self, request, queryset):
+        # рассылка тянет aiohttp, его не нужно грузить при старте админки
+        from .broadcast import start_broadcast
+        for game in queryset:
+            broadcast = Broadcast.objects.create(
+                text=msgs.NEW_GAME_ANNOUNCE.format(game.title))
+            start_broadcast(broadcast.pk)
+        self.message_user(request, f'Запущено рассылок: {len(queryset)}')
+
+
+class PlayerGameInline(admin.TabularInline):
+    model = PlayerGame
+    extra = 0
 
 
 @admin.register(Player)
 class PlayerAdmin(admin.ModelAdmin):
-    pass
+    inlines = (PlayerGameInline,)
+    list_display = ('tg_id', 'steam_name', 'prefered_game', 'search_enabled',
+                    'sign_up')
+    list_select_related = ('prefered_game',)
+    list_filter = ('search_enabled', 'sign_up', 'prefered_game')
+    # сортировки только по индексированным полям
+    sortable_by = ('tg_id', 'steam_name')
+    search_fields = ('steam_name',)
+    search_help_text = ('Начало ника в стиме (без учета регистра) '
+                        'или телеграм айди')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    actions = ('enable_search', 'disable_search')
+
+    def get_search_results(self, request, queryset, search_term):
+        '''
+        Поиск по началу ника без учета регистра, идет по индексу
+        player_steam_name_prefix_idx (см. миграцию 0016) в SQLite
+        и в PostgreSQL с любой локалью. Число - еще и точный tg_id.
+        '''
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        found = queryset.filter(steam_name__istartswith=term)
+        if term.isdigit():
+            found = found | queryset.filter(pk=int(term))
+        return found, False
+
+    def _set_search(self, request, queryset, value: bool) -> None:
+        # один UPDATE без save() и сигналов, индекс поиска перечитаем сами
+        updated = queryset.exclude(search_enabled=value).update(
+            search_enabled=value)
+        refresh_search_index()
+        self.message_user(request, f'Обновлено игроков: {updated}')
+
+    @admin.action(description='Включить поиск')
+    def enable_search(self, request, queryset):
+        self._set_search(request, queryset, True)
+
+    @admin.action(description='Выключить поиск')
+    def disable_search(self, request, queryset):
+        self._set_search(request, queryset, False)
+
+
+@admin.register(Invite)
+class InviteAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'sender_username', 'game', 'mutual',
+                    'created_at', 'delivered_at')
+    list_filter = ('mutual',)
+    list_select_related = ('game',)
+    raw_id_fields = ('sender', 'recipient')
+    readonly_fields = ('created_at', 'delivered_at')
+
+
+@admin.register(Broadcast)
+class BroadcastAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'game', 'status', 'sent', 'failed', 'total',
+                    'created_at', 'finished_at')
+    list_filter = ('status',)
+    readonly_fields = ('status', 'last_tg_id', 'total', 'sent', 'failed',
+                       'created_at', 'started_at', 'finished_at')
+    actions = ('start', 'cancel')
+
+    @admin.action(description='Запустить или продолжить')
+    def start(self, request, queryset):
+        ids = list(queryset.filter(status__in=[
+            Broadcast.Status.PENDING, Broadcast.Status.PAUSED]).values_list(
+            'pk', flat=True))
+        from .broadcast import start_broadcast
+        for broadcast_id in ids:
+            start_broadcast(broadcast_id)
+        self.message_user(request, f'Запущено рассылок: {len(ids)}')
+
+    @admin.action(description='Отменить')
+    def cancel(self, request, queryset):
+        # идущая рассылка остановится после текущей пачки
+        cancelled = queryset.exclude(status__in=[
+            Broadcast.Status.DONE, Broadcast.Status.CANCELLED]).update(
+            status=Broadcast.Status.CANCELLED)
+        self.message_user(request, f'Отменено рассылок: {cancelled}')
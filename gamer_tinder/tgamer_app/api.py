@@ -0,0 +1,94 @@
+'''Асинхронный клиент Telegram Bot API поверх aiohttp'''
+import json
+import aiohttp
+from django.conf import settings
+
+
+class TelegramError(Exception):
+    '''Ошибка, которую вернул Telegram Bot API'''
+    def __init__(self, description: str, error_code: int, json: dict):
+        super().__init__(description, error_code, json)
+        self.description = description
+        self.error_code = error_code
+        self.json = json
+        # сколько секунд просит подождать Telegram при ответе 429
+        self.retry_after = (json.get('parameters') or {}).get('retry_after')
+
+
+def jsonable(value):
+    '''
+    Приводит namedtuple из telepot.namedtuple к словарям,
+    выкидывая None, как это делает telepot перед отправкой.
+    '''
+    if isinstance(value, list):
+        return [jsonable(v) for v in value]
+    if isinstance(value, dict):
+        return {k: jsonable(v) for k, v in value.items() if v is not None}
+    if isinstance(value, tuple) and hasattr(value, '_asdict'):
+        return {k: jsonable(v) for k, v in value._asdict().items()
+                if v is not None}
+    return value
+
+
+class TelegramApi:
+    '''
+    Минимальный асинхронный клиент Bot API. Методы названы так же,
+    как в telepot.Bot, чтобы хендлеры не пришлось переучивать.
+    '''
+    def __init__(self, token: str, base_url: str = None,
+                 timeout: float = 30, pool_size: int = None):
+        self._token = token
+        self._base_url = base_url or settings.TELEGRAM_API_URL
+        self._timeout = timeout
+        self._pool_size = pool_size or settings.BOT_HTTP_POOL_SIZE
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # сессия создается лениво, уже внутри работающего event loop,
+        # и держит keep-alive соединения к API
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self._pool_size,
+                                             keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self._timeout))
+        return self._session
+
+    async def call(self, method: str, files: dict = None, **params):
+        '''
+        Вызывает метод API и возвращает поле result ответа.
+        files - загружаемые файлы {поле: (имя файла, байты)},
+        с ними запрос уходит как multipart/form-data.
+        '''
+        url = f'{self._base_url}/bot{self._token}/{method}'
+        payload = jsonable(params)
+        if files:
+            form = aiohttp.FormData()
+            for key, value in payload.items():
+                form.add_field(key, value if isinstance(value, str)
+                               else json.dumps(value))
+            for key, (filename, content) in files.items():
+                form.add_field(key, content, filename=filename)
+            request = self._get_session().post(url, data=form)
+        else:
+            request = self._get_session().post(url, json=payload)
+        async with request as resp:
+            data = await resp.json(content_type=None)
+        if not data.get('ok'):
+            raise TelegramError(data.get('description', ''),
+                                data.get('error_code', resp.status), data)
+        return data['result']
+
+    async def sendMessage(self, chat_id: int, text: str, **kwargs):
+        return await self.call('sendMessage', chat_id=chat_id, text=text,
+                               **kwargs)
+
+    async def getUpdates(self, offset: int = None, timeout: int = 20):
+        return await self.call('getUpdates', offset=offset, timeout=timeout)
+
+    async def setWebhook(self, url: str):
+        return await self.call('setWebhook', url=url)
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class TgamerAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'tgamer_app'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+        from .metrics import metrics
+        metrics.install()
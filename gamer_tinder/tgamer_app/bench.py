@@ -0,0 +1,506 @@
+'''
+Нагрузочный стенд: гоняет синтетические апдейты через вебхук
+(CommandReceiveView) или через поллинг против заглушки Telegram API
+и считает пропускную способность, задержки хендлеров, число запросов
+к БД на апдейт, число потоков и потребление памяти, а также холодный
+старт процесса.
+'''
+import asyncio
+import itertools
+import json
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test import RequestFactory
+from .models import ChatState, Game, Player, PlayerGame
+from .matchmaking import GameIndex, PlayerStats, parse_genres
+
+CHATS_START = settings.BENCH_CHATS_START
+PLAYERS_START = settings.BENCH_PLAYERS_START
+
+
+class QueryCounter:
+    '''
+    Считает запросы к БД во всех потоках: вешает execute_wrapper
+    на уже открытые соединения и на каждое новое.
+    '''
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def _on_connection(self, sender, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def install(self) -> None:
+        for connection in connections.all():
+            self._on_connection(None, connection)
+        connection_created.connect(self._on_connection, weak=False)
+
+    def uninstall(self) -> None:
+        connection_created.disconnect(self._on_connection)
+        for connection in connections.all():
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+
+
+def rss_kb() -> int:
+    '''Текущий RSS процесса в килобайтах'''
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * resource.getpagesize() // 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Scenario:
+    '''
+    Генерирует поток апдейтов: каждый чат регистрируется, ищет
+    тиммейтов, листает /next и приглашает последнего кандидата.
+    '''
+    def __init__(self, chats: int, nexts: int, game: Game):
+        self.chats = chats
+        self.nexts = nexts
+        self.game = game
+        self._update_ids = itertools.count(1)
+
+    def _update(self, chat_id: int, text: str) -> dict:
+        update_id = next(self._update_ids)
+        return {'update_id': update_id,
+                'message': {'message_id': update_id,
+                            'date': int(time.time()),
+                            'chat': {'id': chat_id, 'type': 'private'},
+                            'from': {'id': chat_id, 'is_bot': False,
+                                     'username': f'bench{chat_id}'},
+                            'text': text}}
+
+    def chat_script(self, chat_id: int) -> list:
+        game_choice = f'{self.game.id} {self.game.title}'
+        texts = ['/registration', f'bench{chat_id}', 'bench player',
+                 game_choice, '/find', game_choice]
+        texts += ['/next'] * self.nexts + ['/invite']
+        return [self._update(chat_id, text) for text in texts]
+
+    def scripts(self) -> list:
+        return [self.chat_script(CHATS_START + idx)
+                for idx in range(self.chats)]
+
+
+class LoadBenchmark:
+    '''
+    mode - webhook или polling. Перед запуском создает players
+    игроков с включенным поиском, после - удаляет ровно тех
+    пользователей, которых создал (если не передан keep). retries -
+    доля апдейтов вебхука, которые доставляются повторно, как при
+    ретраях Telegram. Запускается только на отдельной пустой БД:
+    синтетические id могут совпасть с настоящими.
+    '''
+    def __init__(self, mode: str, chats: int, players: int, nexts: int,
+                 clients: int, fake_port: int, rate_limits: bool = False,
+                 keep: bool = False, retries: float = 0.0):
+        self.mode = mode
+        self.chats = chats
+        self.players = players
+        self.nexts = nexts
+        self.clients = clients
+        self.fake_port = fake_port
+        self.rate_limits = rate_limits
+        self.keep = keep
+        self.retries = retries
+        self.fake = None
+        self._fake_loop = None
+        self._player_ids = []
+        self._chat_ids = []
+        self._game = None
+
+    def _start_fake(self) -> None:
+        from .fake_telegram import start_fake_telegram
+        ready = threading.Event()
+
+        def run():
+            loop = asyncio.new_event_loop()
+            self._fake_loop = loop
+            self.fake, _ = loop.run_until_complete(
+                start_fake_telegram(port=self.fake_port))
+            ready.set()
+            loop.run_forever()
+        threading.Thread(target=run, name='fake-telegram',
+                         daemon=True).start()
+        ready.wait()
+
+    def _configure(self) -> None:
+        settings.TELEGRAM_API_URL = f'http://127.0.0.1:{self.fake_port}'
+        if not self.rate_limits:
+            settings.BOT_SEND_RATE_GLOBAL = 10 ** 6
+            settings.BOT_SEND_RATE_PER_CHAT = 10 ** 6
+            settings.BOT_SEND_BURST_PER_CHAT = 10 ** 6
+            settings.BOT_INBOUND_RATE_PER_CHAT = 10 ** 6
+            settings.BOT_INBOUND_BURST_PER_CHAT = 10 ** 6
+            settings.BOT_INBOUND_COALESCE = False
+
+    @staticmethod
+    def check_database() -> None:
+        '''
+        Стенд создает и удаляет игроков, поэтому не должен видеть
+        настоящих: в БД не должно быть ни игроков, ни состояний чатов
+        '''
+        if Player.objects.exists() or ChatState.objects.exists():
+            raise ValueError(
+                'bench needs a separate empty database, this one already '
+                'has players; point DB_NAME at a scratch database and run '
+                'migrate first')
+
+    def _get_game(self) -> Game:
+        game = Game.objects.order_by('id').first()
+        if game is None:
+            game = self._game = Game.objects.create(
+                title='Bench', description='bench', poster='')
+        return game
+
+    def _seed(self, game: Game) -> None:
+        self._player_ids = list(range(PLAYERS_START,
+                                      PLAYERS_START + self.players))
+        self._chat_ids = list(range(CHATS_START, CHATS_START + self.chats))
+        Player.objects.bulk_create(
+            [Player(tg_id=tg_id, steam_name=f'p{idx}',
+                    about='bench candidate', prefered_game=game,
+                    search_enabled=True,
+                    sign_up=Player.RegistrationSteps.DONE)
+             for idx, tg_id in enumerate(self._player_ids)], batch_size=1000)
+        PlayerGame.objects.bulk_create(
+            [PlayerGame(player_id=tg_id, game=game)
+             for tg_id in self._player_ids], batch_size=1000)
+
+    def _cleanup(self) -> None:
+        '''Удаляет только созданных стендом игроков, чаты и игру'''
+        ids = self._player_ids + self._chat_ids
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            Player.objects.filter(tg_id__in=chunk).delete()
+            ChatState.objects.filter(tg_id__in=chunk).delete()
+        if self._game is not None:
+            self._game.delete()
+            self._game = None
+
+    def _run_webhook(self, scripts: list, total: int):
+        from .bot_app import bot_app
+        from .views import CommandReceiveView
+        factory = RequestFactory()
+        view = CommandReceiveView.as_view()
+        token = settings.TELEGRAM_TOKEN
+        queue = bot_app.get_update_queue()
+        runtime = queue.runtime
+
+        def post(update):
+            rejected = 0
+            while True:
+                request = factory.post(
+                    f'/bot/{token}/', data=json.dumps(update),
+                    content_type='application/json')
+                if view(request, bot_token=token).status_code == 200:
+                    return rejected
+                rejected += 1
+                time.sleep(0.01)
+
+        def post_chats(chat_scripts):
+            rejected = retried = 0
+            # апдейты чатов одного клиента идут вперемешку, но по порядку
+            for step in itertools.zip_longest(*chat_scripts):
+                for update in step:
+                    if update is None:
+                        continue
+                    rejected += post(update)
+                    if random.random() < self.retries:
+                        rejected += post(update)
+                        retried += 1
+            return rejected, retried
+
+        started = time.monotonic()
+        before = runtime.handled + runtime.shed
+        groups = [scripts[idx::self.clients] for idx in range(self.clients)]
+        with ThreadPoolExecutor(self.clients) as pool:
+            results = list(pool.map(post_chats, groups))
+        rejected = sum(result[0] for result in results)
+        retried = sum(result[1] for result in results)
+        while runtime.handled + runtime.shed - before < total + retried:
+            time.sleep(0.01)
+        return time.monotonic() - started, runtime, {'rejected': rejected,
+                                                     'retried': retried}
+
+    def _run_polling(self, scripts: list, total: int):
+        from .gamer_bot import GamerBot
+        from .matchmaking import game_index
+        from .runtime import BotRuntime
+        runtime = BotRuntime(settings.TELEGRAM_TOKEN, GamerBot,
+                             timeout=1200)
+        game_index.warm()
+        threading.Thread(target=asyncio.run, args=(runtime.poll(),),
+                         name='bench-polling', daemon=True).start()
+
+        started = time.monotonic()
+        for step in itertools.zip_longest(*scripts):
+            for update in step:
+                if update is not None:
+                    self._fake_loop.call_soon_threadsafe(
+                        self.fake.push_update, update)
+        while runtime.handled + runtime.shed < total:
+            time.sleep(0.01)
+        return time.monotonic() - started, runtime, {}
+
+    def run(self) -> dict:
+        self._configure()
+        self.check_database()
+        self._start_fake()
+        game = self._get_game()
+        self._seed(game)
+        scripts = Scenario(self.chats, self.nexts, game).scripts()
+        total = sum(len(script) for script in scripts)
+
+        counter = QueryCounter()
+        counter.install()
+        rss_before = rss_kb()
+        try:
+            if self.mode == 'webhook':
+                elapsed, runtime, extra = self._run_webhook(scripts, total)
+            else:
+                elapsed, runtime, extra = self._run_polling(scripts, total)
+        finally:
+            counter.uninstall()
+            if not self.keep:
+                self._cleanup()
+
+        latency = runtime.handle_latency
+        report = {
+            'mode': self.mode,
+            'chats': self.chats,
+            'players': self.players,
+            'updates': total,
+            'elapsed_s': round(elapsed, 3),
+            'updates_per_s': round(total / elapsed, 1),
+            'handler_p50_ms': round(latency.percentile(0.5) * 1000, 2),
+            'handler_p99_ms': round(latency.percentile(0.99) * 1000, 2),
+            'db_queries_per_update': round(counter.count / total, 2),
+            'shed_duplicate': runtime.dedup.duplicates,
+            'shed_coalesced': runtime.inbound.coalesced,
+            'shed_throttled': runtime.inbound.throttled,
+            'api_calls': len(self.fake.calls),
+            'threads': threading.active_count(),
+            'rss_kb': rss_kb(),
+            'rss_growth_kb': rss_kb() - rss_before,
+        }
+        report.update(extra)
+        return report
+
+
+class RankingBenchmark:
+    '''
+    Меряет ранжирование кандидатов без БД: строит отдельный GameIndex
+    на players игроков со случайной активностью и замеряет выдачу
+    страницы лучших кандидатов по одной игре и по двум сразу
+    (пересечение, во второй игре половина игроков) и пересчет
+    рейтинга по событиям.
+    '''
+    def __init__(self, players: int, page_size: int, requests: int):
+        self.players = players
+        self.page_size = page_size
+        self.requests = requests
+
+    def _build(self, game_id: int) -> GameIndex:
+        now = time.time()
+        players = []
+        for tg_id in range(PLAYERS_START, PLAYERS_START + self.players):
+            received = random.randint(0, 20)
+            game_ids = ({game_id, game_id + 1} if tg_id % 2
+                        else {game_id})
+            players.append((tg_id, game_ids, PlayerStats(
+                now - random.uniform(0, 30 * 86400),
+                shown=random.randint(0, 5), received=received,
+                answered=random.randint(0, received))))
+        index = GameIndex()
+        index.load(players, {game_id: parse_genres('moba, strategy'),
+                             game_id + 1: parse_genres('strategy, rpg')})
+        return index
+
+    @staticmethod
+    def _timed(fn, args_list: list) -> dict:
+        timings = []
+        for args in args_list:
+            started = time.perf_counter()
+            fn(*args)
+            timings.append(time.perf_counter() - started)
+        timings.sort()
+        return {'p50_us': round(timings[len(timings) // 2] * 1e6, 1),
+                'p99_us': round(timings[int(len(timings) * 0.99)] * 1e6, 1),
+                'max_us': round(timings[-1] * 1e6, 1)}
+
+    def run(self) -> dict:
+        game_id = 1
+        started = time.perf_counter()
+        index = self._build(game_id)
+        build_s = time.perf_counter() - started
+        ids = list(range(PLAYERS_START, PLAYERS_START + self.players))
+
+        # ищущий уже пролистал несколько страниц
+        pages = [([game_id], self.page_size,
+                  set(random.sample(ids, self.page_size * 5)), [game_id + 1])
+                 for _ in range(self.requests)]
+        both = [([game_id, game_id + 1], *args[1:]) for args in pages]
+        events = [(random.choice(ids),) for _ in range(self.requests)]
+        report = {'mode': 'ranking',
+                  'players': self.players,
+                  'build_s': round(build_s, 3),
+                  'top': self._timed(index.top, pages),
+                  'top_two_games': self._timed(index.top, both),
+                  'shown': self._timed(index.record_shown, events),
+                  'invite': self._timed(index.record_invite, events),
+                  'active': self._timed(index.record_active, events)}
+        return report
+
+
+class SessionMemoryBenchmark:
+    '''
+    Меряет память сессий чатов без сети и БД: открывает sessions
+    сессий GamerBot, у каждой в отдельном InMemoryStateBackend лежит
+    состояние посреди поиска (страница кандидатов, уже показанные).
+    Простаивающая сессия - запись рантайма и строка в бэкенде,
+    активная - еще загруженный StateStorage. В конце планировщик
+    простоя закрывает все сессии разом.
+    '''
+    def __init__(self, sessions: int, page_size: int):
+        self.sessions = sessions
+        self.page_size = page_size
+
+    def _state(self, chat_id: int) -> dict:
+        '''состояние в формате StateStorage._dump'''
+        # id разбросаны, как у настоящих пользователей Telegram
+        rng = random.Random(chat_id)
+        queue = [rng.randrange(10 ** 8, 7 * 10 ** 9)
+                 for _ in range(self.page_size - 1)]
+        return {'search': False, 'games': [1], 'game_action': None,
+                'search_id': 1, 'teammate': None,
+                'cursor': {'kind': 'indexed', 'player': chat_id,
+                           'games': [1], 'queue': queue, 'pivot': None,
+                           'start': None, 'stop': None, 'wrapped': False,
+                           'exhausted': False, 'shown': [chat_id] + queue,
+                           'viewer_games': [1]}}
+
+    def run(self) -> dict:
+        from . import storage
+        from .gamer_bot import GamerBot
+        from .runtime import BotRuntime
+        runtime = BotRuntime(settings.TELEGRAM_TOKEN, GamerBot,
+                             timeout=1200)
+        runtime.run_as_thread()
+        chat_ids = range(CHATS_START, CHATS_START + self.sessions)
+        saved_backend = storage.state_backend
+        storage.state_backend = backend = storage.InMemoryStateBackend(
+            maxsize=self.sessions)
+
+        async def open_sessions():
+            for chat_id in chat_ids:
+                runtime.get_session(chat_id)
+
+        async def expire():
+            return runtime.sweep_idle(ahead=1200 + 1)
+
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            for chat_id in chat_ids:
+                backend.save(chat_id, self._state(chat_id))
+            runtime.submit(open_sessions()).result()
+            idle = tracemalloc.get_traced_memory()[0] - before
+            # активные сессии держат еще и загруженное состояние
+            sample = min(self.sessions, 10000)
+            before_hot = tracemalloc.get_traced_memory()[0]
+            states = [storage.StateStorage(chat_id)
+                      for chat_id in chat_ids[:sample]]
+            for state in states:
+                state.load()
+            hot_state = tracemalloc.get_traced_memory()[0] - before_hot
+            del states
+        finally:
+            tracemalloc.stop()
+            storage.state_backend = saved_backend
+
+        started = time.perf_counter()
+        closed = runtime.submit(expire()).result()
+        # сессии дописывают буфер записей в фоне
+        while runtime.gauges()['tasks'] > 1:
+            time.sleep(0.01)
+        evict_s = time.perf_counter() - started
+        return {'mode': 'sessions',
+                'sessions': self.sessions,
+                'idle_mb': round(idle / 2 ** 20, 1),
+                'idle_bytes_per_session': round(idle / self.sessions),
+                'active_state_bytes': round(hot_state / sample),
+                'evicted': closed,
+                'evict_s': round(evict_s, 3),
+                'sessions_left': runtime.gauges()['sessions']}
+
+
+# выполняется в отдельном интерпретаторе: импорт приложения как при
+# первом запросе к вебхуку, затем ленивый старт бота
+COLD_START_SCRIPT = '''
+import json, threading, time
+started = time.perf_counter()
+import django
+django.setup()
+from django.urls import resolve
+resolve('/bot/metrics/')
+imported = time.perf_counter()
+threads = threading.active_count()
+from tgamer_app.bot_app import bot_app
+bot_app.get_update_queue()
+ready = time.perf_counter()
+print(json.dumps({'import_s': imported - started, 'import_threads': threads,
+                  'bot_start_s': ready - imported,
+                  'bot_threads': threading.active_count()}))
+'''
+
+
+class ColdStartBenchmark:
+    '''
+    Меряет холодный старт в новых процессах: django.setup() и импорт
+    urls/views (так стартуют команды manage.py и воркеры сервера),
+    число потоков после него и ленивый запуск бота на первом апдейте
+    '''
+    def __init__(self, runs: int):
+        self.runs = runs
+
+    def _run_once(self) -> dict:
+        started = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, '-c', COLD_START_SCRIPT], cwd=settings.BASE_DIR,
+            capture_output=True, text=True, check=True)
+        report = json.loads(result.stdout.strip().splitlines()[-1])
+        report['process_s'] = time.perf_counter() - started
+        return report
+
+    def run(self) -> dict:
+        runs = [self._run_once() for _ in range(self.runs)]
+
+        def median_ms(key):
+            values = sorted(run[key] for run in runs)
+            return round(values[len(values) // 2] * 1000, 1)
+        return {'mode': 'coldstart',
+                'runs': self.runs,
+                'process_ms': median_ms('process_s'),
+                'import_ms': median_ms('import_s'),
+                'import_threads': max(run['import_threads'] for run in runs),
+                'bot_start_ms': median_ms('bot_start_s'),
+                'bot_threads': max(run['bot_threads'] for run in runs)}
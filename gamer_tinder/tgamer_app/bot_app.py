@@ -0,0 +1,101 @@
+'''
+Приложение бота. Рантайм, прием апдейтов и индекс поиска создаются
+не при импорте, а при первом апдейте (или запуске поллинга), так что
+импорт urls/views, любые команды manage.py и воркеры не ходят в сеть
+и не запускают потоков. Вебхук регистрируется только явно:
+python manage.py set_webhook.
+'''
+import asyncio
+import threading
+import time
+from django.conf import settings
+from loguru import logger
+
+
+def webhook_url() -> str:
+    return settings.BOT_WEBHOOK_URL.format(token=settings.TELEGRAM_TOKEN)
+
+
+class BotApp:
+    def __init__(self):
+        self._updates = None
+        self._lock = threading.Lock()
+        # сколько заняло создание рантайма и прогрев индекса
+        self.startup_seconds = None
+
+    @property
+    def started(self) -> bool:
+        return self._updates is not None
+
+    def make_runtime(self):
+        '''Рантайм с GamerBot и прогретым индексом поиска'''
+        from .gamer_bot import GamerBot
+        from .matchmaking import game_index
+        from .runtime import BotRuntime
+        runtime = BotRuntime(settings.TELEGRAM_TOKEN, GamerBot, timeout=1200)
+        game_index.warm()
+        return runtime
+
+    def get_update_queue(self):
+        '''
+        Поднимает прием апдейтов с вебхука при первом запросе.
+        Если BOT_WORKER_PROCESSES > 0, апдейты уходят процессам-воркерам
+        (python manage.py run_bot_workers), иначе обрабатываются
+        рантаймом в этом же процессе.
+        '''
+        with self._lock:
+            if self._updates is not None:
+                return self._updates
+            started = time.perf_counter()
+            if settings.BOT_WORKER_PROCESSES:
+                from .cluster import ShardedForwarder
+                updates = ShardedForwarder(settings.BOT_WORKER_PROCESSES)
+            else:
+                from .ingest import UpdateQueue
+                runtime = self.make_runtime()
+                runtime.run_as_thread()
+                updates = UpdateQueue(runtime,
+                                      workers=settings.BOT_UPDATE_WORKERS,
+                                      maxsize=settings.BOT_UPDATE_QUEUE_SIZE)
+                updates.start()
+            self.startup_seconds = time.perf_counter() - started
+            logger.info(f'Bot started in {self.startup_seconds:.3f}s')
+            self._updates = updates
+            return updates
+
+    def run_polling(self, drop_webhook: bool = False) -> None:
+        '''
+        Получает апдейты поллингом, блокирует до остановки. Пока
+        у бота задан вебхук, getUpdates не работает - drop_webhook
+        сначала его удаляет.
+        '''
+        if drop_webhook:
+            self.delete_webhook()
+        runtime = self.make_runtime()
+        print('Listening ...')
+        asyncio.run(runtime.poll())
+
+    @staticmethod
+    def call_api(method: str, **params):
+        '''Разовый вызов Bot API со своим HTTP-клиентом'''
+        from .api import TelegramApi
+
+        async def _call():
+            api = TelegramApi(settings.TELEGRAM_TOKEN)
+            try:
+                return await api.call(method, **params)
+            finally:
+                await api.close()
+        return asyncio.run(_call())
+
+    def set_webhook(self, url: str = None):
+        return self.call_api('setWebhook', url=url or webhook_url())
+
+    def delete_webhook(self):
+        return self.call_api('deleteWebhook')
+
+    def get_webhook_info(self) -> dict:
+        return self.call_api('getWebhookInfo')
+
+
+bot_app = BotApp()
@@ -0,0 +1,207 @@
+'''
+Рассылки всем игрокам: получатели читаются из БД пачками по tg_id,
+сообщения уходят через OutboundDispatcher со своим лимитом скорости,
+а после каждой пачки прогресс сохраняется в Broadcast. Память
+ограничена размером пачки, время - числом получателей и
+BROADCAST_SEND_RATE, а прерванную рассылку можно продолжить.
+'''
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections, connections
+from django.utils import timezone
+from loguru import logger
+from .api import TelegramApi, TelegramError
+from .dispatcher import OutboundDispatcher
+from .models import Broadcast
+
+
+class BroadcastRunner:
+    '''
+    Отправляет одну рассылку. Перед стартом рассылка захватывается
+    (статус RUNNING), так что два процесса не шлют одно и то же.
+    Если рассылку отменили в админке, отправка останавливается
+    после текущей пачки.
+    '''
+    def __init__(self, broadcast_id: int, outbox: OutboundDispatcher,
+                 chunk_size: int = None, on_progress=None):
+        self.broadcast_id = broadcast_id
+        self._outbox = outbox
+        self._chunk_size = chunk_size or settings.BROADCAST_CHUNK_SIZE
+        # вызывается с отчетом progress() после каждой пачки
+        self._on_progress = on_progress
+        self._broadcast = None
+        # свой поток для БД: запросы идут по очереди в одном соединении
+        self._db = ThreadPoolExecutor(max_workers=1,
+                                      thread_name_prefix='broadcast-db')
+        self._started = None
+        self._sent_before = 0
+
+    def _run_db(self, fn, *args):
+        def call():
+            close_old_connections()
+            return fn(*args)
+        return asyncio.get_running_loop().run_in_executor(self._db, call)
+
+    def claim(self, force: bool = False) -> bool:
+        '''
+        Переводит рассылку в RUNNING, если ее никто не отправляет.
+        force - забрать и рассылку в статусе RUNNING, например,
+        если отправлявший процесс упал.
+        '''
+        statuses = [Broadcast.Status.PENDING, Broadcast.Status.PAUSED]
+        if force:
+            statuses.append(Broadcast.Status.RUNNING)
+        claimed = Broadcast.objects.filter(
+            pk=self.broadcast_id, status__in=statuses).update(
+            status=Broadcast.Status.RUNNING)
+        if not claimed:
+            return False
+        broadcast = Broadcast.objects.get(pk=self.broadcast_id)
+        if broadcast.started_at is None:
+            broadcast.started_at = timezone.now()
+            broadcast.total = broadcast.recipients().count()
+            broadcast.save(update_fields=['started_at', 'total'])
+        self._broadcast = broadcast
+        return True
+
+    def _next_chunk(self) -> list:
+        qs = self._broadcast.recipients()
+        if self._broadcast.last_tg_id is not None:
+            qs = qs.filter(tg_id__gt=self._broadcast.last_tg_id)
+        return list(qs[:self._chunk_size])
+
+    def _save_progress(self, status: str = None) -> bool:
+        '''
+        Сохраняет, до кого дошли. Возвращает False, если рассылку
+        тем временем отменили или у нее забрали
+        '''
+        broadcast = self._broadcast
+        changes = {'last_tg_id': broadcast.last_tg_id,
+                   'sent': broadcast.sent, 'failed': broadcast.failed}
+        if status is not None:
+            changes['status'] = status
+            if status in (Broadcast.Status.DONE, Broadcast.Status.CANCELLED):
+                changes['finished_at'] = timezone.now()
+        return bool(Broadcast.objects.filter(
+            pk=broadcast.pk, status=Broadcast.Status.RUNNING).update(
+            **changes))
+
+    async def _send(self, tg_id: int) -> bool:
+        try:
+            await self._outbox.sendMessage(tg_id, self._broadcast.text)
+        except TelegramError as e:
+            # заблокировал бота, удалил аккаунт и т.п. - не повторяем
+            logger.debug(f'Broadcast {self.broadcast_id} to {tg_id} '
+                         f'failed: {e.description}')
+            return False
+        except Exception:
+            # сетевые ошибки диспетчер уже повторил
+            logger.exception(f'Broadcast {self.broadcast_id} to {tg_id} '
+                             'failed')
+            return False
+        return True
+
+    def progress(self) -> dict:
+        broadcast = self._broadcast
+        done = broadcast.sent + broadcast.failed
+        elapsed = time.monotonic() - self._started
+        rate = (done - self._sent_before) / elapsed if elapsed else 0.0
+        left = max((broadcast.total or 0) - done, 0)
+        return {'id': broadcast.pk,
+                'done': done,
+                'total': broadcast.total,
+                'sent': broadcast.sent,
+                'failed': broadcast.failed,
+                'rate': round(rate, 1),
+                'eta_s': round(left / rate) if rate else None}
+
+    async def run(self, force: bool = False) -> dict:
+        '''
+        Отправляет рассылку до конца. Если задачу отменили
+        (Ctrl+C в команде), рассылка ставится на паузу.
+        '''
+        try:
+            if not await self._run_db(self.claim, force):
+                raise ValueError(f'Broadcast {self.broadcast_id} is not '
+                                 'pending or paused')
+            broadcast = self._broadcast
+            self._started = time.monotonic()
+            self._sent_before = broadcast.sent + broadcast.failed
+            status = Broadcast.Status.DONE
+            try:
+                while True:
+                    chunk = await self._run_db(self._next_chunk)
+                    if not chunk:
+                        break
+                    results = await asyncio.gather(
+                        *(self._send(tg_id) for tg_id in chunk))
+                    delivered = sum(results)
+                    broadcast.sent += delivered
+                    broadcast.failed += len(results) - delivered
+                    broadcast.last_tg_id = chunk[-1]
+                    if not await self._run_db(self._save_progress):
+                        status = None
+                        logger.info(f'Broadcast {broadcast.pk} was stopped')
+                        break
+                    if self._on_progress is not None:
+                        self._on_progress(self.progress())
+            except asyncio.CancelledError:
+                # прогресс сохранен по прошлую пачку: часть текущей
+                # после продолжения получит сообщение второй раз
+                await self._run_db(self._save_progress,
+                                   Broadcast.Status.PAUSED)
+                raise
+            if status is not None:
+                await self._run_db(self._save_progress, status)
+            report = self.progress()
+            logger.info(f'Broadcast finished: {report}')
+            return report
+        finally:
+            await self._run_db(connections.close_all)
+            self._db.shutdown()
+
+
+def run_broadcast(broadcast_id: int, force: bool = False,
+                  rate: float = None, chunk_size: int = None,
+                  on_progress=None) -> dict:
+    '''
+    Отправляет рассылку в своем event loop со своим HTTP-клиентом,
+    блокирует до конца рассылки
+    '''
+    # своя доля общего лимита Telegram, остальное - ответам бота
+    budget = settings.TELEGRAM_SEND_RATE_LIMIT - settings.BOT_SEND_RATE_GLOBAL
+    rate = rate or settings.BROADCAST_SEND_RATE
+    if rate > budget:
+        raise ValueError(f'Broadcast rate {rate} exceeds {budget} msg/s '
+                         'left by BOT_SEND_RATE_GLOBAL')
+
+    async def _run():
+        api = TelegramApi(settings.TELEGRAM_TOKEN)
+        outbox = OutboundDispatcher(api, rate=rate)
+        try:
+            return await BroadcastRunner(
+                broadcast_id, outbox, chunk_size=chunk_size,
+                on_progress=on_progress).run(force)
+        finally:
+            await api.close()
+    return asyncio.run(_run())
+
+
+def start_broadcast(broadcast_id: int) -> threading.Thread:
+    '''
+    Запускает рассылку в фоновом потоке (из админки). Если процесс
+    завершится раньше, рассылку можно продолжить командой
+    manage.py broadcast --resume ID --force
+    '''
+    def run():
+        try:
+            run_broadcast(broadcast_id)
+        except Exception:
+            logger.exception(f'Broadcast {broadcast_id} failed')
+    thread = threading.Thread(target=run, name=f'broadcast-{broadcast_id}',
+                              daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,61 @@
+'''Кэши, которые живут в памяти процесса бота'''
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from .models import Player
+
+
+class PlayerCache:
+    '''
+    LRU-кэш игроков по tg_id с ограниченным временем жизни записи.
+    Хендлеры меняют и сохраняют закэшированный объект, поэтому кэш
+    остается актуальным. Если игрока сохранили в другом месте
+    (например, в админке), запись выбрасывается по сигналу post_save.
+    '''
+    def __init__(self, maxsize: int, ttl: float):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, tg_id: int):
+        with self._lock:
+            item = self._data.get(tg_id)
+            if item is None:
+                return None
+            expires_at, player = item
+            if expires_at < time.monotonic():
+                del self._data[tg_id]
+                return None
+            self._data.move_to_end(tg_id)
+            return player
+
+    def put(self, player: Player) -> None:
+        with self._lock:
+            self._data[player.tg_id] = (time.monotonic() + self._ttl, player)
+            self._data.move_to_end(player.tg_id)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, tg_id: int) -> None:
+        with self._lock:
+            self._data.pop(tg_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def on_saved(self, player: Player) -> None:
+        '''Выбрасывает запись, если сохранили не закэшированный объект'''
+        with self._lock:
+            item = self._data.get(player.tg_id)
+            if item is not None and item[1] is not player:
+                del self._data[player.tg_id]
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+player_cache = PlayerCache(settings.PLAYER_CACHE_SIZE,
+                           settings.PLAYER_CACHE_TTL)
@@ -0,0 +1,120 @@
+'''
+Многопроцессный режим: процесс с вебхуком раскидывает апдейты
+по chat_id между N процессами-воркерами через Unix-сокеты,
+каждый воркер держит сессии только своих чатов.
+'''
+import asyncio
+import json
+import os
+import socket
+import threading
+from loguru import logger
+from django.conf import settings
+from .ingest import UpdateQueue, shard_of
+from .runtime import BotRuntime
+from .metrics import metrics
+
+
+def worker_socket_path(idx: int) -> str:
+    return os.path.join(settings.BOT_WORKER_SOCKET_DIR, f'worker-{idx}.sock')
+
+
+class ShardedForwarder:
+    '''
+    Замена UpdateQueue для процесса с вебхуком: отправляет апдейт
+    воркеру его чата и ждет подтверждения, что тот принял его в очередь.
+    Протокол - по строке JSON на апдейт, в ответ '1' или '0'.
+    '''
+    def __init__(self, count: int, timeout: float = 2):
+        self._count = count
+        self._timeout = timeout
+        self._conns = [None] * count
+        self._locks = [threading.Lock() for _ in range(count)]
+        self.accepted = 0
+        self.rejected = 0
+        self.failed = 0
+        metrics.register('forwarder', self.gauges)
+
+    def _connect(self, idx: int):
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.settimeout(self._timeout)
+        conn.connect(worker_socket_path(idx))
+        return conn.makefile('rwb')
+
+    def _send(self, idx: int, line: bytes) -> bool:
+        if self._conns[idx] is None:
+            self._conns[idx] = self._connect(idx)
+        conn = self._conns[idx]
+        conn.write(line)
+        conn.flush()
+        answer = conn.readline()
+        if not answer:
+            raise ConnectionError(f'worker {idx} closed the connection')
+        return answer.strip() == b'1'
+
+    def put(self, update: dict) -> bool:
+        idx = shard_of(update, self._count, salt=1)
+        line = json.dumps(update).encode() + b'\n'
+        with self._locks[idx]:
+            try:
+                ok = self._send(idx, line)
+            except OSError:
+                logger.exception(f'Worker {idx} is unavailable')
+                self._conns[idx] = None
+                self.failed += 1
+                return False
+        if ok:
+            self.accepted += 1
+        else:
+            self.rejected += 1
+        return ok
+
+    def gauges(self) -> dict:
+        return {'forwarder_accepted_total': self.accepted,
+                'forwarder_rejected_total': self.rejected,
+                'forwarder_failed_total': self.failed}
+
+    def stats(self) -> dict:
+        return {'accepted': self.accepted,
+                'rejected': self.rejected,
+                'failed': self.failed}
+
+
+async def serve_worker(idx: int, handler_class, warm_index) -> None:
+    '''
+    Поднимает рантайм бота и слушает сокет воркера idx.
+    warm_index - функция, заново заполняющая индекс поиска: изменения
+    игроков из других воркеров доходят до этого процесса только так.
+    '''
+    runtime = BotRuntime(settings.TELEGRAM_TOKEN, handler_class,
+                         timeout=1200)
+    runtime.loop = asyncio.get_running_loop()
+    await runtime.run_sync(warm_index)
+    queue = UpdateQueue(runtime, workers=settings.BOT_UPDATE_WORKERS,
+                        maxsize=settings.BOT_UPDATE_QUEUE_SIZE)
+    await queue.open()
+
+    async def handle_connection(reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            ok = queue.put(json.loads(line))
+            writer.write(b'1\n' if ok else b'0\n')
+            await writer.drain()
+        writer.close()
+
+    path = worker_socket_path(idx)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        os.unlink(path)
+    server = await asyncio.start_unix_server(handle_connection, path)
+    logger.info(f'Worker {idx} is listening on {path}')
+
+    async with server:
+        while True:
+            await asyncio.sleep(settings.BOT_INDEX_REFRESH)
+            try:
+                await runtime.run_sync(warm_index)
+            except Exception:
+                logger.exception('Error while refreshing search index')
@@ -0,0 +1,221 @@
+'''
+Исходящие сообщения: все вызовы Bot API проходят через один
+диспетчер, который соблюдает лимиты Telegram на чат и на бота,
+повторяет запросы после 429 и сетевых ошибок и считает метрики.
+'''
+import asyncio
+import time
+from collections import deque
+import aiohttp
+from loguru import logger
+from django.conf import settings
+from .api import TelegramApi, TelegramError
+from .metrics import metrics
+
+
+class TokenBucket:
+    '''
+    Token bucket, в котором токен занимается заранее: reserve()
+    сразу списывает токен (уходя в долг) и возвращает, сколько
+    ждать до отправки. Поэтому порядок резервирования сохраняется.
+    '''
+    def __init__(self, rate: float, capacity: float):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self._capacity,
+                           self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def reserve(self, now: float = None) -> float:
+        self._refill(now or time.monotonic())
+        self._tokens -= 1
+        return 0.0 if self._tokens >= 0 else -self._tokens / self._rate
+
+    def try_take(self, now: float = None) -> bool:
+        '''Забирает токен, только если он есть прямо сейчас'''
+        self._refill(now or time.monotonic())
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def penalize(self, seconds: float) -> None:
+        '''Ничего не отправлять еще seconds секунд'''
+        self._refill(time.monotonic())
+        self._tokens = min(self._tokens, 0) - seconds * self._rate
+
+    def is_full(self, now: float = None) -> bool:
+        self._refill(now or time.monotonic())
+        return self._tokens >= self._capacity
+
+
+class LatencyStats:
+    '''Счетчик задержек с окном последних значений для перцентилей'''
+    def __init__(self, window: int = 1000):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._recent = deque(maxlen=window)
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self._recent.append(value)
+
+    def percentile(self, q: float) -> float:
+        if not self._recent:
+            return 0.0
+        values = sorted(self._recent)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def as_dict(self) -> dict:
+        return {'count': self.count,
+                'avg': self.total / self.count if self.count else 0.0,
+                'p50': self.percentile(0.5),
+                'p99': self.percentile(0.99),
+                'max': self.max}
+
+
+class OutboundDispatcher:
+    '''
+    Обертка над TelegramApi с тем же интерфейсом (sendMessage, call),
+    через которую ходят все хендлеры. Вызов ждет, пока сообщение
+    не будет доставлено, поэтому порядок сообщений в чате сохраняется,
+    а переполненная очередь притормаживает хендлеры.
+    '''
+    def __init__(self, api: TelegramApi, rate: float = None):
+        self._api = api
+        # rate - сообщений в секунду на бота, по умолчанию лимит Telegram
+        rate = rate or settings.BOT_SEND_RATE_GLOBAL
+        self._global = TokenBucket(rate, rate)
+        self._chats = {}
+        self._pending = None
+        self._in_flight = None
+        self.depth = 0
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.throttled = 0
+        self.latency = LatencyStats()
+        self.api_latency = LatencyStats()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > settings.BOT_SEND_BUCKETS_MAX:
+                now = time.monotonic()
+                self._chats = {key: value for key, value in self._chats.items()
+                               if not value.is_full(now)}
+            bucket = self._chats[chat_id] = TokenBucket(
+                settings.BOT_SEND_RATE_PER_CHAT,
+                settings.BOT_SEND_BURST_PER_CHAT)
+        return bucket
+
+    def _ensure_started(self) -> None:
+        # семафоры создаются лениво, уже внутри работающего loop
+        if self._pending is None:
+            self._pending = asyncio.Semaphore(settings.BOT_SEND_QUEUE_SIZE)
+            self._in_flight = asyncio.Semaphore(settings.BOT_HTTP_POOL_SIZE)
+
+    async def call(self, method: str, chat_id: int = None, **params):
+        '''
+        Вызывает метод API с учетом лимитов. chat_id, если передан,
+        уходит в параметры и включает лимит на чат.
+        '''
+        self._ensure_started()
+        started = time.monotonic()
+        self.depth += 1
+        try:
+            async with self._pending:
+                result = await self._deliver(method, chat_id, params)
+        finally:
+            self.depth -= 1
+        self.latency.observe(time.monotonic() - started)
+        return result
+
+    async def _deliver(self, method: str, chat_id, params: dict):
+        if chat_id is not None:
+            params['chat_id'] = chat_id
+        chat_bucket = self._chat_bucket(chat_id) if chat_id else None
+        attempt = 0
+        while True:
+            if chat_bucket is not None:
+                await asyncio.sleep(chat_bucket.reserve())
+            await asyncio.sleep(self._global.reserve())
+            try:
+                async with self._in_flight:
+                    sent_at = time.monotonic()
+                    try:
+                        result = await self._api.call(method, **params)
+                    except Exception:
+                        metrics.observe_api(
+                            method, time.monotonic() - sent_at, ok=False)
+                        raise
+                    elapsed = time.monotonic() - sent_at
+                    self.api_latency.observe(elapsed)
+                    metrics.observe_api(method, elapsed, ok=True)
+                self.sent += 1
+                return result
+            except TelegramError as e:
+                if e.error_code != 429 or attempt >= settings.BOT_SEND_RETRIES:
+                    self.failed += 1
+                    raise
+                self.throttled += 1
+                delay = e.retry_after or 1
+                (chat_bucket or self._global).penalize(delay)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt >= settings.BOT_SEND_RETRIES:
+                    self.failed += 1
+                    raise
+                await asyncio.sleep(0.5 * 2 ** attempt)
+            attempt += 1
+            self.retries += 1
+            logger.warning(f'Retrying {method} for {chat_id}, '
+                           f'attempt {attempt}')
+
+    async def sendMessage(self, chat_id: int, text: str, **kwargs):
+        return await self.call('sendMessage', chat_id=chat_id, text=text,
+                               **kwargs)
+
+    async def sendPhoto(self, chat_id: int, photo, **kwargs):
+        '''photo - file_id или (имя файла, байты) для загрузки'''
+        if isinstance(photo, tuple):
+            return await self.call('sendPhoto', chat_id=chat_id,
+                                   files={'photo': photo}, **kwargs)
+        return await self.call('sendPhoto', chat_id=chat_id, photo=photo,
+                               **kwargs)
+
+    async def sendMediaGroup(self, chat_id: int, media: list,
+                             files: dict = None):
+        return await self.call('sendMediaGroup', chat_id=chat_id,
+                               media=media, files=files)
+
+    async def editMessageText(self, chat_id: int, message_id: int,
+                              text: str, **kwargs):
+        return await self.call('editMessageText', chat_id=chat_id,
+                               message_id=message_id, text=text, **kwargs)
+
+    async def editMessageMedia(self, chat_id: int, message_id: int,
+                               media: dict, files: dict = None, **kwargs):
+        return await self.call('editMessageMedia', chat_id=chat_id,
+                               message_id=message_id, media=media,
+                               files=files, **kwargs)
+
+    async def answerCallbackQuery(self, callback_query_id: str, **kwargs):
+        '''Без chat_id: ответ на нажатие не тратит лимит чата'''
+        return await self.call('answerCallbackQuery',
+                               callback_query_id=callback_query_id, **kwargs)
+
+    def stats(self) -> dict:
+        return {'depth': self.depth,
+                'sent': self.sent,
+                'failed': self.failed,
+                'retries': self.retries,
+                'throttled': self.throttled,
+                'latency': self.latency.as_dict(),
+                'api_latency': self.api_latency.as_dict()}
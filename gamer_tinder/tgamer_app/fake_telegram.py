@@ -0,0 +1,144 @@
+'''
+Заглушка Telegram Bot API для локальной отладки и нагрузочных тестов.
+Запоминает все вызовы, отвечает как настоящий API, умеет задерживать
+ответы и возвращать 429 при превышении лимитов.
+Бот направляется на нее переменной окружения TG_API_URL.
+'''
+import asyncio
+import itertools
+import json
+import time
+from aiohttp import web
+from .dispatcher import TokenBucket
+
+
+class FakeTelegram:
+    def __init__(self, latency: float = 0.0, chat_rate: float = None,
+                 chat_burst: float = 3, global_rate: float = None):
+        self.latency = latency
+        self.calls = []
+        self.webhook_url = None
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._chat_buckets = {}
+        self._global = (TokenBucket(global_rate, global_rate)
+                        if global_rate else None)
+        self._message_ids = itertools.count(1)
+        self._updates = None
+        self._update_ids = itertools.count(1)
+        self.throttled = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        app.router.add_get('/bot{token}/{method}', self.handle)
+        return app
+
+    def push_update(self, update: dict) -> None:
+        '''Кладет апдейт, который бот заберет через getUpdates'''
+        if self._updates is None:
+            self._updates = asyncio.Queue()
+        update.setdefault('update_id', next(self._update_ids))
+        self._updates.put_nowait(update)
+
+    def calls_to(self, chat_id: int, method: str = 'sendMessage') -> list:
+        return [params for name, params in self.calls
+                if name == method and params.get('chat_id') == chat_id]
+
+    def _too_many(self, chat_id) -> float:
+        '''Возвращает retry_after, если запрос превышает лимиты'''
+        if self._global is not None and not self._global.try_take():
+            return 1
+        if chat_id is not None and self._chat_rate:
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self._chat_buckets[chat_id] = TokenBucket(
+                    self._chat_rate, self._chat_burst)
+            if not bucket.try_take():
+                return 1
+        return 0
+
+    async def _get_updates(self, params: dict) -> list:
+        if self._updates is None:
+            self._updates = asyncio.Queue()
+        try:
+            first = await asyncio.wait_for(self._updates.get(),
+                                           timeout=params.get('timeout') or 0)
+        except asyncio.TimeoutError:
+            return []
+        updates = [first]
+        while not self._updates.empty():
+            updates.append(self._updates.get_nowait())
+        return updates
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        if method == 'getUpdates':
+            return self._ok(await self._get_updates(params))
+
+        self.calls.append((method, params))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        chat_id = params.get('chat_id')
+        retry_after = self._too_many(chat_id)
+        if retry_after:
+            self.throttled += 1
+            return web.json_response({
+                'ok': False, 'error_code': 429,
+                'description': f'Too Many Requests: retry after {retry_after}',
+                'parameters': {'retry_after': retry_after}})
+
+        if method == 'setWebhook':
+            self.webhook_url = params.get('url')
+            return self._ok(True)
+        if method == 'deleteWebhook':
+            self.webhook_url = None
+            return self._ok(True)
+        if method == 'getWebhookInfo':
+            return self._ok({'url': self.webhook_url or '',
+                             'pending_update_count': 0})
+        if method == 'answerCallbackQuery':
+            return self._ok(True)
+        message = {'message_id': params.get('message_id')
+                   or next(self._message_ids),
+                   'date': int(time.time()),
+                   'chat': {'id': chat_id, 'type': 'private'}}
+        if 'text' in params:
+            message['text'] = params['text']
+        if method == 'sendMediaGroup':
+            media = params.get('media') or []
+            if isinstance(media, str):
+                media = json.loads(media)
+            return self._ok([self._photo_message(chat_id)
+                             for _ in media])
+        if method in ('sendPhoto', 'editMessageMedia'):
+            message['photo'] = [{'file_id': f'fake-{message["message_id"]}',
+                                 'file_unique_id': str(message['message_id']),
+                                 'width': 0, 'height': 0}]
+        return self._ok(message)
+
+    def _photo_message(self, chat_id) -> dict:
+        message_id = next(self._message_ids)
+        return {'message_id': message_id, 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'photo': [{'file_id': f'fake-{message_id}',
+                           'file_unique_id': str(message_id),
+                           'width': 0, 'height': 0}]}
+
+    @staticmethod
+    def _ok(result) -> web.Response:
+        return web.json_response({'ok': True, 'result': result})
+
+
+async def start_fake_telegram(host: str = '127.0.0.1', port: int = 8081,
+                              **kwargs):
+    '''Поднимает заглушку в текущем loop, возвращает (fake, runner)'''
+    fake = FakeTelegram(**kwargs)
+    runner = web.AppRunner(fake.app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return fake, runner
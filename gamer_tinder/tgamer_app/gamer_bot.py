@@ -1,272 +1,639 @@
 import telepot
-import os
-import time
 from loguru import logger
 from django.conf import settings
-from telepot.loop import MessageLoop, OrderedWebhook
-from telepot.helper import ChatHandler
 from telepot.namedtuple import ReplyKeyboardRemove, Message
-from telepot.delegate import per_chat_id, create_open, pave_event_space
 from .models import Game, Player
+from .api import TelegramError
+from .runtime import ChatHandler
 from .validators import validate_steam_name
-from .markups import reg_markup, games_markup, teammate_markup
+from .markups import inline_reg_markup, inline_teammate_markup, \
+    games_catalogue, player_games_markup, GAMES_PAGE_COMMAND, ALL_MY_GAMES, \
+    CALLBACK_NEXT, CALLBACK_INVITE, CALLBACK_REGISTRATION
 from .storage import StateStorage
+from .cache import player_cache
+from .writeback import player_writes, activity_writes
+from .metrics import metrics
+from .posters import photo_file_id, poster_source, remember_file_id
+from .invites import invite_delivery, record_invite
 from . import msgs
 
 
-TOKEN = settings.TELEGRAM_TOKEN
+# длиннее подпись к фото Telegram не принимает
+PHOTO_CAPTION_MAX_LEN = 1024
 
 
 class GamerBot(ChatHandler):
+    __slots__ = ('_state',)
+    # таблицы роутинга общие для всех сессий: команда -> имя хендлера
+    text_route = {'/commands': 'on_commands',
+                  '/change_steam_name': 'reset_steam_name',
+                  '/change_about': 'reset_about',
+                  '/change_game': 'reset_prefered_game',
+                  '/add_game': 'start_add_game',
+                  '/remove_game': 'start_remove_game',
+                  '/enableSearch': 'set_enable_search',
+                  '/disableSearch': 'set_disable_search',
+                  '/find': 'find_friends',
+                  '/next': 'next_teammate',
+                  '/invite': 'invite',
+                  '/help': 'on_commands'
+                  }
+    callback_route = {CALLBACK_NEXT: 'on_next_button',
+                      CALLBACK_INVITE: 'on_invite_button',
+                      CALLBACK_REGISTRATION: 'on_reg_button'}
+    flavor_route = {'chat': 'text_router',
+                    'callback_query': 'callback_router'}
+    available_commands = '\n'.join(text_route.keys())
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.text_route = {'/commands': self.on_commands,
-                           '/change_steam_name': self.reset_steam_name,
-                           '/change_about': self.reset_about,
-                           '/change_game': self.reset_prefered_game,
-                           '/enableSearch': self.set_enable_search,
-                           '/disableSearch': self.set_disable_search,
-                           '/find': self.find_friends,
-                           '/next': self.next_teammate,
-                           '/invite': self.invite,
-                           '/help': self.on_commands
-                           }
-        self._router.routing_table['chat'] = self.text_router
-        self.available_commands = '\n'.join(self.text_route.keys())
-        self._state = StateStorage()
-
-    def text_router(self, msg):
+        # создается на апдейт и отпускается, когда сессия простаивает
+        self._state = None
+
+    async def on_message(self, msg):
+        '''
+        Подтягивает состояние диалога перед обработкой сообщения
+        и сохраняет его после.
+        '''
+        if self._state is None:
+            self._state = StateStorage(self.chat_id)
+        # после перезапуска заодно дошлет неотправленные приглашения
+        invite_delivery.attach(self._runtime)
+        await self.db(self._state.load)
+        try:
+            return await super().on_message(msg)
+        finally:
+            await self.db(self._state.save)
+
+    def compact(self):
+        '''
+        Состояние уже сохранено в бэкенде: страница кандидатов
+        и карточка текущего подтянутся заново при следующем апдейте
+        '''
+        self._state = None
+
+    async def text_router(self, msg):
         '''
         Главный роутер.
         '''
         content_type, chat_type, chat_id = telepot.glance(msg)
         if content_type != 'text':
-            return self.sender.sendMessage(msgs.ACCEPTS_MESSAGES_ONLY)
+            metrics.set_command('non_text')
+            return await self.sender.sendMessage(msgs.ACCEPTS_MESSAGES_ONLY)
         msg_text = msg['text']
 
         try:
-            player = Player.objects.get(tg_id=chat_id)
+            player = await self.get_player(chat_id)
         except Player.DoesNotExist:
             if msg_text == '/registration':
-                player = Player(tg_id=chat_id)
-                player.save()
-                return self.register(player, msg_text, start=True)
+                metrics.set_command('/registration')
+                return await self.start_registration(chat_id)
             else:
-                return self.sender.sendMessage(
-                    msgs.PLEASE_REGISTER, reply_markup=reg_markup)
+                metrics.set_command('unregistered')
+                return await self.sender.sendMessage(
+                    msgs.PLEASE_REGISTER, reply_markup=inline_reg_markup)
+
+        activity_writes.active(chat_id)
+        if msg_text.startswith(GAMES_PAGE_COMMAND):
+            metrics.set_command(GAMES_PAGE_COMMAND)
+            return await self.send_games_page(player, msg_text)
 
         if player.sign_up != player.RegistrationSteps.DONE:
-            return self.register(player, msg_text)
+            metrics.set_command('registration_step')
+            return await self.register(player, msg_text)
 
-        if self._state.get_search_status():
-            game = self.parse_game_setting_msg(player, msg['text'])
-            self._state.set_current_game(game)
-            return self.find_friends(player, msg)
+        game_action = self._state.get_game_action()
+        if game_action is not None:
+            metrics.set_command('game_choice')
+            return await self.apply_game_action(player, game_action, msg_text)
 
+        if self._state.get_search_status():
+            metrics.set_command('game_choice')
+            if msg_text == ALL_MY_GAMES:
+                game_ids = await self.db(player.get_game_ids)
+            else:
+                game = await self.parse_game_setting_msg(player, msg_text)
+                game_ids = [game.pk] if game is not None else []
+            self._state.set_current_games(game_ids)
+            return await self.find_friends(player, msg)
+
+        # произвольный текст не попадает в метки метрик
+        metrics.set_command(
+            msg_text if msg_text in self.text_route else 'default')
+        handler = getattr(self, self.text_route.get(msg_text, 'on_default'))
         if msg_text.strip() in ['/find', '/invite']:
-            return self.text_route[msg_text](player, msg)
-        return self.text_route.get(msg_text, self.on_default)(player, msg_text)
+            return await handler(player, msg)
+        return await handler(player, msg_text)
 
-    def register(self, player: Player, msg_text: str, start: bool = False):
+    async def callback_router(self, query):
+        '''
+        Роутер для inline-кнопок. callback_data - буква действия
+        и аргументы через двоеточие (см. markups.CALLBACK_*).
+        На нажатие всегда нужно ответить, иначе у кнопки крутятся часики.
+        '''
+        query_id, from_id, data = telepot.glance(query,
+                                                 flavor='callback_query')
+        action, _, args = (data or '').partition(':')
+        name = self.callback_route.get(action)
+        if name is None:
+            metrics.set_command('callback_unknown')
+            return await self.bot.answerCallbackQuery(query_id)
+        metrics.set_command(f'callback_{action}')
+        return await getattr(self, name)(query, args)
+
+    async def start_registration(self, chat_id: int):
+        '''Создает игрока и задает первый вопрос регистрации'''
+        player = Player(tg_id=chat_id)
+        await self.db(player.save)
+        player_cache.put(player)
+        return await self.register(player, '', start=True)
+
+    async def get_player(self, chat_id: int) -> Player:
+        '''
+        Достает игрока из кэша, а при промахе - из БД вместе с игрой
+        '''
+        player = player_cache.get(chat_id) or player_writes.pending(chat_id)
+        if player is None:
+            player = await self.db(
+                Player.objects.select_related('prefered_game').get,
+                tg_id=chat_id)
+            player_cache.put(player)
+        return player
+
+    async def register(self, player: Player, msg_text: str,
+                       start: bool = False):
         '''
         Дополнительный роутер для процесса регистрации
         '''
         if start:
-            return self.send_next_registration_message(player)
+            return await self.send_next_registration_message(player)
 
         if player.sign_up == player.RegistrationSteps.STEAM_NAME:
             steam_name_is_valid, validator_msg = validate_steam_name(msg_text)
             if not steam_name_is_valid:
-                return self.sender.sendMessage(validator_msg)
+                return await self.sender.sendMessage(validator_msg)
             else:
-                self.set_steam_name(player, msg_text)
+                await self.set_steam_name(player, msg_text)
 
         elif player.sign_up == player.RegistrationSteps.ABOUT:
-            self.set_about(player, msg_text)
+            await self.set_about(player, msg_text)
 
         elif player.sign_up == player.RegistrationSteps.PREFERED_GAME:
-            game = self.parse_game_setting_msg(player, msg_text)
-            self.set_prefered_game(player, game)
+            game = await self.parse_game_setting_msg(player, msg_text)
+            await self.set_prefered_game(player, game)
 
-        return self.send_next_registration_message(player)
+        return await self.send_next_registration_message(player)
 
-    def parse_game_setting_msg(self, player: Player, msg_text: str):
-        '''Сопоставляет объекты из БД с коммандой выбора игры'''
+    async def parse_game_setting_msg(self, player: Player, msg_text: str):
+        '''Сопоставляет игры из каталога с коммандой выбора игры'''
         try:
             game_id = int(msg_text.split()[0])
-            game = Game.objects.get(pk=game_id)
-            return game
-
-        except (Game.DoesNotExist, ValueError):
+        except ValueError:
             logger.exception('Error while parcing game name', backtrace=False)
             return None
+        game = await self.db(games_catalogue.get_game, game_id)
+        if game is None:
+            logger.warning(f'Unknown game id {game_id}')
+        return game
+
+    async def games_markup(self, page: int = 1, search: bool = False) -> str:
+        '''
+        Готовая клавиатура выбора игры из каталога, в поиске -
+        с кнопкой "все мои игры"
+        '''
+        return await self.db(games_catalogue.get_markup, page, search)
 
-    def send_next_registration_message(self, player: Player) -> str:
+    async def send_games_page(self, player: Player, msg_text: str):
+        '''Хендлер для перелистывания клавиатуры с играми'''
+        try:
+            page = int(msg_text.split()[1])
+        except (IndexError, ValueError):
+            page = 1
+        search = self._state.get_search_status()
+        return await self.send_game_picker(msgs.ENTER_GAME, page, search)
+
+    async def send_game_picker(self, text: str, page: int = 1,
+                               search: bool = False):
+        '''Альбом с постерами игр страницы и клавиатура выбора игры'''
+        if settings.GAMES_PICKER_POSTERS:
+            games = await self.db(games_catalogue.get_page_games, page)
+            await self.send_posters(games[:settings.GAMES_PICKER_POSTERS])
+        return await self.sender.sendMessage(
+            text, reply_markup=await self.games_markup(page, search=search))
+
+    async def send_posters(self, games: list) -> None:
+        '''
+        Отправляет постеры альбомом: уже загруженные - по file_id,
+        остальные файлами, и запоминает их file_id
+        '''
+        sources = await self.db(lambda: [poster_source(game)
+                                          for game in games])
+        posters = [(game, source) for game, source in zip(games, sources)
+                   if source is not None]
+        if not posters:
+            return
+        media, files = [], {}
+        for idx, (game, source) in enumerate(posters):
+            if isinstance(source, tuple):
+                files[f'poster{idx}'] = source
+                source = f'attach://poster{idx}'
+            media.append({'type': 'photo', 'media': source,
+                          'caption': f'{game.id} {game.title}'})
+        try:
+            if len(media) == 1:
+                # в альбоме должно быть от 2 фото
+                photo = files.get('poster0') or media[0]['media']
+                sent = [await self.sender.sendPhoto(
+                    photo, caption=media[0]['caption'])]
+            else:
+                sent = await self.sender.sendMediaGroup(media,
+                                                        files=files or None)
+        except TelegramError as e:
+            logger.warning(f'Could not send posters: {e.description}')
+            return
+        if files:
+            await self.db(lambda: [
+                remember_file_id(game, photo_file_id(message), source)
+                for (game, source), message in zip(posters, sent)
+                if isinstance(source, tuple)])
+
+    async def send_next_registration_message(self, player: Player) -> str:
         '''Еще один роутер для шагов связанных с регистрацией'''
         route = {
          player.RegistrationSteps.STEAM_NAME: (msgs.ENTER_STEAM_NAME,
                                                ReplyKeyboardRemove()),
          player.RegistrationSteps.ABOUT: (msgs.ENTER_ABOUT, None),
          player.RegistrationSteps.PREFERED_GAME: (msgs.ENTER_PREF_GAME,
-                                                  games_markup),
+                                                  None),
          player.RegistrationSteps.DONE: (msgs.REG_SUCCESS,
                                          ReplyKeyboardRemove())
          }
         msg_text = route[player.sign_up][0]
         markup = route[player.sign_up][1]
-        return self.sender.sendMessage(msg_text, reply_markup=markup)
+        if player.sign_up == player.RegistrationSteps.PREFERED_GAME:
+            return await self.send_game_picker(msg_text)
+        return await self.sender.sendMessage(msg_text, reply_markup=markup)
 
-    def set_steam_name(self, player: Player, msg_text: str) -> None:
+    async def save_player(self, player: Player, *fields: str) -> None:
+        '''
+        Откладывает запись полей игрока в буфер. Когда регистрация
+        завершена, пишет сразу, чтобы игрок тут же попал в поиск.
+        '''
+        was_done = player.sign_up == player.RegistrationSteps.DONE
+        player_writes.mark(player, *fields)
+        if not was_done and player.sign_up == player.RegistrationSteps.DONE:
+            await self.db(player_writes.flush, player.tg_id)
+
+    async def set_steam_name(self, player: Player, msg_text: str) -> None:
         '''Сохраняет информацию об имени в стиме в БД'''
         player.steam_name = msg_text
-        player.save(update_fields=['steam_name', 'sign_up'])
+        await self.save_player(player, 'steam_name', 'sign_up')
 
-    def set_about(self, player: Player, msg_text: str) -> None:
+    async def set_about(self, player: Player, msg_text: str) -> None:
         '''
         Сохраняет информацию об игроке в БД
         '''
         player.about = msg_text
-        player.save(update_fields=['about', 'sign_up'])
+        await self.save_player(player, 'about', 'sign_up')
 
-    def set_prefered_game(self, player: Player, game: Game):
+    async def set_prefered_game(self, player: Player, game: Game):
         '''
-        Сохраняет любимую игру в бд
+        Сохраняет любимую игру в бд и добавляет ее в список игр
+        игрока
         '''
+        if game is not None:
+            await self.db(player.add_game, game)
         player.prefered_game = game
-        player.save(update_fields=['prefered_game', 'sign_up'])
+        await self.save_player(player, 'prefered_game', 'sign_up')
+
+    async def start_add_game(self, player: Player, msg_text: str):
+        '''Хендлер для /add_game: ждем игру из каталога'''
+        self._state.set_search_status(False)
+        self._state.set_game_action('add')
+        return await self.send_game_picker(msgs.ENTER_GAME_TO_ADD)
+
+    async def start_remove_game(self, player: Player, msg_text: str):
+        '''Хендлер для /remove_game: ждем игру из списка игрока'''
+        games = await self.db(player.get_games)
+        if not games:
+            return await self.sender.sendMessage(msgs.NO_GAMES)
+        self._state.set_search_status(False)
+        self._state.set_game_action('remove')
+        return await self.sender.sendMessage(
+            msgs.ENTER_GAME_TO_REMOVE,
+            reply_markup=player_games_markup(games))
+
+    async def apply_game_action(self, player: Player, action: str,
+                                msg_text: str):
+        '''Добавляет или убирает выбранную игру из списка игрока'''
+        self._state.set_game_action(None)
+        game = await self.parse_game_setting_msg(player, msg_text)
+        if game is None:
+            return await self.sender.sendMessage(
+                msgs.UNKNOWN_GAME, reply_markup=ReplyKeyboardRemove())
+        if action == 'add':
+            await self.db(player.add_game, game)
+            text = msgs.GAME_ADDED.format(game.title)
+        elif game.pk == player.prefered_game_id:
+            text = msgs.CANT_REMOVE_PREFERED
+        else:
+            await self.db(player.remove_game, game.pk)
+            text = msgs.GAME_REMOVED.format(game.title)
+        return await self.sender.sendMessage(
+            text, reply_markup=ReplyKeyboardRemove())
 
-    def set_enable_search(self, player: Player, msg) -> None:
+    async def set_enable_search(self, player: Player, msg) -> None:
         '''Включает поиск'''
         player.search_enabled = True
-        player.save(update_fields=['search_enabled'])
-        self.sender.sendMessage(msgs.SEARCH_ENABLED)
+        await self.save_player(player, 'search_enabled')
+        await self.sender.sendMessage(msgs.SEARCH_ENABLED)
 
-    def set_disable_search(self, player: Player, msg) -> None:
+    async def set_disable_search(self, player: Player, msg) -> None:
         '''Выключает поиск'''
         player.search_enabled = False
-        player.save(update_fields=['search_enabled'])
-        self.sender.sendMessage(msgs.SEARCH_DISABLED)
+        await self.save_player(player, 'search_enabled')
+        await self.sender.sendMessage(msgs.SEARCH_DISABLED)
 
-    def on_default(self, player, msg_text):
+    async def on_default(self, player, msg_text):
         '''Хендлер для сообщений которые не предусмотрены ботом'''
-        self.sender.sendMessage(
+        await self.sender.sendMessage(
             msgs.NOT_UNDERSTAND +
             f'\n{self.available_commands}')
 
-    def on_commands(self, player, msg_text):
+    async def on_commands(self, player, msg_text):
         '''Хендлер для /commands'''
-        self.sender.sendMessage(
+        await self.sender.sendMessage(
              f'{msgs.COMMAND_LIST}\n{self.available_commands}')
 
-    def reset_steam_name(self, player, msg):
+    async def reset_steam_name(self, player, msg):
         '''
         Сбрасывает, поле с именем в стиме, после чего бот автоматически
         попросит пользователя указать любимую игру заново.
         '''
         player.steam_name = ''
-        player.save(update_fields=['steam_name', 'sign_up'])
-        return self.register(player, '', start=True)
+        await self.save_player(player, 'steam_name', 'sign_up')
+        return await self.register(player, '', start=True)
 
-    def reset_about(self, player, msg):
+    async def reset_about(self, player, msg):
         '''
         Сбрасывает, поле с описанием игрока, после чего бот автоматически
         попросит пользователя указать его заново.
         '''
         player.about = ''
-        player.save(update_fields=['about', 'sign_up'])
-        return self.register(player, '', start=True)
+        await self.save_player(player, 'about', 'sign_up')
+        return await self.register(player, '', start=True)
 
-    def reset_prefered_game(self, player, msg):
+    async def reset_prefered_game(self, player, msg):
         '''
         Сбрасывает, поле с любимой игрой, после чего бот автоматически
         попросит пользователя указать любимую игру заново.
         '''
         player.prefered_game = None
-        player.save(update_fields=['prefered_game', 'sign_up'])
-        return self.register(player, '', start=True)
+        await self.save_player(player, 'prefered_game', 'sign_up')
+        return await self.register(player, '', start=True)
 
-    def check_username_set(self, player: Player, msg: Message):
+    async def check_username_set(self, player: Player, msg: Message):
         '''
         Проверка на то установлен ли параметр username у пользователя
         '''
         try:
             username = msg['from']['username']
         except KeyError:
-            return self.sender.sendMessage(msgs.SHOW_USERNAME)
+            return await self.sender.sendMessage(msgs.SHOW_USERNAME)
         return username
 
-    def find_friends(self, player: Player, msg: Message):
+    async def find_friends(self, player: Player, msg: Message):
         '''
         Хендл для поиска игрока.
         В if-else сохраняется статус поиска, чтобы роутер вернул нас
         в эту функцию.
         '''
         if not self._state.get_search_status():
-            self.check_username_set(player, msg)
-            self.sender.sendMessage(
-                msgs.ENTER_GAME, reply_markup=games_markup)
+            await self.check_username_set(player, msg)
+            await self.send_game_picker(msgs.ENTER_GAME, search=True)
             self._state.set_search_status(True)
         else:
             self._state.set_search_status(False)
-            game = self._state.get_current_game(player)
-            if game is None:
-                return self.find_friends(player, msg)
-            teammates = self._state.update_possible_teammates(
-                player, game)
+            game_ids = self._state.get_current_games()
+            if not game_ids:
+                return await self.find_friends(player, msg)
+            teammates = await self.db(
+                self._state.update_possible_teammates, player, game_ids)
             if not teammates:
-                return self.sender.sendMessage(msgs.NO_PLAYERS_FOUND)
-            return self.next_teammate(player, msg)
+                return await self.sender.sendMessage(msgs.NO_PLAYERS_FOUND)
+            return await self.next_teammate(player, msg)
 
-    def next_teammate(self, player: Player, msg: Message):
+    async def next_teammate(self, player: Player, msg: Message):
         '''Хендл для кнопки некст в поиске'''
         try:
-            possible_teammate = self._state.get_next_teammate()
+            possible_teammate = await self.db(self._state.get_next_teammate)
         except IndexError:
-            return self.sender.sendMessage(msgs.NO_MORE_PLAYERS_FOUND)
-        possible_teammate_card = self.prepare_player_card(possible_teammate)
-        return self.sender.sendMessage(
-            possible_teammate_card, reply_markup=teammate_markup)
+            return await self.sender.sendMessage(msgs.NO_MORE_PLAYERS_FOUND)
+        activity_writes.shown(possible_teammate.tg_id)
+        return await self.send_player_card(possible_teammate)
 
-    def invite(self, player: Player, msg: Message):
+    async def send_player_card(self, player: Player):
+        '''
+        Карточка игрока подписью к постеру его любимой игры, если
+        помещается в подпись, иначе просто текстом
+        '''
+        card = self.prepare_player_card(player)
+        game = self.card_game(player)
+        poster = None
+        if game is not None and len(card) <= PHOTO_CAPTION_MAX_LEN:
+            poster = await self.db(poster_source, game)
+        markup = self.card_markup(player)
+        if poster is None:
+            return await self.sender.sendMessage(card, reply_markup=markup)
+        message = await self.sender.sendPhoto(
+            poster, caption=card, reply_markup=markup)
+        if isinstance(poster, tuple):
+            await self.db(remember_file_id, game, photo_file_id(message),
+                          poster)
+        return message
+
+    def card_markup(self, player: Player):
+        return inline_teammate_markup(self._state.get_search_id(),
+                                      player.tg_id)
+
+    async def edit_player_card(self, message: dict, player: Player):
+        '''
+        Показывает следующего игрока в том же сообщении вместо нового.
+        Фото-карточка меняет постер и подпись, текстовая - текст.
+        Если новая карточка в старое сообщение не помещается
+        (из фото не сделать текст и наоборот), отправляется новое.
+        '''
+        card = self.prepare_player_card(player)
+        markup = self.card_markup(player)
+        message_id = message['message_id']
+        game = self.card_game(player)
+        try:
+            if 'text' in message:
+                return await self.sender.editMessageText(
+                    message_id, card, reply_markup=markup)
+            poster = None
+            if ('photo' in message and game is not None
+                    and len(card) <= PHOTO_CAPTION_MAX_LEN):
+                poster = await self.db(poster_source, game)
+            if poster is None:
+                return await self.send_player_card(player)
+            files = None
+            media = {'type': 'photo', 'media': poster, 'caption': card}
+            if isinstance(poster, tuple):
+                files = {'poster': poster}
+                media['media'] = 'attach://poster'
+            edited = await self.sender.editMessageMedia(
+                message_id, media, files=files, reply_markup=markup)
+        except TelegramError as e:
+            # сообщение удалили или оно слишком старое для правки
+            logger.warning(f'Could not edit card {message_id}: '
+                           f'{e.description}')
+            return await self.send_player_card(player)
+        if files:
+            await self.db(remember_file_id, game, photo_file_id(edited),
+                          poster)
+        return edited
+
+    async def invite(self, player: Player, msg: Message):
         '''Хендл для инвайта'''
-        username = self.check_username_set(player, msg)
+        username = msg['from'].get('username')
+        if not username:
+            return await self.sender.sendMessage(msgs.SHOW_USERNAME)
         teammate = self._state.get_current_teammate()
-        self.bot.sendMessage(
-            teammate.tg_id,
-            f'Пользователю {username} понравилась ваша карточка по игре.' +
-            ' Напиши ему!')
-        return self.sender.sendMessage(
-            f'Сообщение {teammate.steam_name} успешно отправлено!')
+        if teammate is None:
+            # поиск не начат или сессия сброшена по таймауту
+            return await self.sender.sendMessage(msgs.CARD_EXPIRED)
+        reply, _ = await self.send_invite(username, teammate)
+        return await self.sender.sendMessage(reply)
+
+    async def send_invite(self, username: str, teammate: Player):
+        '''
+        Записывает приглашение, уведомление получателю уйдет в фоне
+        (invites.InviteDelivery). Возвращает ответ пригласившему
+        и взаимно ли приглашение.
+        '''
+        games = self._state.get_current_games()
+        created, mutual_username = await self.db(
+            record_invite, self.chat_id, teammate.tg_id, username,
+            games[0] if games else None)
+        if not created:
+            # уже приглашал: второй раз получателя не беспокоим
+            return msgs.INVITE_SENT.format(teammate.steam_name), False
+        activity_writes.invited(teammate.tg_id)
+        invite_delivery.schedule(self._runtime, teammate.tg_id)
+        if mutual_username is not None:
+            return msgs.INVITE_MUTUAL.format(teammate.steam_name,
+                                             mutual_username), True
+        return msgs.INVITE_SENT.format(teammate.steam_name), False
+
+    def get_card_teammate(self, args: str):
+        '''
+        Текущий кандидат, если кнопка нажата под его карточкой
+        в текущем поиске, иначе None - карточка устарела
+        '''
+        try:
+            search_id, tg_id = map(int, args.split(':'))
+        except ValueError:
+            return None
+        teammate = self._state.get_current_teammate()
+        if (search_id != self._state.get_search_id() or teammate is None
+                or teammate.tg_id != tg_id):
+            return None
+        return teammate
+
+    async def on_next_button(self, query, args: str):
+        '''Кнопка /next под карточкой: следующий игрок в том же сообщении'''
+        query_id = query['id']
+        if self.get_card_teammate(args) is None:
+            return await self.bot.answerCallbackQuery(
+                query_id, text=msgs.CARD_EXPIRED)
+        activity_writes.active(self.chat_id)
+        try:
+            teammate = await self.db(self._state.get_next_teammate)
+        except IndexError:
+            return await self.bot.answerCallbackQuery(
+                query_id, text=msgs.NO_MORE_PLAYERS_FOUND)
+        activity_writes.shown(teammate.tg_id)
+        await self.edit_player_card(query['message'], teammate)
+        return await self.bot.answerCallbackQuery(query_id)
+
+    async def on_invite_button(self, query, args: str):
+        '''
+        Кнопка /invite под карточкой, об успехе сообщает всплывающая
+        подсказка, а не новое сообщение
+        '''
+        query_id = query['id']
+        teammate = self.get_card_teammate(args)
+        if teammate is None:
+            return await self.bot.answerCallbackQuery(
+                query_id, text=msgs.CARD_EXPIRED)
+        activity_writes.active(self.chat_id)
+        username = query['from'].get('username')
+        if not username:
+            return await self.bot.answerCallbackQuery(
+                query_id, text=msgs.SHOW_USERNAME, show_alert=True)
+        reply, mutual = await self.send_invite(username, teammate)
+        # username для ответа не должен исчезнуть через пару секунд
+        return await self.bot.answerCallbackQuery(query_id, text=reply,
+                                                  show_alert=mutual)
+
+    async def on_reg_button(self, query, args: str):
+        '''Кнопка регистрации под приглашением зарегистрироваться'''
+        await self.bot.answerCallbackQuery(query['id'])
+        try:
+            await self.get_player(self.chat_id)
+        except Player.DoesNotExist:
+            return await self.start_registration(self.chat_id)
 
     def prepare_player_card(self, player: Player) -> str:
-        '''Создает карточку игрока, просто строка с информацией'''
-        card = f'Игрок: {player.steam_name}.\n' + \
-               f'Любимая игра: {player.prefered_game.title}.\n' + \
+        '''
+        Создает карточку игрока, просто строка с информацией.
+        Игры игрока должны быть подгружены заранее (prefetch_related)
+        '''
+        games = ', '.join(self.describe_player_game(player_game)
+                          for player_game in player.player_games.all())
+        # любимую игру могли удалить из каталога (SET_NULL)
+        favourite = player.prefered_game
+        favourite = (f'Любимая игра: {favourite.title}.\n'
+                     if favourite is not None else '')
+        card = f'Игрок: {player.steam_name}.\n' + favourite + \
+               (f'Игры: {games}.\n' if games else '') + \
                f'Об игроке: {player.about}'
         return card
 
+    @staticmethod
+    def card_game(player: Player):
+        '''
+        Игра, чей постер показывается на карточке: любимая, а если ее
+        удалили - первая из списка игр игрока, None - игр нет
+        '''
+        if player.prefered_game is not None:
+            return player.prefered_game
+        player_game = next(iter(player.player_games.all()), None)
+        return player_game.game if player_game is not None else None
+
+    @staticmethod
+    def describe_player_game(player_game) -> str:
+        details = [detail for detail in (player_game.role, player_game.skill)
+                   if detail]
+        if not details:
+            return player_game.game.title
+        return f'{player_game.game.title} ({", ".join(map(str, details))})'
+
     def on__idle(self, event):
         '''
         Очищаем стейт, чтобы не засорять память.
         '''
+        if player_writes.pending(self.chat_id) is None:
+            player_cache.invalidate(self.chat_id)
+        else:
+            # запись дописывается в потоке БД, а кэш чистится уже после
+            self._runtime.spawn(self._flush_and_forget())
         self.close()
 
+    async def _flush_and_forget(self):
+        try:
+            await self.db(player_writes.flush, self.chat_id)
+        finally:
+            player_cache.invalidate(self.chat_id)
 
-@logger.catch
-def run_as_polling():
-    bot = telepot.DelegatorBot(TOKEN, [pave_event_space()(
-        per_chat_id(), create_open, GamerBot, timeout=1200),
-    ])
-    MessageLoop(bot).run_as_thread()
-    print('Listening ...')#
-
-    while True:
-        time.sleep(10)
-
-
-bot = telepot.DelegatorBot(TOKEN, [pave_event_space()(
-    per_chat_id(), create_open, GamerBot, timeout=1200),
-])
-bot.setWebhook(f'https://authdemka.ru/bot/{TOKEN}/')
-webhook = OrderedWebhook(bot)
-webhook.run_as_thread()
@@ -0,0 +1,103 @@
+'''
+Защита на входе рантайма: апдейты, которые Telegram доставил
+повторно (вебхук ответил слишком поздно), и команды, которые чат
+шлет быстрее, чем бот успевает их обработать, отбрасываются
+до хендлеров. Сколько работы так сэкономлено, видно в /metrics.
+'''
+import time
+from .dispatcher import TokenBucket
+
+
+class UpdateDedup:
+    '''
+    Последние size update_id: кольцевой буфер, чтобы забывать старые,
+    и множество для проверки. Память постоянная, проверка O(1).
+    Не полагается на то, что id растут: после недели без апдейтов
+    Telegram начинает нумерацию со случайного числа.
+    '''
+    def __init__(self, size: int):
+        self._ring = [None] * size
+        self._pos = 0
+        self._seen = set()
+        self.duplicates = 0
+
+    def seen(self, update_id) -> bool:
+        '''True, если апдейт уже был, иначе запоминает его'''
+        if update_id is None:
+            return False
+        if update_id in self._seen:
+            self.duplicates += 1
+            return True
+        old = self._ring[self._pos]
+        if old is not None:
+            self._seen.discard(old)
+        self._ring[self._pos] = update_id
+        self._seen.add(update_id)
+        self._pos = (self._pos + 1) % len(self._ring)
+        return False
+
+
+class InboundLimiter:
+    '''
+    Лимит на команды чата: текст с "/" и нажатия inline-кнопок.
+    Такая же команда, которая уже ждет своей очереди в этом чате,
+    склеивается с ней (coalesced), а сверх rate команд в секунду
+    (с запасом burst) команды отбрасываются (throttled). Обычный
+    текст не режется: это ответы на шаги регистрации и выбор игры.
+    '''
+    def __init__(self, rate: float, burst: float, coalesce: bool = True,
+                 max_buckets: int = 10000):
+        self._rate = rate
+        self._burst = burst
+        self._coalesce = coalesce
+        self._max_buckets = max_buckets
+        self._buckets = {}
+        # chat_id -> команды, которые ждут лока чата
+        self._waiting = {}
+        self.coalesced = 0
+        self.throttled = 0
+
+    @staticmethod
+    def command_key(msg: dict):
+        '''Команда апдейта или None, если это обычный текст'''
+        if 'data' in msg:
+            return msg['data']
+        text = msg.get('text')
+        if text and text.startswith('/'):
+            return text.strip()
+        return None
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if len(self._buckets) > self._max_buckets:
+                now = time.monotonic()
+                self._buckets = {key: value
+                                 for key, value in self._buckets.items()
+                                 if not value.is_full(now)}
+            bucket = self._buckets[chat_id] = TokenBucket(self._rate,
+                                                          self._burst)
+        return bucket
+
+    def admit(self, chat_id: int, key: str) -> bool:
+        '''Пропускать ли команду key; пропущенная считается ждущей'''
+        waiting = self._waiting.get(chat_id)
+        if self._coalesce and waiting is not None and key in waiting:
+            self.coalesced += 1
+            return False
+        if not self._bucket(chat_id).try_take():
+            self.throttled += 1
+            return False
+        if waiting is None:
+            waiting = self._waiting[chat_id] = set()
+        waiting.add(key)
+        return True
+
+    def started(self, chat_id: int, key: str) -> None:
+        '''Команда дождалась лока: такую же снова можно ставить в очередь'''
+        waiting = self._waiting.get(chat_id)
+        if waiting is None:
+            return
+        waiting.discard(key)
+        if not waiting:
+            del self._waiting[chat_id]
@@ -0,0 +1,118 @@
+'''
+Прием апдейтов с вебхука: ограниченная очередь, разбитая на шарды
+по chat_id, и по воркеру на каждый шард.
+'''
+import asyncio
+import threading
+from loguru import logger
+from .runtime import BotRuntime, extract_message, get_chat_id
+from .metrics import metrics
+
+
+def shard_of(update: dict, count: int, salt: int = 0) -> int:
+    '''
+    Номер шарда апдейта: по chat_id, а если чата нет - по update_id.
+    Разные уровни шардирования (процессы, очереди внутри процесса)
+    передают разный salt, чтобы их шарды не коррелировали.
+    Хэш кортежа из int одинаков во всех процессах.
+    '''
+    msg = extract_message(update)
+    chat_id = get_chat_id(msg) if msg is not None else None
+    key = chat_id if chat_id is not None else update.get('update_id', 0)
+    return hash((salt, key)) % count
+
+
+class UpdateQueue:
+    '''
+    Вебхук только кладет апдейт в очередь и сразу отвечает Telegram.
+    Апдейты одного чата всегда попадают в один шард и обрабатываются
+    по порядку, а медленный чат задерживает только свой шард.
+    Повторы и флуд (BotRuntime.admit) отсеиваются до шарда,
+    чтобы не занимать в нем место.
+    '''
+    def __init__(self, runtime: BotRuntime, workers: int, maxsize: int):
+        self._runtime = runtime
+        self._workers = workers
+        self._shard_size = max(1, maxsize // workers)
+        self._shards = []
+        self._depth = [0] * workers
+        self._lock = threading.Lock()
+        self.received = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.shed = 0
+        self.max_depth = 0
+        metrics.register('update_queue', self.gauges)
+
+    @property
+    def runtime(self) -> BotRuntime:
+        return self._runtime
+
+    def start(self) -> None:
+        '''Создает шарды и воркеров в loop рантайма'''
+        self._runtime.submit(self.open()).result()
+
+    async def open(self) -> None:
+        '''То же, что start, но изнутри loop рантайма'''
+        for idx in range(self._workers):
+            shard = asyncio.Queue()
+            self._shards.append(shard)
+            self._runtime.spawn(self._work(idx, shard))
+
+    def put(self, update: dict) -> bool:
+        '''
+        Потокобезопасно кладет апдейт в очередь, не блокируясь.
+        Возвращает False, если шард переполнен.
+        '''
+        idx = shard_of(update, self._workers)
+        with self._lock:
+            self.received += 1
+            if self._depth[idx] >= self._shard_size:
+                self.rejected += 1
+                logger.warning(f'Update queue shard {idx} is full')
+                return False
+            self._depth[idx] += 1
+            self.accepted += 1
+            self.max_depth = max(self.max_depth, sum(self._depth))
+        self._runtime.loop.call_soon_threadsafe(self._enqueue, idx, update)
+        return True
+
+    def _enqueue(self, idx: int, update: dict) -> None:
+        if self._runtime.admit(update):
+            self._shards[idx].put_nowait(update)
+            return
+        with self._lock:
+            self._depth[idx] -= 1
+            self.shed += 1
+
+    async def _work(self, idx: int, shard: asyncio.Queue) -> None:
+        while True:
+            update = await shard.get()
+            try:
+                await self._runtime.handle(update, admitted=True)
+            finally:
+                with self._lock:
+                    self._depth[idx] -= 1
+                    self.processed += 1
+
+    def gauges(self) -> dict:
+        with self._lock:
+            return {'update_queue_depth': sum(self._depth),
+                    'update_queue_max_depth': self.max_depth,
+                    'update_queue_accepted_total': self.accepted,
+                    'update_queue_rejected_total': self.rejected,
+                    'update_queue_processed_total': self.processed,
+                    'update_queue_shed_total': self.shed}
+
+    def stats(self) -> dict:
+        '''Снимок метрик очереди'''
+        with self._lock:
+            return {'received': self.received,
+                    'accepted': self.accepted,
+                    'rejected': self.rejected,
+                    'processed': self.processed,
+                    'shed': self.shed,
+                    'depth': sum(self._depth),
+                    'max_depth': self.max_depth,
+                    'shard_depth': list(self._depth)}
@@ -0,0 +1,261 @@
+'''
+Приглашения: хендлер только записывает Invite в БД и ставит
+получателя в расписание, а уведомления отправляет InviteDelivery
+в event loop рантайма, так что чат отправителя не ждет доставки
+чужому чату. Первое приглашение получателю уходит сразу, следующие
+за окно BOT_INVITE_DIGEST_WINDOW копятся и приходят одним сообщением.
+Неотправленные приглашения лежат в БД: delivered_at ставится только
+после успешной отправки, после перезапуска их подбирает attach(),
+а взятые в отправку упавшим процессом - он же по истечении аренды
+BOT_INVITE_CLAIM_LEASE.
+'''
+import asyncio
+import heapq
+from datetime import timedelta
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+from loguru import logger
+from .api import TelegramError
+from .metrics import metrics
+from .models import Invite
+from . import msgs
+
+
+def record_invite(sender_id: int, recipient_id: int, username: str,
+                  game_id: int = None):
+    '''
+    Сохраняет приглашение. Возвращает (created, mutual_username):
+    created - False, если этот игрок уже приглашал получателя,
+    mutual_username - username получателя, если он уже приглашал
+    отправителя, иначе None
+    '''
+    try:
+        with transaction.atomic():
+            Invite.objects.create(sender_id=sender_id,
+                                  recipient_id=recipient_id,
+                                  sender_username=username, game_id=game_id)
+    except IntegrityError:
+        return False, None
+    # обратная пара ищется по уникальному индексу (sender, recipient)
+    mutual_username = Invite.objects.filter(
+        sender_id=recipient_id, recipient_id=sender_id).values_list(
+        'sender_username', flat=True).first()
+    if mutual_username is not None:
+        Invite.objects.filter(
+            Q(sender_id=sender_id, recipient_id=recipient_id)
+            | Q(sender_id=recipient_id, recipient_id=sender_id)).update(
+            mutual=True)
+    return True, mutual_username
+
+
+def claim_pending(recipient_id: int, lease: float) -> tuple:
+    '''
+    Берет в отправку недоставленные приглашения получателя одним
+    UPDATE, так что два процесса не отправят одно и то же дважды.
+    Возвращает (метка claimed_at, список (username, mutual)); метка
+    нужна, чтобы потом отметить доставку или вернуть приглашения.
+    '''
+    now = timezone.now()
+    claimed = Invite.objects.filter(
+        Q(claimed_at__isnull=True)
+        | Q(claimed_at__lt=now - timedelta(seconds=lease)),
+        recipient_id=recipient_id, delivered_at__isnull=True).update(
+        claimed_at=now)
+    if not claimed:
+        return now, []
+    return now, list(Invite.objects.filter(
+        recipient_id=recipient_id, claimed_at=now,
+        delivered_at__isnull=True).order_by('created_at').values_list(
+        'sender_username', 'mutual'))
+
+
+def mark_delivered(recipient_id: int, claimed_at) -> None:
+    Invite.objects.filter(recipient_id=recipient_id, claimed_at=claimed_at,
+                          delivered_at__isnull=True).update(
+        delivered_at=timezone.now())
+
+
+def release_claim(recipient_id: int, claimed_at) -> None:
+    '''Возвращает неотправленные приглашения, их возьмут снова'''
+    Invite.objects.filter(recipient_id=recipient_id, claimed_at=claimed_at,
+                          delivered_at__isnull=True).update(claimed_at=None)
+
+
+def pending_recipients(lease: float, created_before=None) -> list:
+    '''
+    Получатели недоставленных приглашений, которые никто не держит
+    в отправке дольше lease секунд. created_before - только приглашения
+    старше этого времени: свежие ждут окна в процессе, который их записал
+    '''
+    pending = Invite.objects.filter(
+        Q(claimed_at__isnull=True)
+        | Q(claimed_at__lt=timezone.now() - timedelta(seconds=lease)),
+        delivered_at__isnull=True)
+    if created_before is not None:
+        pending = pending.filter(created_at__lt=created_before)
+    return list(pending.values_list('recipient_id', flat=True).distinct())
+
+
+def compose_notification(invites: list, limit: int) -> str:
+    '''Текст уведомления по списку (username, mutual)'''
+    if len(invites) == 1:
+        username, mutual = invites[0]
+        text = msgs.INVITE_RECEIVED_MUTUAL if mutual else msgs.INVITE_RECEIVED
+        return text.format(username)
+    lines = [msgs.INVITE_DIGEST_MUTUAL.format(username) if mutual
+             else username for username, mutual in invites[:limit]]
+    if len(invites) > limit:
+        lines.append(msgs.INVITE_DIGEST_MORE.format(len(invites) - limit))
+    return msgs.INVITE_DIGEST.format(len(invites), '\n'.join(lines))
+
+
+class InviteDelivery:
+    '''
+    Расписание уведомлений: куча (когда, получатель) и задача в loop
+    рантайма, которая будит себя к ближайшему сроку. Получатель
+    в расписании один раз, сколько бы приглашений ни пришло
+    до срока, - они и склеиваются в одно сообщение.
+    '''
+    def __init__(self, window: float = None, limit: int = None,
+                 lease: float = None):
+        self._window = (settings.BOT_INVITE_DIGEST_WINDOW if window is None
+                        else window)
+        self._limit = limit or settings.BOT_INVITE_DIGEST_MAX
+        self._lease = lease or settings.BOT_INVITE_CLAIM_LEASE
+        self._runtime = None
+        self._heap = []
+        # получатель -> когда отправить
+        self._due = {}
+        # получатель -> когда последний раз отправляли (время loop)
+        self._last_sent = {}
+        self._prune_at = 1000
+        self._wakeup = None
+        self.scheduled = 0
+        self.coalesced = 0
+        self.notifications = 0
+        self.delivered = 0
+        self.failed = 0
+        metrics.register('invites', self.gauges)
+
+    def attach(self, runtime) -> None:
+        '''
+        Запускает доставку в loop рантайма и подбирает приглашения,
+        не доставленные до перезапуска. Вызывать в этом loop,
+        повторные вызовы с тем же рантаймом ничего не делают
+        '''
+        if self._runtime is runtime:
+            return
+        self._runtime = runtime
+        self._heap = []
+        self._due = {}
+        self._wakeup = asyncio.Event()
+        runtime.spawn(self._run(runtime))
+        runtime.spawn(self._recover(runtime))
+
+    def schedule(self, runtime, recipient_id: int) -> None:
+        '''Ставит уведомление получателю, вызывать в loop рантайма'''
+        self.attach(runtime)
+        if recipient_id in self._due:
+            self.coalesced += 1
+            return
+        now = runtime.loop.time()
+        last = self._last_sent.get(recipient_id)
+        due = now if last is None else max(now, last + self._window)
+        self._due[recipient_id] = due
+        heapq.heappush(self._heap, (due, recipient_id))
+        self.scheduled += 1
+        self._wakeup.set()
+
+    async def _recover(self, runtime) -> None:
+        '''
+        Сразу после запуска - все недоставленные приглашения, потом
+        раз в lease - те, что бросил упавший процесс
+        '''
+        created_before = None
+        while self._runtime is runtime:
+            try:
+                recipients = await runtime.run_sync(
+                    pending_recipients, self._lease, created_before)
+            except Exception:
+                logger.exception('Error while loading pending invites')
+                recipients = []
+            for recipient_id in recipients:
+                self.schedule(runtime, recipient_id)
+            await asyncio.sleep(self._lease)
+            created_before = timezone.now() - timedelta(seconds=self._lease)
+
+    async def _run(self, runtime) -> None:
+        loop = runtime.loop
+        # рантайм сменился (стенд запускает новый) - задача не нужна
+        while self._runtime is runtime:
+            now = loop.time()
+            while self._heap and self._heap[0][0] <= now:
+                _, recipient_id = heapq.heappop(self._heap)
+                del self._due[recipient_id]
+                self._last_sent[recipient_id] = now
+                runtime.spawn(self._deliver(recipient_id))
+            if len(self._last_sent) > self._prune_at:
+                # кто не получал уведомлений дольше окна, получит сразу
+                self._last_sent = {
+                    key: value for key, value in self._last_sent.items()
+                    if now - value < self._window}
+                self._prune_at = max(1000, len(self._last_sent) * 2)
+            timeout = self._heap[0][0] - now if self._heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _deliver(self, recipient_id: int) -> None:
+        runtime = self._runtime
+        try:
+            claimed_at, invites = await runtime.run_sync(
+                claim_pending, recipient_id, self._lease)
+        except Exception:
+            logger.exception(f'Error while claiming invites to {recipient_id}')
+            return
+        if not invites:
+            return
+        try:
+            await runtime.outbox.sendMessage(
+                recipient_id, compose_notification(invites, self._limit))
+        except Exception as e:
+            self.failed += 1
+            if isinstance(e, TelegramError) and e.retry_after is None:
+                # заблокировал бота и т.п. - повтор не поможет
+                logger.debug(f'Invite notification to {recipient_id} '
+                             f'failed: {e.description}')
+                await self._finish(mark_delivered, recipient_id, claimed_at)
+                return
+            # сетевые ошибки и 429 диспетчер уже повторил: возвращаем
+            # приглашения и пробуем снова не раньше чем через окно
+            logger.exception(f'Invite notification to {recipient_id} failed')
+            if await self._finish(release_claim, recipient_id, claimed_at):
+                self.schedule(runtime, recipient_id)
+            return
+        # если не отметится, через lease уведомление уйдет повторно
+        await self._finish(mark_delivered, recipient_id, claimed_at)
+        self.notifications += 1
+        self.delivered += len(invites)
+
+    async def _finish(self, fn, recipient_id: int, claimed_at) -> bool:
+        try:
+            await self._runtime.run_sync(fn, recipient_id, claimed_at)
+        except Exception:
+            logger.exception(f'Error while updating invites to {recipient_id}')
+            return False
+        return True
+
+    def gauges(self) -> dict:
+        return {'invites_scheduled': len(self._due),
+                'invites_scheduled_total': self.scheduled,
+                'invites_coalesced_total': self.coalesced,
+                'invites_delivered_total': self.delivered,
+                'invite_notifications_total': self.notifications,
+                'invite_notifications_failed_total': self.failed}
+
+
+invite_delivery = InviteDelivery()
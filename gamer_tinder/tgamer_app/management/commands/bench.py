@@ -0,0 +1,75 @@
+import json
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from tgamer_app.bench import ColdStartBenchmark, LoadBenchmark, \
+    RankingBenchmark, SessionMemoryBenchmark
+
+
+class Command(BaseCommand):
+    help = ('Drives synthetic chats through the bot against a local fake '
+            'Telegram API and reports throughput and resource usage')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', choices=('webhook', 'polling',
+                                               'ranking', 'coldstart',
+                                               'sessions'),
+                            default='webhook',
+                            help='ranking measures the search ranking alone, '
+                                 'without the bot and the database; '
+                                 'coldstart - startup of fresh processes; '
+                                 'sessions - memory of idle chat sessions')
+        parser.add_argument('--chats', type=int, default=100,
+                            help='concurrent synthetic chats')
+        parser.add_argument('--players', type=int, default=1000,
+                            help='candidates created for the search')
+        parser.add_argument('--nexts', type=int, default=10,
+                            help='/next commands sent by every chat')
+        parser.add_argument('--clients', type=int, default=8,
+                            help='threads posting to the webhook view')
+        parser.add_argument('--port', type=int, default=8765,
+                            help='port of the fake Telegram API')
+        parser.add_argument('--rate-limits', action='store_true',
+                            help='keep the outbound and inbound rate limits '
+                                 'from settings')
+        parser.add_argument('--retries', type=float, default=0.0,
+                            help='webhook mode: share of updates delivered '
+                                 'twice')
+        parser.add_argument('--keep', action='store_true',
+                            help='do not delete the synthetic players (the '
+                                 'next run then needs a fresh database)')
+        parser.add_argument('--requests', type=int, default=10000,
+                            help='ranking mode: pages and events measured')
+        parser.add_argument('--sessions', type=int, default=100000,
+                            help='sessions mode: chat sessions opened')
+        parser.add_argument('--runs', type=int, default=5,
+                            help='coldstart mode: processes started')
+        parser.add_argument('--json', action='store_true',
+                            help='print the report as JSON')
+
+    def handle(self, *args, **options):
+        if options['mode'] == 'sessions':
+            report = SessionMemoryBenchmark(
+                options['sessions'],
+                page_size=settings.TEAMMATES_PAGE_SIZE).run()
+        elif options['mode'] == 'coldstart':
+            report = ColdStartBenchmark(options['runs']).run()
+        elif options['mode'] == 'ranking':
+            report = RankingBenchmark(
+                options['players'], page_size=settings.TEAMMATES_PAGE_SIZE,
+                requests=options['requests']).run()
+        else:
+            try:
+                report = LoadBenchmark(
+                    options['mode'], chats=options['chats'],
+                    players=options['players'], nexts=options['nexts'],
+                    clients=options['clients'], fake_port=options['port'],
+                    rate_limits=options['rate_limits'],
+                    keep=options['keep'],
+                    retries=options['retries']).run()
+            except ValueError as e:
+                raise CommandError(str(e))
+        if options['json']:
+            self.stdout.write(json.dumps(report))
+            return
+        for key, value in report.items():
+            self.stdout.write(f'{key}: {value}')
@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand, CommandError
+from tgamer_app.broadcast import run_broadcast
+from tgamer_app.models import Broadcast, Game
+
+
+class Command(BaseCommand):
+    help = ('Sends a message to all registered players (or the players of '
+            'one game), rate limited and resumable')
+
+    def add_arguments(self, parser):
+        parser.add_argument('text', nargs='?',
+                            help='text of a new broadcast')
+        parser.add_argument('--game', type=int,
+                            help='send only to the players of this game id')
+        parser.add_argument('--resume', type=int, metavar='ID',
+                            help='continue a pending or paused broadcast')
+        parser.add_argument('--force', action='store_true',
+                            help='with --resume: take over a broadcast '
+                                 'still marked as running, e.g. after a crash')
+        parser.add_argument('--rate', type=float,
+                            help='messages per second, default '
+                                 'BROADCAST_SEND_RATE, at most '
+                                 'TELEGRAM_SEND_RATE_LIMIT - '
+                                 'BOT_SEND_RATE_GLOBAL')
+        parser.add_argument('--chunk-size', type=int,
+                            help='recipients per chunk, default '
+                                 'BROADCAST_CHUNK_SIZE')
+
+    def handle(self, *args, **options):
+        if options['resume'] is not None:
+            broadcast_id = options['resume']
+        elif options['text']:
+            game = None
+            if options['game'] is not None:
+                game = Game.objects.filter(pk=options['game']).first()
+                if game is None:
+                    raise CommandError(f'Unknown game {options["game"]}')
+            broadcast_id = Broadcast.objects.create(
+                text=options['text'], game=game).pk
+            self.stdout.write(f'Created broadcast {broadcast_id}')
+        else:
+            raise CommandError('Pass the text of a new broadcast or --resume')
+
+        def on_progress(report):
+            self.stdout.write(
+                f'{report["done"]}/{report["total"]} '
+                f'(failed {report["failed"]}), {report["rate"]} msg/s, '
+                f'eta {report["eta_s"]} s')
+
+        try:
+            report = run_broadcast(
+                broadcast_id, force=options['force'], rate=options['rate'],
+                chunk_size=options['chunk_size'], on_progress=on_progress)
+        except ValueError as e:
+            raise CommandError(str(e))
+        except KeyboardInterrupt:
+            self.stdout.write(f'Paused, continue with --resume {broadcast_id}')
+            return
+        self.stdout.write(f'Done: {report}')
@@ -0,0 +1,34 @@
+import sys
+from django.core.management.base import BaseCommand
+from tgamer_app.transfer import FORMATS, GAME_FIELDS, PLAYER_FIELDS, \
+    RecordWriter, export_games, export_players, guess_format
+
+EXPORTERS = {'players': (export_players, PLAYER_FIELDS),
+             'games': (export_games, GAME_FIELDS)}
+
+
+class Command(BaseCommand):
+    help = 'Streams players or games from the database to JSONL/CSV'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', choices=tuple(EXPORTERS))
+        parser.add_argument('path', nargs='?', default='-',
+                            help='output file, - for stdout')
+        parser.add_argument('--format', choices=FORMATS,
+                            help='default: guessed from the file extension, '
+                                 'jsonl for stdout')
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help='rows fetched from the database at once')
+
+    def handle(self, *args, **options):
+        export, fields = EXPORTERS[options['model']]
+        path = options['path']
+        fmt = options['format'] or guess_format(path)
+        if path == '-':
+            count = export(RecordWriter(sys.stdout, fmt, fields), fmt,
+                           options['chunk_size'])
+        else:
+            with open(path, 'w', newline='', encoding='utf-8') as stream:
+                count = export(RecordWriter(stream, fmt, fields), fmt,
+                               options['chunk_size'])
+        self.stderr.write(f'Exported {count} {options["model"]}')
@@ -0,0 +1,35 @@
+import asyncio
+from django.core.management.base import BaseCommand
+from tgamer_app.fake_telegram import start_fake_telegram
+
+
+class Command(BaseCommand):
+    help = 'Runs a local stand-in for the Telegram Bot API'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8081)
+        parser.add_argument('--latency', type=float, default=0.0,
+                            help='delay of every answer, seconds')
+        parser.add_argument('--chat-rate', type=float, default=None,
+                            help='messages per second allowed per chat')
+        parser.add_argument('--global-rate', type=float, default=None,
+                            help='messages per second allowed in total')
+
+    def handle(self, *args, **options):
+        asyncio.run(self.serve(options))
+
+    async def serve(self, options):
+        fake, runner = await start_fake_telegram(
+            options['host'], options['port'], latency=options['latency'],
+            chat_rate=options['chat_rate'],
+            global_rate=options['global_rate'])
+        self.stdout.write(f'Fake Telegram API on '
+                          f'http://{options["host"]}:{options["port"]}')
+        try:
+            while True:
+                await asyncio.sleep(10)
+                self.stdout.write(f'calls: {len(fake.calls)}, '
+                                  f'throttled: {fake.throttled}')
+        finally:
+            await runner.cleanup()
@@ -0,0 +1,50 @@
+import sys
+import time
+from django.core.management.base import BaseCommand, CommandError
+from tgamer_app.transfer import FORMATS, GameImporter, PlayerImporter, \
+    guess_format, read_records, synthetic_players
+
+IMPORTERS = {'players': PlayerImporter, 'games': GameImporter}
+
+
+class Command(BaseCommand):
+    help = ('Streams players or games from a JSONL/CSV file into the '
+            'database, updating existing rows (upsert) in batches')
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', choices=tuple(IMPORTERS))
+        parser.add_argument('path', nargs='?', default='-',
+                            help='input file, - for stdin')
+        parser.add_argument('--format', choices=FORMATS,
+                            help='default: guessed from the file extension, '
+                                 'jsonl for stdin')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--synthetic', type=int, metavar='N',
+                            help='players: instead of reading a file, load '
+                                 'N synthetic players (the manage.py bench '
+                                 'tg_id range)')
+        parser.add_argument('--game', type=int,
+                            help='with --synthetic: game of the players')
+
+    def handle(self, *args, **options):
+        importer = IMPORTERS[options['model']](options['batch_size'])
+        started = time.perf_counter()
+        if options['synthetic'] is not None:
+            if options['model'] != 'players':
+                raise CommandError('--synthetic only works for players')
+            report = importer.run(synthetic_players(options['synthetic'],
+                                                    options['game']))
+        else:
+            path = options['path']
+            fmt = options['format'] or guess_format(path)
+            if path == '-':
+                report = importer.run(read_records(sys.stdin, fmt))
+            else:
+                with open(path, newline='', encoding='utf-8') as stream:
+                    report = importer.run(read_records(stream, fmt))
+        elapsed = time.perf_counter() - started
+        done = report['created'] + report['updated']
+        self.stdout.write(
+            f'{options["model"]}: created {report["created"]}, '
+            f'updated {report["updated"]}, skipped {report["errors"]} '
+            f'in {elapsed:.1f} s ({done / elapsed if elapsed else 0:.0f}/s)')
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from tgamer_app.models import Game
+from tgamer_app.posters import make_thumbnail
+
+
+class Command(BaseCommand):
+    help = ('Makes poster thumbnails for games that have none, e.g. after '
+            'import_data games (bulk imports skip the signals that do it)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='remake thumbnails of every game')
+
+    def handle(self, *args, **options):
+        games = Game.objects.exclude(poster='')
+        if not options['all']:
+            games = games.filter(thumbnail='')
+        made = 0
+        for game_id in games.values_list('pk', flat=True):
+            try:
+                made += make_thumbnail(game_id)
+            except OSError as e:
+                self.stderr.write(f'Game {game_id}: {e}')
+        self.stdout.write(f'Made {made} thumbnails')
@@ -1,9 +1,14 @@
 from django.core.management.base import BaseCommand
-from tgamer_app.gamer_bot import run_as_polling
+from tgamer_app.bot_app import bot_app
 
 
 class Command(BaseCommand):
     help = 'Runs the bot!'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--drop-webhook', action='store_true',
+                            help='delete the webhook first, Telegram does '
+                                 'not give updates to polling while it is set')
+
     def handle(self, *args, **options):
-        run_as_polling()
+        bot_app.run_polling(drop_webhook=options['drop_webhook'])
@@ -0,0 +1,44 @@
+import asyncio
+import multiprocessing
+import time
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from loguru import logger
+
+
+def worker_main(idx: int) -> None:
+    django.setup()
+    from tgamer_app.cluster import serve_worker
+    from tgamer_app.gamer_bot import GamerBot
+    from tgamer_app.writeback import refresh_game_index
+    asyncio.run(serve_worker(idx, GamerBot, refresh_game_index))
+
+
+class Command(BaseCommand):
+    help = 'Runs bot worker processes for the multi-process webhook mode'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int,
+                            default=settings.BOT_WORKER_PROCESSES,
+                            help='number of worker processes')
+
+    def handle(self, *args, **options):
+        count = options['workers']
+        if count < 1:
+            self.stderr.write('Set --workers or BOT_WORKER_PROCESSES')
+            return
+        ctx = multiprocessing.get_context('spawn')
+        procs = {}
+        while True:
+            for idx in range(count):
+                proc = procs.get(idx)
+                if proc is None or not proc.is_alive():
+                    if proc is not None:
+                        logger.warning(f'Worker {idx} exited with '
+                                       f'{proc.exitcode}, restarting')
+                    proc = ctx.Process(target=worker_main, args=(idx,),
+                                       name=f'bot-worker-{idx}', daemon=True)
+                    proc.start()
+                    procs[idx] = proc
+            time.sleep(1)
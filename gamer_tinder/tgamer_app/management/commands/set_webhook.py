@@ -0,0 +1,40 @@
+import asyncio
+import aiohttp
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from tgamer_app.api import TelegramError
+from tgamer_app.bot_app import bot_app, webhook_url
+
+
+class Command(BaseCommand):
+    help = ('Registers the bot webhook with Telegram (BOT_WEBHOOK_URL by '
+            'default), deletes it or shows its status')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help='webhook URL, default '
+                                          'BOT_WEBHOOK_URL')
+        parser.add_argument('--delete', action='store_true',
+                            help='delete the webhook, e.g. before run_bot')
+        parser.add_argument('--info', action='store_true',
+                            help='only show the current webhook status')
+
+    def handle(self, *args, **options):
+        try:
+            if options['info']:
+                info = bot_app.get_webhook_info()
+                for key, value in info.items():
+                    self.stdout.write(f'{key}: {value}')
+                return
+            if options['delete']:
+                bot_app.delete_webhook()
+                self.stdout.write('Webhook deleted')
+                return
+            url = options['url'] or webhook_url()
+            bot_app.set_webhook(url)
+        except TelegramError as e:
+            raise CommandError(e.description)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise CommandError(f'Telegram is unreachable: {e}')
+        # the URL contains the bot token, keep it out of the output
+        self.stdout.write('Webhook set to ' + url.replace(
+            settings.TELEGRAM_TOKEN, '<token>'))
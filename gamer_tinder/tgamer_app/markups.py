@@ -1,5 +1,11 @@
+import json
+import threading
+import time
+from django.conf import settings
+from django.db.models import Count, Max
 from telepot.namedtuple import InlineKeyboardMarkup, InlineKeyboardButton, \
      ReplyKeyboardMarkup, KeyboardButton
+from .api import jsonable
 from .models import Game
 
 
@@ -20,29 +26,154 @@ def build_keyboard(buttons: list, per_line: int) -> list:
     return res
 
 
-# markup for registration start keyboard
-reg_button = KeyboardButton(text='/registration')
-reg_markup = ReplyKeyboardMarkup(keyboard=[[reg_button]])
+# callback_data of inline buttons: a one-letter action and, for the
+# teammate card, "<search id>:<candidate tg_id>" - Telegram allows 64 bytes
+CALLBACK_NEXT = 'n'
+CALLBACK_INVITE = 'i'
+CALLBACK_REGISTRATION = 'r'
 
 # inline markup for registration start keyboard
 
 inline_reg_button = InlineKeyboardButton(text='registration',
-                                         callback_data='registration')
+                                         callback_data=CALLBACK_REGISTRATION)
 inline_reg_markup = InlineKeyboardMarkup(inline_keyboard=[[inline_reg_button]])
 
 # markup for selecting favourite game keyboard
-games = [(game.id, game.title) for game in Game.objects.all()]
-games_keyboard = build_keyboard([KeyboardButton(text=f'{game[0]} {game[1]}')
-                                for game in games], 3)
-games_markup = ReplyKeyboardMarkup(keyboard=games_keyboard)
-
-# markups for the search function
-teammate_markup = ReplyKeyboardMarkup(
-    keyboard=[[KeyboardButton(text='/next'), KeyboardButton(text='/invite')]]
-                                      )
-inline_teammate_markup = InlineKeyboardMarkup(
-    inline_keyboard=[
-        [InlineKeyboardButton(text='/next', callback_data='next'),
-         InlineKeyboardButton(text='/invite', callback_data='invite')]
-        ]
-            )
+GAMES_PAGE_COMMAND = '/games'
+# search button for players who play every game of the searching player
+ALL_MY_GAMES = 'Все мои игры'
+
+
+class GamesCatalogue:
+    '''
+    Lazily built cache of games and of the keyboards to pick one.
+    Games are usually edited in the admin, in another process, so
+    every check_interval seconds the catalogue compares a stamp of the
+    table (count, max id, max updated_at) with the one it was built
+    from. Game signals bump the local version to rebuild at once in
+    the process that saved the game. The catalogue is rebuilt (and
+    every keyboard page serialised to JSON) once per change.
+    Search keyboards are the same pages with an extra ALL_MY_GAMES row.
+    '''
+    def __init__(self, per_line: int, page_size: int,
+                 check_interval: float = 10):
+        self._per_line = per_line
+        self._page_size = page_size
+        self._check_interval = check_interval
+        self._version = 0
+        self._built_version = None
+        self._built_stamp = None
+        self._checked_at = None
+        self._games = {}
+        self._pages = []
+        self._search_pages = []
+        self._page_games = []
+        self._lock = threading.Lock()
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._version += 1
+
+    def _build(self) -> None:
+        games = list(Game.objects.order_by('id'))
+        chunks = [games[i:i + self._page_size]
+                  for i in range(0, len(games), self._page_size)] or [[]]
+        pages = []
+        search_pages = []
+        for idx, chunk in enumerate(chunks):
+            keyboard = build_keyboard(
+                [KeyboardButton(text=f'{game.id} {game.title}')
+                 for game in chunk], self._per_line)
+            nav = []
+            if idx > 0:
+                nav.append(KeyboardButton(text=f'{GAMES_PAGE_COMMAND} {idx}'))
+            if idx < len(chunks) - 1:
+                nav.append(
+                    KeyboardButton(text=f'{GAMES_PAGE_COMMAND} {idx + 2}'))
+            if nav:
+                keyboard.append(nav)
+            pages.append(self._serialise(keyboard))
+            # the search keyboard hides after the choice, results come
+            # with inline buttons
+            search_pages.append(self._serialise(
+                [[KeyboardButton(text=ALL_MY_GAMES)]] + keyboard,
+                one_time=True))
+        self._games = {game.id: game for game in games}
+        self._pages = pages
+        self._search_pages = search_pages
+        self._page_games = chunks
+
+    @staticmethod
+    def _serialise(keyboard: list, one_time: bool = False) -> str:
+        markup = ReplyKeyboardMarkup(keyboard=keyboard,
+                                     one_time_keyboard=one_time or None)
+        return json.dumps(jsonable(markup), separators=(',', ':'))
+
+    @staticmethod
+    def _stamp() -> tuple:
+        stamp = Game.objects.aggregate(count=Count('id'), last_id=Max('id'),
+                                       updated=Max('updated_at'))
+        return stamp['count'], stamp['last_id'], stamp['updated']
+
+    def _ensure_built(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if (self._built_version == self._version
+                    and self._checked_at is not None
+                    and now - self._checked_at < self._check_interval):
+                return
+            version = self._version
+            stamp = self._stamp()
+            self._checked_at = now
+            if version != self._built_version or stamp != self._built_stamp:
+                self._build()
+                self._built_stamp = stamp
+            self._built_version = version
+
+    def get_markup(self, page: int = 1, search: bool = False) -> str:
+        '''
+        returns the serialised keyboard for the page (1-based),
+        clamped to the existing pages
+        '''
+        self._ensure_built()
+        pages = self._search_pages if search else self._pages
+        page = min(max(page, 1), len(pages))
+        return pages[page - 1]
+
+    def get_page_games(self, page: int = 1) -> list:
+        '''games shown on the keyboard page (1-based)'''
+        self._ensure_built()
+        page = min(max(page, 1), len(self._page_games))
+        return self._page_games[page - 1]
+
+    def get_game(self, game_id: int):
+        self._ensure_built()
+        return self._games.get(game_id)
+
+
+games_catalogue = GamesCatalogue(
+    per_line=3, page_size=settings.GAMES_PAGE_SIZE,
+    check_interval=settings.GAMES_CATALOGUE_CHECK)
+
+
+def player_games_markup(games: list) -> ReplyKeyboardMarkup:
+    '''keyboard with the player's own games, e.g. to remove one'''
+    return ReplyKeyboardMarkup(keyboard=build_keyboard(
+        [KeyboardButton(text=f'{game.id} {game.title}') for game in games],
+        per_line=3))
+
+
+# inline markup for the search function
+def inline_teammate_markup(search_id: int,
+                           tg_id: int) -> InlineKeyboardMarkup:
+    '''
+    inline buttons under a teammate card, the callback data points
+    at the card's search and candidate so stale cards can be told apart
+    '''
+    cursor = f'{search_id}:{tg_id}'
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text='/next',
+                              callback_data=f'{CALLBACK_NEXT}:{cursor}'),
+         InlineKeyboardButton(text='/invite',
+                              callback_data=f'{CALLBACK_INVITE}:{cursor}')]
+    ])
@@ -0,0 +1,340 @@
+'''
+Индекс для поиска тиммейтов в памяти процесса: для каждой игры
+игроки с включенным поиском, упорядоченные по рейтингу.
+'''
+import bisect
+import heapq
+import threading
+import time
+from django.conf import settings
+from .models import Game, Player, PlayerGame
+
+
+def parse_genres(genre: str) -> frozenset:
+    '''Жанры игры через запятую -> множество'''
+    return frozenset(filter(None, (name.strip().lower()
+                                   for name in genre.split(','))))
+
+
+class PlayerStats:
+    '''Счетчики активности игрока, из которых считается его рейтинг'''
+    __slots__ = ('last_active', 'shown', 'received', 'answered', 'awaiting')
+
+    def __init__(self, last_active: float, shown: int = 0, received: int = 0,
+                 answered: int = 0, awaiting: bool = False):
+        self.last_active = last_active
+        self.shown = shown
+        self.received = received
+        self.answered = answered
+        self.awaiting = awaiting
+
+    def score(self) -> float:
+        '''
+        Рейтинг не зависит от текущего времени: давность активности
+        входит в него как last_active / RANK_RECENCY_SCALE, поэтому
+        у неактивного игрока он не меняется, а у остальных растет,
+        и пересчитывать всех по таймеру не нужно.
+        '''
+        acceptance = (self.answered + 1) / (self.received + 2)
+        return (self.last_active / settings.RANK_RECENCY_SCALE
+                + settings.RANK_ACCEPT_WEIGHT * acceptance
+                - settings.RANK_SHOWN_PENALTY * self.shown)
+
+
+class Ranking:
+    '''
+    Игроки одной игры, отсортированные по убыванию рейтинга.
+    Ключи хранятся со знаком минус в параллельном списке, так что
+    вставка и удаление - bisect и сдвиг списка, а top-k - срез.
+    '''
+    def __init__(self):
+        self._keys = []
+        self._ids = []
+        self._members = set()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __contains__(self, tg_id: int) -> bool:
+        return tg_id in self._members
+
+    @classmethod
+    def build(cls, scored: list) -> 'Ranking':
+        '''Строит рейтинг сразу из пар (score, tg_id)'''
+        ranking = cls()
+        scored.sort(key=lambda item: -item[0])
+        ranking._keys = [-score for score, _ in scored]
+        ranking._ids = [tg_id for _, tg_id in scored]
+        ranking._members = set(ranking._ids)
+        return ranking
+
+    def insert(self, tg_id: int, score: float) -> None:
+        pos = bisect.bisect_right(self._keys, -score)
+        self._keys.insert(pos, -score)
+        self._ids.insert(pos, tg_id)
+        self._members.add(tg_id)
+
+    def remove(self, tg_id: int, score: float) -> None:
+        pos = bisect.bisect_left(self._keys, -score)
+        while self._ids[pos] != tg_id:
+            pos += 1
+        del self._keys[pos]
+        del self._ids[pos]
+        self._members.discard(tg_id)
+
+    def top(self, k: int, exclude=frozenset(), within=()) -> list:
+        '''
+        До k лучших tg_id, не входящих в exclude и входящих
+        во все рейтинги within
+        '''
+        res = []
+        for tg_id in self._ids:
+            if tg_id in exclude:
+                continue
+            if all(tg_id in other for other in within):
+                res.append(tg_id)
+                if len(res) == k:
+                    break
+        return res
+
+
+class GameIndex:
+    '''
+    Инвертированный индекс игра -> рейтинг ее игроков с включенным
+    поиском. Игрок с несколькими играми стоит в рейтинге каждой
+    с одним и тем же рейтингом. Рейтинг пересчитывается только
+    у того, с кем что-то произошло (написал боту, его показали, его
+    пригласили), поэтому выдача лучших кандидатов не требует запросов
+    к БД и не зависит от размера пула.
+    '''
+    def __init__(self):
+        self._rankings = {}
+        self._games = {}
+        self._scores = {}
+        self._stats = {}
+        self._genres = {}
+        self._lock = threading.Lock()
+        self.is_warm = False
+
+    def warm(self) -> None:
+        '''Заполняет индекс из БД, вызывается при старте бота'''
+        rows = Player.objects.filter(
+            search_enabled=True,
+            sign_up=Player.RegistrationSteps.DONE).values_list(
+            'tg_id', 'activity__last_active_at',
+            'activity__times_shown', 'activity__invites_received',
+            'activity__invites_answered', 'activity__awaiting_reply',
+        ).iterator()
+        links = PlayerGame.objects.filter(
+            player__search_enabled=True,
+            player__sign_up=Player.RegistrationSteps.DONE).values_list(
+            'player_id', 'game_id').iterator()
+        # строим новый индекс рядом и подменяем, чтобы не держать
+        # блокировку, пока читаем таблицы
+        fresh = GameIndex()
+        genres = {game_id: parse_genres(genre) for game_id, genre
+                  in Game.objects.values_list('id', 'genre')}
+        now = time.time()
+        stats = {}
+        for (tg_id, last_active, shown, received,
+             answered, awaiting) in rows:
+            if last_active is None:
+                stats[tg_id] = PlayerStats(now)
+            else:
+                stats[tg_id] = PlayerStats(last_active.timestamp(), shown,
+                                           received, answered, awaiting)
+        games = {}
+        for tg_id, game_id in links:
+            if tg_id in stats:
+                games.setdefault(tg_id, set()).add(game_id)
+        fresh.load([(tg_id, player_games, stats[tg_id])
+                    for tg_id, player_games in games.items()], genres)
+        with self._lock:
+            self._rankings = fresh._rankings
+            self._games = fresh._games
+            self._scores = fresh._scores
+            self._stats = fresh._stats
+            self._genres = fresh._genres
+            self.is_warm = True
+
+    def load(self, players: list, genres: dict) -> None:
+        '''
+        Заполняет пустой индекс тройками (tg_id, id игр, PlayerStats),
+        сортируя каждую игру один раз, а не вставляя по одному
+        '''
+        scored = {}
+        for tg_id, game_ids, stats in players:
+            score = self._scores[tg_id] = stats.score()
+            self._stats[tg_id] = stats
+            self._games[tg_id] = set(game_ids)
+            for game_id in game_ids:
+                scored.setdefault(game_id, []).append((score, tg_id))
+        self._rankings = {game_id: Ranking.build(items)
+                          for game_id, items in scored.items()}
+        self._genres = genres
+
+    def _add(self, tg_id: int, game_ids) -> None:
+        stats = self._stats.get(tg_id)
+        if stats is None:
+            # только что включил поиск - значит, только что был активен
+            stats = self._stats[tg_id] = PlayerStats(time.time())
+        score = self._scores[tg_id] = stats.score()
+        self._games[tg_id] = set()
+        for game_id in game_ids:
+            self._add_game(tg_id, game_id, score)
+
+    def _add_game(self, tg_id: int, game_id: int, score: float) -> None:
+        ranking = self._rankings.get(game_id)
+        if ranking is None:
+            ranking = self._rankings[game_id] = Ranking()
+        ranking.insert(tg_id, score)
+        self._games[tg_id].add(game_id)
+
+    def _remove(self, tg_id: int) -> None:
+        game_ids = self._games.pop(tg_id, None)
+        if game_ids is None:
+            return
+        score = self._scores.pop(tg_id)
+        for game_id in game_ids:
+            self._rankings[game_id].remove(tg_id, score)
+
+    def _rescore(self, tg_id: int) -> None:
+        game_ids = self._games.get(tg_id)
+        if game_ids is None:
+            return
+        old = self._scores[tg_id]
+        score = self._scores[tg_id] = self._stats[tg_id].score()
+        for game_id in game_ids:
+            ranking = self._rankings[game_id]
+            ranking.remove(tg_id, old)
+            ranking.insert(tg_id, score)
+
+    def update(self, tg_id: int, search_enabled: bool) -> None:
+        '''
+        Синхронизирует запись игрока с тем, виден ли он в поиске
+        (Player.is_searchable).
+        Список игр игрока читается из БД, только когда игрок
+        попадает в индекс.
+        '''
+        if search_enabled == (tg_id in self._games):
+            return
+        if not search_enabled:
+            self.remove(tg_id)
+            return
+        game_ids = PlayerGame.objects.filter(player_id=tg_id).values_list(
+            'game_id', flat=True)
+        with self._lock:
+            if tg_id not in self._games:
+                self._add(tg_id, game_ids)
+
+    def add_game(self, tg_id: int, game_id: int) -> None:
+        '''Игрок с включенным поиском добавил игру'''
+        with self._lock:
+            game_ids = self._games.get(tg_id)
+            if game_ids is not None and game_id not in game_ids:
+                self._add_game(tg_id, game_id, self._scores[tg_id])
+
+    def remove_game(self, tg_id: int, game_id: int) -> None:
+        with self._lock:
+            game_ids = self._games.get(tg_id)
+            if game_ids is not None and game_id in game_ids:
+                game_ids.discard(game_id)
+                self._rankings[game_id].remove(tg_id, self._scores[tg_id])
+
+    def remove(self, tg_id: int) -> None:
+        with self._lock:
+            self._remove(tg_id)
+            self._stats.pop(tg_id, None)
+
+    def games_of(self, tg_id: int) -> set:
+        '''Игры игрока, если он есть в индексе'''
+        return set(self._games.get(tg_id, ()))
+
+    def set_genres(self, game_id: int, genre: str = None) -> None:
+        '''Обновляет жанры игры, genre=None - игру удалили'''
+        with self._lock:
+            if genre is None:
+                self._genres.pop(game_id, None)
+            else:
+                self._genres[game_id] = parse_genres(genre)
+
+    def record_active(self, tg_id: int, now: float = None) -> None:
+        '''Игрок написал боту: отвечает на приглашение, если его ждут'''
+        with self._lock:
+            stats = self._stats.get(tg_id)
+            if stats is None:
+                return
+            now = now or time.time()
+            if (now - stats.last_active < settings.RANK_ACTIVITY_RESOLUTION
+                    and not stats.shown and not stats.awaiting):
+                return
+            if stats.awaiting:
+                stats.answered += 1
+                stats.awaiting = False
+            stats.last_active = now
+            stats.shown = 0
+            self._rescore(tg_id)
+
+    def record_shown(self, tg_id: int) -> None:
+        with self._lock:
+            stats = self._stats.get(tg_id)
+            if stats is not None:
+                stats.shown += 1
+                self._rescore(tg_id)
+
+    def record_invite(self, tg_id: int) -> None:
+        with self._lock:
+            stats = self._stats.get(tg_id)
+            if stats is not None:
+                stats.received += 1
+                stats.awaiting = True
+                self._rescore(tg_id)
+
+    def size(self, game_id: int) -> int:
+        return len(self._rankings.get(game_id, ()))
+
+    def _genres_of(self, game_ids) -> frozenset:
+        return frozenset().union(*(self._genres.get(game_id, ())
+                                   for game_id in game_ids))
+
+    def top(self, game_ids: list, k: int, exclude=frozenset(),
+            viewer_games=()) -> list:
+        '''
+        Возвращает до k лучших tg_id игроков, у которых есть все игры
+        game_ids и которые не входят в exclude. Пересечение не строится
+        целиком: идем по рейтингу самой маленькой игры и проверяем,
+        есть ли игрок в остальных. Если переданы игры ищущего,
+        кандидаты из окна лучших по рейтингу переупорядочиваются
+        с учетом общих с ними жанров.
+        '''
+        with self._lock:
+            rankings = [self._rankings.get(game_id) for game_id in game_ids]
+            if not rankings or not all(rankings):
+                return []
+            rankings.sort(key=len)
+            smallest, others = rankings[0], rankings[1:]
+            viewer_genres = self._genres_of(viewer_games)
+            if not viewer_genres:
+                return smallest.top(k, exclude, others)
+            window = smallest.top(k * settings.RANK_GENRE_WINDOW, exclude,
+                                  others)
+            bonus = settings.RANK_GENRE_WEIGHT / len(viewer_genres)
+            # общие жанры считаются по игре один раз на запрос
+            shared = {}
+
+            def key(tg_id):
+                common = set()
+                for game_id in self._games[tg_id]:
+                    game_shared = shared.get(game_id)
+                    if game_shared is None:
+                        game_shared = shared[game_id] = (
+                            viewer_genres & self._genres.get(game_id, set()))
+                    common |= game_shared
+                return self._scores[tg_id] + bonus * len(common)
+            return heapq.nlargest(k, window, key=key)
+
+
+game_index = GameIndex()
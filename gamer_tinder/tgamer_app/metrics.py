@@ -0,0 +1,192 @@
+'''
+Метрики бота в текстовом формате Prometheus: задержки команд,
+запросы к БД на апдейт, время вызовов Bot API и состояние рантайма.
+Все счетчики живут в памяти процесса и стоят пару операций
+на событие, так что их можно не выключать в проде.
+'''
+import bisect
+import contextvars
+import threading
+import time
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34)
+
+
+class Histogram:
+    '''Гистограмма с фиксированными корзинами, как в Prometheus'''
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self._counts[bisect.bisect_left(self._buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> list:
+        '''Пары (верхняя граница, число значений не больше нее)'''
+        res = []
+        total = 0
+        for bound, count in zip(self._buckets + ('+Inf',), self._counts):
+            total += count
+            res.append((bound, total))
+        return res
+
+
+class UpdateStats:
+    '''Что накопилось за обработку одного апдейта'''
+    __slots__ = ('command', 'queries', 'db_time', 'send_time')
+
+    def __init__(self):
+        self.command = 'other'
+        self.queries = 0
+        self.db_time = 0.0
+        self.send_time = 0.0
+
+
+# апдейт, который сейчас обрабатывается; рантайм копирует контекст
+# в пул потоков БД, поэтому запросы оттуда тоже попадают в него
+_current_update = contextvars.ContextVar('current_update', default=None)
+
+
+class BotMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._commands = {}
+        self._command_queries = {}
+        self._command_send = {}
+        self._api = {}
+        self._api_errors = {}
+        self._db = Histogram()
+        self._collectors = {}
+        self._installed = False
+
+    def install(self) -> None:
+        '''Начинает считать запросы всех соединений с БД'''
+        if self._installed:
+            return
+        self._installed = True
+        for connection in connections.all():
+            self._on_connection(None, connection)
+        connection_created.connect(self._on_connection, weak=False)
+
+    def _on_connection(self, sender, connection, **kwargs) -> None:
+        if self._execute not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self._execute)
+
+    def _execute(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            stats = _current_update.get()
+            if stats is not None:
+                stats.queries += 1
+                stats.db_time += elapsed
+            with self._lock:
+                self._db.observe(elapsed)
+
+    def start_update(self) -> contextvars.Token:
+        return _current_update.set(UpdateStats())
+
+    def finish_update(self, token: contextvars.Token, elapsed: float) -> None:
+        stats = _current_update.get()
+        _current_update.reset(token)
+        command = stats.command
+        with self._lock:
+            if command not in self._commands:
+                self._commands[command] = Histogram()
+                self._command_queries[command] = Histogram(QUERY_BUCKETS)
+                self._command_send[command] = Histogram()
+            self._commands[command].observe(elapsed)
+            self._command_queries[command].observe(stats.queries)
+            self._command_send[command].observe(stats.send_time)
+
+    def set_command(self, command: str) -> None:
+        '''
+        Помечает текущий апдейт командой. Метка должна браться
+        из конечного набора, а не из произвольного текста.
+        '''
+        stats = _current_update.get()
+        if stats is not None:
+            stats.command = command
+
+    def observe_api(self, method: str, elapsed: float, ok: bool) -> None:
+        stats = _current_update.get()
+        if stats is not None:
+            stats.send_time += elapsed
+        with self._lock:
+            histogram = self._api.get(method)
+            if histogram is None:
+                histogram = self._api[method] = Histogram()
+            histogram.observe(elapsed)
+            if not ok:
+                self._api_errors[method] = self._api_errors.get(method, 0) + 1
+
+    def register(self, name: str, collector) -> None:
+        '''
+        collector - функция без аргументов, возвращающая словарь
+        {имя метрики: число}. Повторная регистрация под тем же
+        именем заменяет предыдущую.
+        '''
+        self._collectors[name] = collector
+
+    @staticmethod
+    def _histogram_lines(name: str, histogram: Histogram,
+                         labels: str = '') -> list:
+        sep = ',' if labels else ''
+        lines = [f'{name}_bucket{{{labels}{sep}le="{bound}"}} {count}'
+                 for bound, count in histogram.cumulative()]
+        suffix = f'{{{labels}}}' if labels else ''
+        lines.append(f'{name}_sum{suffix} {histogram.sum}')
+        lines.append(f'{name}_count{suffix} {histogram.count}')
+        return lines
+
+    def _labeled(self, name: str, help_text: str, histograms: dict,
+                 label: str) -> list:
+        lines = [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+        for value, histogram in sorted(histograms.items()):
+            lines += self._histogram_lines(name, histogram,
+                                           f'{label}="{value}"')
+        return lines
+
+    def render(self) -> str:
+        with self._lock:
+            lines = self._labeled(
+                'gamer_bot_update_seconds', 'Update handling time',
+                self._commands, 'command')
+            lines += self._labeled(
+                'gamer_bot_update_queries', 'DB queries per update',
+                self._command_queries, 'command')
+            lines += self._labeled(
+                'gamer_bot_update_send_seconds',
+                'Time spent in Bot API calls per update',
+                self._command_send, 'command')
+            lines += self._labeled(
+                'gamer_bot_api_seconds', 'Bot API call time',
+                self._api, 'method')
+            lines += ['# HELP gamer_bot_api_errors_total Failed Bot API calls',
+                      '# TYPE gamer_bot_api_errors_total counter']
+            lines += [f'gamer_bot_api_errors_total{{method="{method}"}} {count}'
+                      for method, count in sorted(self._api_errors.items())]
+            lines += ['# HELP gamer_bot_db_query_seconds DB query time',
+                      '# TYPE gamer_bot_db_query_seconds histogram']
+            lines += self._histogram_lines('gamer_bot_db_query_seconds',
+                                           self._db)
+        for collector in list(self._collectors.values()):
+            for name, value in collector().items():
+                kind = 'counter' if name.endswith('_total') else 'gauge'
+                lines += [f'# TYPE gamer_bot_{name} {kind}',
+                          f'gamer_bot_{name} {value}']
+        lines.append('# TYPE gamer_bot_threads gauge')
+        lines.append(f'gamer_bot_threads {threading.active_count()}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = BotMetrics()
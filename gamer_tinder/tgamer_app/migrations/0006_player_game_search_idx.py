@@ -0,0 +1,17 @@
+# Generated by Django 4.0.4 on 2026-10-18 16:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tgamer_app', '0005_alter_player_about'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='player',
+            index=models.Index(fields=['prefered_game', 'search_enabled', 'tg_id'], name='player_game_search_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.0.4 on 2026-10-18 16:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tgamer_app', '0006_player_game_search_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatState',
+            fields=[
+                ('tg_id', models.BigIntegerField(primary_key=True, serialize=False, verbose_name='Телеграм айди')),
+                ('data', models.JSONField(default=dict, verbose_name='Состояние')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Обновлено')),
+            ],
+            options={
+                'verbose_name': 'Состояние диалога',
+                'verbose_name_plural': 'Состояния диалогов',
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.0.4 on 2026-10-18 16:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tgamer_app', '0007_chatstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlayerActivity',
+            fields=[
+                ('player', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='activity', serialize=False, to='tgamer_app.player', verbose_name='Игрок')),
+                ('last_active_at', models.DateTimeField(null=True, verbose_name='Последняя активность')),
+                ('times_shown', models.PositiveIntegerField(default=0, verbose_name='Показов с последней активности')),
+                ('invites_received', models.PositiveIntegerField(default=0, verbose_name='Получено приглашений')),
+                ('invites_answered', models.PositiveIntegerField(default=0, verbose_name='Отвечено приглашений')),
+                ('awaiting_reply', models.BooleanField(default=False, verbose_name='Ждет ответа на приглашение')),
+            ],
+            options={
+                'verbose_name': 'Активность игрока',
+                'verbose_name_plural': 'Активность игроков',
+            },
+        ),
+    ]
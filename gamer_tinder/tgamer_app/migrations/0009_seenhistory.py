@@ -0,0 +1,28 @@
+# Generated by Django 4.0.4 on 2026-10-18 16:23
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tgamer_app', '0008_playeractivity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SeenHistory',
+            fields=[
+                ('player', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='seen_history', serialize=False, to='tgamer_app.player', verbose_name='Игрок')),
+                ('current', models.BinaryField(verbose_name='Текущий фильтр')),
+                ('previous', models.BinaryField(null=True, verbose_name='Предыдущий фильтр')),
+                ('count', models.PositiveIntegerField(default=0, verbose_name='Записей в текущем фильтре')),
+                ('rotated_at', models.DateTimeField(verbose_name='Начало текущего фильтра')),
+            ],
+            options={
+                'verbose_name': 'История просмотров',
+                'verbose_name_plural': 'Истории просмотров',
+            },
+        ),
+    ]
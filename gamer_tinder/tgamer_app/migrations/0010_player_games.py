@@ -0,0 +1,61 @@
+# Generated by Django 4.0.4 on 2026-10-18 16:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def copy_prefered_games(apps, schema_editor):
+    '''Любимая игра становится первой игрой в списке игрока'''
+    Player = apps.get_model('tgamer_app', 'Player')
+    PlayerGame = apps.get_model('tgamer_app', 'PlayerGame')
+    rows = Player.objects.filter(prefered_game__isnull=False).values_list(
+        'tg_id', 'prefered_game_id').iterator()
+    batch = []
+    for tg_id, game_id in rows:
+        batch.append(PlayerGame(player_id=tg_id, game_id=game_id))
+        if len(batch) >= 1000:
+            PlayerGame.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    PlayerGame.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tgamer_app', '0009_seenhistory'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlayerGame',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('skill', models.PositiveSmallIntegerField(blank=True, null=True, verbose_name='Уровень')),
+                ('role', models.CharField(blank=True, default='', max_length=50, verbose_name='Роль')),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='player_games', to='tgamer_app.game', verbose_name='Игра')),
+            ],
+            options={
+                'verbose_name': 'Игра игрока',
+                'verbose_name_plural': 'Игры игроков',
+            },
+        ),
+        migrations.AddField(
+            model_name='player',
+            name='games',
+            field=models.ManyToManyField(related_name='players', through='tgamer_app.PlayerGame', to='tgamer_app.game', verbose_name='Игры'),
+        ),
+        migrations.AddField(
+            model_name='playergame',
+            name='player',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='player_games', to='tgamer_app.player', verbose_name='Игрок'),
+        ),
+        migrations.AddIndex(
+            model_name='playergame',
+            index=models.Index(fields=['game', 'player'], name='player_game_game_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='playergame',
+            constraint=models.UniqueConstraint(fields=('player', 'game'), name='player_game_unique'),
+        ),
+        migrations.RunPython(copy_prefered_games, migrations.RunPython.noop),
+    ]
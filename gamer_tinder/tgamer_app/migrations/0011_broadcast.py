@@ -0,0 +1,34 @@
+# Generated by Django 4.0.4 on 2026-10-18 16:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tgamer_app', '0010_player_games'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Broadcast',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('text', models.TextField(verbose_name='Текст')),
+                ('status', models.CharField(choices=[('pending', 'Ожидает'), ('running', 'Идет'), ('paused', 'Приостановлена'), ('done', 'Завершена'), ('cancelled', 'Отменена')], default='pending', max_length=16, verbose_name='Статус')),
+                ('last_tg_id', models.BigIntegerField(blank=True, null=True, verbose_name='Последний получатель')),
+                ('total', models.PositiveIntegerField(blank=True, null=True, verbose_name='Получателей')),
+                ('sent', models.PositiveIntegerField(default=0, verbose_name='Доставлено')),
+                ('failed', models.PositiveIntegerField(default=0, verbose_name='Не доставлено')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Создана')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='Запущена')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Закончена')),
+                ('game', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='broadcasts', to='tgamer_app.game', verbose_name='Только игрокам игры')),
+            ],
+            options={
+                'verbose_name': 'Рассылка',
+                'verbose_name_plural': 'Рассылки',
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.0.4 on 2026-10-18 16:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tgamer_app', '0011_broadcast'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='poster_file_id',
+            field=models.CharField(blank=True, editable=False, max_length=255, verbose_name='file_id постера'),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='thumbnail',
+            field=models.ImageField(blank=True, editable=False, upload_to='games/thumbs/', verbose_name='Миниатюра'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.0.4 on 2026-10-18 17:09
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tgamer_app', '0012_game_thumbnail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Invite',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sender_username', models.CharField(max_length=32, verbose_name='Username отправителя')),
+                ('mutual', models.BooleanField(default=False, verbose_name='Взаимно')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Создано')),
+                ('delivered_at', models.DateTimeField(blank=True, null=True, verbose_name='Доставлено')),
+                ('game', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='invites', to='tgamer_app.game', verbose_name='Игра поиска')),
+                ('recipient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='invites_received', to='tgamer_app.player', verbose_name='Получатель')),
+                ('sender', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='invites_sent', to='tgamer_app.player', verbose_name='Отправитель')),
+            ],
+            options={
+                'verbose_name': 'Приглашение',
+                'verbose_name_plural': 'Приглашения',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='invite',
+            index=models.Index(fields=['recipient', 'delivered_at'], name='invite_recipient_pending_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='invite',
+            constraint=models.UniqueConstraint(fields=('sender', 'recipient'), name='invite_sender_recipient_unique'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.0.4 on 2026-10-18 17:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tgamer_app', '0013_invite'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='player',
+            index=models.Index(fields=['search_enabled', 'sign_up', 'tg_id'], name='player_search_signup_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='player',
+            index=models.Index(fields=['sign_up', 'tg_id'], name='player_signup_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='player',
+            index=models.Index(fields=['steam_name'], name='player_steam_name_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.0.4 on 2026-10-18 17:21
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tgamer_app', '0014_player_admin_idx'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='player',
+            name='player_game_search_idx',
+        ),
+    ]
@@ -0,0 +1,38 @@
+from django.db import migrations
+
+# поиск по началу ника в админке (steam_name__istartswith): Django
+# строит UPPER(steam_name) LIKE UPPER(...) на PostgreSQL
+# и регистронезависимый LIKE на SQLite. Обычный индекс по steam_name
+# (он нужен для сортировки) для LIKE не годится: в PostgreSQL с не-C
+# локалью нужен text_pattern_ops, в SQLite - COLLATE NOCASE. Описать
+# такие индексы в Meta одинаково для обеих БД нельзя, поэтому они
+# создаются здесь.
+INDEX_SQL = {
+    'postgresql': 'CREATE INDEX player_steam_name_prefix_idx ON '
+                  'tgamer_app_player (UPPER(steam_name) text_pattern_ops)',
+    'sqlite': 'CREATE INDEX player_steam_name_prefix_idx ON '
+              'tgamer_app_player (steam_name COLLATE NOCASE)',
+}
+
+
+def create_index(apps, schema_editor):
+    sql = INDEX_SQL.get(schema_editor.connection.vendor)
+    if sql is not None:
+        schema_editor.execute(sql)
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor in INDEX_SQL:
+        schema_editor.execute(
+            'DROP INDEX IF EXISTS player_steam_name_prefix_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tgamer_app', '0015_drop_player_game_search_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
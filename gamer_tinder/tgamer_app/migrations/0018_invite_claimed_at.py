@@ -0,0 +1,22 @@
+# Generated by Django 4.0.4 on 2026-10-18 17:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tgamer_app', '0017_game_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invite',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Взято в отправку'),
+        ),
+        migrations.AddIndex(
+            model_name='invite',
+            index=models.Index(fields=['delivered_at', 'claimed_at'], name='invite_pending_claim_idx'),
+        ),
+    ]
@@ -7,6 +7,15 @@ class Game(models.Model):
     genre = models.CharField('Жанр', max_length=100, default='')
     description = models.TextField('Описание игры')
     poster = models.ImageField('Постер', upload_to='games/')
+    # уменьшенная копия постера для админки и бота, см. posters.py
+    thumbnail = models.ImageField('Миниатюра', upload_to='games/thumbs/',
+                                  blank=True, editable=False)
+    # file_id миниатюры в Telegram после первой загрузки
+    poster_file_id = models.CharField('file_id постера', max_length=255,
+                                      blank=True, editable=False)
+    # по нему процессы бота замечают изменения каталога, см.
+    # markups.GamesCatalogue; update() должны выставлять его сами
+    updated_at = models.DateTimeField('Изменена', auto_now=True)
 
     def __str__(self):
         return self.title
@@ -34,6 +43,9 @@ class Player(models.Model):
                                       related_name='Игроки',
                                       on_delete=models.SET_NULL,
                                       null=True)
+    games = models.ManyToManyField(Game, verbose_name='Игры',
+                                   through='PlayerGame',
+                                   related_name='players')
     search_enabled = models.BooleanField('Поиск включен', default=True)
     sign_up = models.IntegerField(choices=RegistrationSteps.choices,
                                   default=RegistrationSteps.NEW_PLAYER)
@@ -43,7 +55,7 @@ class Player(models.Model):
         Функция вычисляет на каком этапе регистрации мы находимся
         '''
         fields_enum = enumerate(
-            (self.steam_name, self.about, self.prefered_game), start=1)
+            (self.steam_name, self.about, self.prefered_game_id), start=1)
         su_status = None
         for idx, field in fields_enum:
             if field is None or not field:
@@ -53,14 +65,60 @@ class Player(models.Model):
             su_status = self.RegistrationSteps.DONE
         self.sign_up = su_status
 
-    def get_possible_teammates(self, game: Game):
+    def is_searchable(self) -> bool:
+        '''Показывается ли игрок в поиске: включил поиск и зарегистрирован'''
+        return (self.search_enabled
+                and self.sign_up == self.RegistrationSteps.DONE)
+
+    def get_possible_teammates(self, games: list):
+        '''
+        returns a query of registered players with search enabled
+        who play every game of games (Game objects or ids)
+        '''
+        qs = Player.objects.filter(search_enabled=True,
+                                   sign_up=self.RegistrationSteps.DONE)
+        for game in games:
+            qs = qs.filter(player_games__game=game)
+        return qs.exclude(pk=self.tg_id)
+
+    def get_game_ids(self) -> list:
+        return list(PlayerGame.objects.filter(player=self).values_list(
+            'game_id', flat=True))
+
+    def get_games(self) -> list:
+        return list(self.games.order_by('id'))
+
+    def add_game(self, game: Game) -> None:
+        PlayerGame.objects.get_or_create(player=self, game=game)
+
+    def remove_game(self, game_id: int) -> None:
+        # удаление по одному, чтобы сработал сигнал post_delete
+        for link in PlayerGame.objects.filter(player=self, game_id=game_id):
+            link.delete()
+
+    def get_teammates_page(self, games: list, limit: int,
+                           start: int = None, stop: int = None) -> list:
+        '''
+        returns up to limit possible teammates ordered by tg_id
+        with start <= tg_id < stop, so the caller can walk
+        the candidates page by page (keyset pagination)
+        '''
+        qs = self.get_possible_teammates(games)
+        if start is not None:
+            qs = qs.filter(tg_id__gte=start)
+        if stop is not None:
+            qs = qs.filter(tg_id__lt=stop)
+        return list(qs.select_related('prefered_game').prefetch_related(
+            'player_games__game').order_by('tg_id')[:limit])
+
+    def get_teammates_id_range(self, games: list) -> tuple:
         '''
-        returns a query of players with search enabled and
-        same prefered game
+        returns (min, max) tg_id of possible teammates,
+        (None, None) if there are none
         '''
-        qs = Player.objects.filter(search_enabled=True).filter(
-            prefered_game=game).exclude(pk=self.tg_id)
-        return qs
+        bounds = self.get_possible_teammates(games).aggregate(
+            lo=models.Min('tg_id'), hi=models.Max('tg_id'))
+        return bounds['lo'], bounds['hi']
 
     def save(self, *args, **kwargs):
         self.update_sign_up_status()
@@ -69,3 +127,189 @@ class Player(models.Model):
     class Meta:
         verbose_name = 'Игрок'
         verbose_name_plural = 'Игроки'
+        indexes = [
+            # фильтры и сортировка по нику в админке
+            models.Index(fields=['search_enabled', 'sign_up', 'tg_id'],
+                         name='player_search_signup_idx'),
+            models.Index(fields=['sign_up', 'tg_id'],
+                         name='player_signup_idx'),
+            models.Index(fields=['steam_name'], name='player_steam_name_idx'),
+            # индекс для поиска по началу ника создает миграция 0016:
+            # он разный для PostgreSQL и SQLite
+        ]
+
+
+class PlayerGame(models.Model):
+    '''Игра в списке игрока, с его уровнем и ролью в ней'''
+    player = models.ForeignKey(Player, verbose_name='Игрок',
+                               on_delete=models.CASCADE,
+                               related_name='player_games')
+    game = models.ForeignKey(Game, verbose_name='Игра',
+                             on_delete=models.CASCADE,
+                             related_name='player_games')
+    skill = models.PositiveSmallIntegerField('Уровень', null=True,
+                                             blank=True)
+    role = models.CharField('Роль', max_length=50, blank=True, default='')
+
+    class Meta:
+        verbose_name = 'Игра игрока'
+        verbose_name_plural = 'Игры игроков'
+        constraints = [
+            models.UniqueConstraint(fields=['player', 'game'],
+                                    name='player_game_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['game', 'player'],
+                         name='player_game_game_idx'),
+        ]
+
+
+class ChatState(models.Model):
+    '''
+    Состояние диалога с ботом (поиск, текущая игра, курсор по кандидатам).
+    Хранятся только id, см. storage.StateStorage.
+    '''
+    tg_id = models.BigIntegerField('Телеграм айди', primary_key=True)
+    data = models.JSONField('Состояние', default=dict)
+    updated_at = models.DateTimeField('Обновлено', auto_now=True)
+
+    class Meta:
+        verbose_name = 'Состояние диалога'
+        verbose_name_plural = 'Состояния диалогов'
+
+
+class PlayerActivity(models.Model):
+    '''
+    Счетчики активности игрока, по которым ранжируются кандидаты
+    в поиске (см. matchmaking.GameIndex). Пишутся пачками через
+    writeback.activity_writes.
+    '''
+    player = models.OneToOneField(Player, verbose_name='Игрок',
+                                  primary_key=True, on_delete=models.CASCADE,
+                                  related_name='activity')
+    last_active_at = models.DateTimeField('Последняя активность', null=True)
+    times_shown = models.PositiveIntegerField(
+        'Показов с последней активности', default=0)
+    invites_received = models.PositiveIntegerField('Получено приглашений',
+                                                   default=0)
+    invites_answered = models.PositiveIntegerField('Отвечено приглашений',
+                                                   default=0)
+    awaiting_reply = models.BooleanField('Ждет ответа на приглашение',
+                                         default=False)
+
+    class Meta:
+        verbose_name = 'Активность игрока'
+        verbose_name_plural = 'Активность игроков'
+
+
+class SeenHistory(models.Model):
+    '''
+    Кого игроку уже показывали в поиске. Хранится не список, а два
+    фильтра Блума (текущий и предыдущий), см. seen.SeenSet, так что
+    размер записи не зависит от числа показанных анкет.
+    '''
+    player = models.OneToOneField(Player, verbose_name='Игрок',
+                                  primary_key=True, on_delete=models.CASCADE,
+                                  related_name='seen_history')
+    current = models.BinaryField('Текущий фильтр')
+    previous = models.BinaryField('Предыдущий фильтр', null=True)
+    count = models.PositiveIntegerField('Записей в текущем фильтре',
+                                        default=0)
+    rotated_at = models.DateTimeField('Начало текущего фильтра')
+
+    class Meta:
+        verbose_name = 'История просмотров'
+        verbose_name_plural = 'Истории просмотров'
+
+
+class Invite(models.Model):
+    '''
+    Приглашение (лайк) одного игрока другому. Уведомления получателю
+    отправляет invites.InviteDelivery, несколько приглашений за окно
+    BOT_INVITE_DIGEST_WINDOW уходят одним сообщением. Пара
+    (отправитель, получатель) уникальна, поэтому взаимный лайк
+    ищется по тому же индексу.
+    '''
+    sender = models.ForeignKey(Player, verbose_name='Отправитель',
+                               on_delete=models.CASCADE,
+                               related_name='invites_sent')
+    recipient = models.ForeignKey(Player, verbose_name='Получатель',
+                                  on_delete=models.CASCADE,
+                                  related_name='invites_received')
+    # username отправителя в Telegram на момент приглашения,
+    # по нему получатель напишет отправителю
+    sender_username = models.CharField('Username отправителя',
+                                       max_length=32)
+    game = models.ForeignKey(Game, verbose_name='Игра поиска',
+                             on_delete=models.SET_NULL, null=True,
+                             blank=True, related_name='invites')
+    mutual = models.BooleanField('Взаимно', default=False)
+    created_at = models.DateTimeField('Создано', auto_now_add=True)
+    delivered_at = models.DateTimeField('Доставлено', null=True, blank=True)
+    # когда процесс взял приглашение в отправку; delivered_at ставится
+    # только после отправки, а взятое, но не доставленное (процесс
+    # упал) через BOT_INVITE_CLAIM_LEASE секунд снова можно взять
+    claimed_at = models.DateTimeField('Взято в отправку', null=True,
+                                      blank=True, editable=False)
+
+    def __str__(self):
+        return f'{self.sender_id} -> {self.recipient_id}'
+
+    class Meta:
+        verbose_name = 'Приглашение'
+        verbose_name_plural = 'Приглашения'
+        constraints = [
+            models.UniqueConstraint(fields=['sender', 'recipient'],
+                                    name='invite_sender_recipient_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['recipient', 'delivered_at'],
+                         name='invite_recipient_pending_idx'),
+            # недоставленные с истекшей арендой, см. pending_recipients
+            models.Index(fields=['delivered_at', 'claimed_at'],
+                         name='invite_pending_claim_idx'),
+        ]
+
+
+class Broadcast(models.Model):
+    '''
+    Рассылка всем зарегистрированным игрокам или игрокам одной игры.
+    Получатели перебираются по возрастанию tg_id, last_tg_id - на ком
+    остановились, поэтому прерванную рассылку можно продолжить
+    (см. broadcast.BroadcastRunner).
+    '''
+    class Status(models.TextChoices):
+        PENDING = 'pending', 'Ожидает'
+        RUNNING = 'running', 'Идет'
+        PAUSED = 'paused', 'Приостановлена'
+        DONE = 'done', 'Завершена'
+        CANCELLED = 'cancelled', 'Отменена'
+
+    text = models.TextField('Текст')
+    game = models.ForeignKey(Game, verbose_name='Только игрокам игры',
+                             on_delete=models.CASCADE, null=True, blank=True,
+                             related_name='broadcasts')
+    status = models.CharField('Статус', max_length=16,
+                              choices=Status.choices, default=Status.PENDING)
+    last_tg_id = models.BigIntegerField('Последний получатель', null=True,
+                                        blank=True)
+    total = models.PositiveIntegerField('Получателей', null=True, blank=True)
+    sent = models.PositiveIntegerField('Доставлено', default=0)
+    failed = models.PositiveIntegerField('Не доставлено', default=0)
+    created_at = models.DateTimeField('Создана', auto_now_add=True)
+    started_at = models.DateTimeField('Запущена', null=True, blank=True)
+    finished_at = models.DateTimeField('Закончена', null=True, blank=True)
+
+    def recipients(self):
+        '''query of tg_ids to send to, ordered for keyset pagination'''
+        qs = Player.objects.filter(sign_up=Player.RegistrationSteps.DONE)
+        if self.game_id is not None:
+            qs = qs.filter(player_games__game_id=self.game_id)
+        return qs.order_by('tg_id').values_list('tg_id', flat=True)
+
+    def __str__(self):
+        return f'#{self.pk} {self.text[:40]}'
+
+    class Meta:
+        verbose_name = 'Рассылка'
+        verbose_name_plural = 'Рассылки'
@@ -15,4 +15,21 @@ COMMAND_LIST = 'Список комманд: '
 SHOW_USERNAME =  'Для использования этой комманды нужно в настройках профиля указать username'
 NO_PLAYERS_FOUND = 'Ни одного игрока, соответствующего вашим предпочтениям не найдено.'
 NO_MORE_PLAYERS_FOUND = 'Других игроков по вашему запросу не найдено.'
+ENTER_GAME_TO_ADD = 'Выберите игру, которую хотите добавить в свой список: '
+ENTER_GAME_TO_REMOVE = 'Выберите игру, которую хотите убрать из своего списка: '
+NO_GAMES = 'В вашем списке пока нет игр, добавьте их командой /add_game'
+UNKNOWN_GAME = 'Такой игры нет в каталоге.'
+GAME_ADDED = 'Игра {} добавлена в ваш список.'
+GAME_REMOVED = 'Игра {} убрана из вашего списка.'
+CANT_REMOVE_PREFERED = 'Это ваша любимая игра, сменить ее можно командой /change_game'
+INVITE_SENT = 'Сообщение {} успешно отправлено!'
+INVITE_MUTUAL = 'Это взаимно! {} тоже хочет с вами поиграть, напишите @{}'
+INVITE_RECEIVED = 'Пользователю {} понравилась ваша карточка по игре. Напиши ему!'
+INVITE_RECEIVED_MUTUAL = 'Это взаимно! Пользователю {} тоже понравилась ваша карточка. Напиши ему!'
+INVITE_DIGEST = 'Вашу карточку отметили игроки ({}):\n{}\nНапишите им!'
+INVITE_DIGEST_MUTUAL = '{} - взаимно'
+INVITE_DIGEST_MORE = 'и еще {}'
+CARD_EXPIRED = 'Эта карточка устарела, начните поиск заново командой /find'
+TOO_FAST = 'Слишком быстро, подождите секунду'
+NEW_GAME_ANNOUNCE = 'В каталоге новая игра: {}! Найти тиммейтов по ней можно командой /find'
 ON_HELP = ''
\ No newline at end of file
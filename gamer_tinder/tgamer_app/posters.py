@@ -0,0 +1,146 @@
+'''
+Постеры игр: по загруженному постеру один раз в фоновом потоке
+делается миниатюра (Pillow), ее показывает админка и отправляет бот.
+После первой отправки Telegram возвращает file_id, он сохраняется
+в Game.poster_file_id, и дальше отправляется только он, без байтов.
+'''
+import io
+import os
+import queue
+import threading
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections
+from django.utils import timezone
+from loguru import logger
+from PIL import Image, ImageOps
+from .models import Game
+
+
+def make_thumbnail(game_id: int) -> bool:
+    '''
+    Делает миниатюру постера игры, возвращает False, если постера нет.
+    Пишет через update(), чтобы не вызывать сигналы Game повторно.
+    '''
+    game = Game.objects.filter(pk=game_id).first()
+    if game is None or not game.poster:
+        return False
+    with game.poster.open('rb') as poster, Image.open(poster) as image:
+        image = ImageOps.exif_transpose(image).convert('RGB')
+        image.thumbnail(settings.POSTER_THUMB_SIZE)
+        data = io.BytesIO()
+        image.save(data, 'JPEG', quality=85, optimize=True)
+    old = game.thumbnail.name
+    name = os.path.splitext(os.path.basename(game.poster.name))[0] + '.jpg'
+    game.thumbnail.save(name, ContentFile(data.getvalue()), save=False)
+    # постер могли сменить, пока делали миниатюру: тогда она не нужна
+    updated = Game.objects.filter(pk=game.pk, poster=game.poster.name).update(
+        thumbnail=game.thumbnail.name, poster_file_id='',
+        updated_at=timezone.now())
+    if not updated:
+        game.thumbnail.delete(save=False)
+        return False
+    if old:
+        game.thumbnail.storage.delete(old)
+    # update() не вызывает сигналы: каталог этого процесса перечитаем
+    # сами, остальные заметят новый updated_at
+    from .markups import games_catalogue
+    games_catalogue.invalidate()
+    return True
+
+
+class ThumbnailWorker:
+    '''Фоновый поток, который делает миниатюры по очереди'''
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, game_id: int) -> None:
+        self._queue.put(game_id)
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='thumbnails', daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            game_id = self._queue.get()
+            close_old_connections()
+            try:
+                make_thumbnail(game_id)
+            except Exception:
+                logger.exception(f'Error while making thumbnail of {game_id}')
+            finally:
+                self._queue.task_done()
+
+    def join(self) -> None:
+        '''Ждет, пока очередь опустеет'''
+        self._queue.join()
+
+
+class PosterUpload(tuple):
+    '''
+    (имя файла, байты) для загрузки в Telegram; thumbnail - какая
+    миниатюра была в БД, когда файл читали: file_id сохранится,
+    только если она с тех пор не сменилась
+    '''
+    def __new__(cls, filename: str, content: bytes, thumbnail: str):
+        upload = super().__new__(cls, (filename, content))
+        upload.thumbnail = thumbnail
+        return upload
+
+
+def poster_source(game: Game):
+    '''
+    Что отправлять в sendPhoto: file_id, если постер уже загружали,
+    иначе PosterUpload миниатюры или постера, None - постера нет.
+    Читает файл, вызывать вне event loop. game может быть объектом
+    из каталога другого процесса, где еще нет миниатюры и file_id,
+    поэтому без file_id поля постера перечитываются из БД. Файл
+    открывается через storage, а не через FieldFile.open(): тот
+    запоминает открытый файл в самом поле, и соседний поток его закроет.
+    '''
+    if game.poster_file_id:
+        return game.poster_file_id
+    current = Game.objects.filter(pk=game.pk).only(
+        'poster', 'thumbnail', 'poster_file_id').first()
+    if current is None:
+        return None
+    if current.poster_file_id:
+        return current.poster_file_id
+    image = current.thumbnail or current.poster
+    if not image:
+        return None
+    try:
+        with image.storage.open(image.name, 'rb') as f:
+            return PosterUpload(os.path.basename(image.name), f.read(),
+                                current.thumbnail.name)
+    except (OSError, ValueError):
+        logger.warning(f'Poster of game {game.pk} is missing: {image.name}')
+        return None
+
+
+def photo_file_id(message: dict):
+    '''file_id самой большой версии фото из отправленного сообщения'''
+    photos = message.get('photo') if isinstance(message, dict) else None
+    return photos[-1]['file_id'] if photos else None
+
+
+def remember_file_id(game: Game, file_id: str, upload: PosterUpload) -> None:
+    '''
+    Сохраняет file_id загруженного постера, дальше он отправляется
+    вместо файла. Если миниатюру успели сделать или переделать,
+    file_id старой картинки не сохраняется.
+    '''
+    if not file_id:
+        return
+    updated = Game.objects.filter(pk=game.pk,
+                                  thumbnail=upload.thumbnail).update(
+        poster_file_id=file_id)
+    if updated:
+        game.poster_file_id = file_id
+
+
+thumbnail_worker = ThumbnailWorker()
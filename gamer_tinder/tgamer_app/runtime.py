@@ -0,0 +1,424 @@
+'''
+Асинхронный рантайм бота: один event loop на процесс вместо
+потока на каждый чат, как было с telepot.DelegatorBot.
+'''
+import asyncio
+import contextlib
+import contextvars
+import functools
+import heapq
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import telepot
+from loguru import logger
+from django.conf import settings
+from django.db import close_old_connections
+from .api import TelegramApi
+from .dispatcher import LatencyStats, OutboundDispatcher
+from .inbound import InboundLimiter, UpdateDedup
+from .metrics import metrics
+from . import msgs
+
+
+UPDATE_KINDS = ('message', 'edited_message', 'callback_query')
+
+
+def extract_message(update: dict):
+    '''Достает из апдейта само сообщение (или callback_query)'''
+    for kind in UPDATE_KINDS:
+        if kind in update:
+            return update[kind]
+    return None
+
+
+def get_chat_id(msg: dict):
+    '''Аналог telepot.delegate.per_chat_id'''
+    if 'chat' in msg:
+        return msg['chat']['id']
+    if 'message' in msg:
+        return msg['message']['chat']['id']
+    return None
+
+
+def _call_db(fn, *args, **kwargs):
+    '''
+    Потоки пула живут долго и держат постоянные соединения, поэтому,
+    как Django в начале запроса, закрываем соединения, которые
+    устарели (CONN_MAX_AGE) или сломались после ошибки
+    '''
+    close_old_connections()
+    return fn(*args, **kwargs)
+
+
+class Sender:
+    '''
+    Аналог telepot.helper.Sender: методы API
+    с уже подставленным chat_id.
+    '''
+    def __init__(self, api, chat_id: int):
+        self._api = api
+        self._chat_id = chat_id
+
+    def sendMessage(self, text: str, **kwargs):
+        return self._api.sendMessage(self._chat_id, text, **kwargs)
+
+    def sendPhoto(self, photo, **kwargs):
+        return self._api.sendPhoto(self._chat_id, photo, **kwargs)
+
+    def sendMediaGroup(self, media: list, files: dict = None):
+        return self._api.sendMediaGroup(self._chat_id, media, files=files)
+
+    def editMessageText(self, message_id: int, text: str, **kwargs):
+        return self._api.editMessageText(self._chat_id, message_id, text,
+                                         **kwargs)
+
+    def editMessageMedia(self, message_id: int, media: dict,
+                         files: dict = None, **kwargs):
+        return self._api.editMessageMedia(self._chat_id, message_id, media,
+                                          files=files, **kwargs)
+
+
+class ChatHandler:
+    '''
+    Асинхронная замена telepot.helper.ChatHandler.
+    Хендлеры наследников - корутины, а ORM вызывается через self.db,
+    который выполняет функцию в ограниченном пуле потоков рантайма.
+    Сессий столько же, сколько недавно писавших чатов, поэтому это
+    маленькая запись на __slots__: таблицы роутинга общие на класс
+    (flavor -> имя метода), отправитель и лок создаются по требованию.
+    '''
+    __slots__ = ('chat_id', '_runtime', 'last_seen', 'idle_deadline',
+                 'compacted')
+    flavor_route = {'chat': 'on_chat_message'}
+
+    def __init__(self, runtime: 'BotRuntime', chat_id: int):
+        self.chat_id = chat_id
+        self._runtime = runtime
+        # заполняет рантайм: время последнего апдейта по loop.time(),
+        # срок записи сессии в планировщике простоя и сжата ли она
+        self.last_seen = 0.0
+        self.idle_deadline = None
+        self.compacted = False
+
+    @property
+    def bot(self) -> OutboundDispatcher:
+        return self._runtime.outbox
+
+    @property
+    def sender(self) -> 'Sender':
+        return Sender(self._runtime.outbox, self.chat_id)
+
+    def db(self, fn, *args, **kwargs):
+        '''Выполняет синхронный (ORM) вызов в пуле потоков рантайма'''
+        return self._runtime.run_sync(fn, *args, **kwargs)
+
+    async def on_message(self, msg: dict):
+        try:
+            name = self.flavor_route.get(telepot.flavor(msg), 'on_unhandled')
+        except telepot.exception.BadFlavor:
+            name = 'on_unhandled'
+        return await getattr(self, name)(msg)
+
+    async def on_chat_message(self, msg: dict):
+        pass
+
+    async def on_unhandled(self, msg: dict):
+        pass
+
+    def compact(self) -> None:
+        '''
+        Сессия простаивает BOT_SESSION_COMPACT_AFTER секунд: можно
+        отпустить все, что восстанавливается при следующем апдейте
+        '''
+
+    def on__idle(self, event: dict):
+        self.close()
+
+    def close(self):
+        self._runtime.close_session(self.chat_id)
+
+
+class IdleScheduler:
+    '''
+    Один планировщик простоя на все сессии вместо таймера на каждую.
+    В куче по одной записи (срок, chat_id) на сессию, а апдейт только
+    обновляет last_seen сессии. Когда срок записи подходит, простаивающая
+    сессия сжимается (compact) или закрывается (on__idle), а сессия,
+    в которую с тех пор писали, переносится на новый срок.
+    Так апдейт стоит O(1), а сессия - одну запись в куче.
+    '''
+    interval = 1.0
+
+    def __init__(self, sessions: dict, timeout: float, compact_after: float,
+                 is_busy):
+        self._sessions = sessions
+        self._timeout = timeout
+        self._compact_after = min(compact_after, timeout)
+        # занятые сессии (апдейт обрабатывается) не трогаем
+        self._is_busy = is_busy
+        self._heap = []
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def _push(self, session: ChatHandler, deadline: float) -> None:
+        session.idle_deadline = deadline
+        heapq.heappush(self._heap, (deadline, session.chat_id))
+
+    def add(self, session: ChatHandler) -> None:
+        '''Ставит новую сессию в очередь, last_seen уже заполнен'''
+        self._push(session, session.last_seen + self._compact_after)
+
+    def sweep(self, now: float) -> int:
+        '''Обрабатывает подошедшие сроки, возвращает число закрытых'''
+        heap = self._heap
+        closed = 0
+        while heap and heap[0][0] <= now:
+            deadline, chat_id = heapq.heappop(heap)
+            session = self._sessions.get(chat_id)
+            # сессию закрыли раньше, или это запись прежней сессии чата
+            if session is None or session.idle_deadline != deadline:
+                continue
+            idle = now - session.last_seen
+            if self._is_busy(chat_id):
+                self._push(session, now + self._compact_after)
+            elif idle >= self._timeout:
+                session.on__idle({'_idle': {'source': chat_id,
+                                            'timeout': self._timeout}})
+                closed += 1
+                if self._sessions.get(chat_id) is session:
+                    self._push(session, now + self._timeout)
+            elif session.compacted:
+                self._push(session, session.last_seen + self._timeout)
+            elif idle >= self._compact_after:
+                session.compact()
+                session.compacted = True
+                self._push(session, session.last_seen + self._timeout)
+            else:
+                self._push(session, session.last_seen + self._compact_after)
+        return closed
+
+    async def run(self, loop: asyncio.AbstractEventLoop) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.sweep(loop.time())
+            except Exception:
+                logger.exception('Error while evicting idle sessions')
+
+
+class BotRuntime:
+    '''
+    Держит сессии чатов, event loop и пул потоков для БД.
+    Сообщения одного чата обрабатываются строго по очереди,
+    разные чаты - конкурентно в одном потоке.
+    '''
+    def __init__(self, token: str, handler_class, timeout: int = 1200,
+                 db_workers: int = None, compact_after: float = None):
+        self.api = TelegramApi(token)
+        # хендлеры отправляют сообщения только через диспетчер
+        self.outbox = OutboundDispatcher(self.api)
+        self.loop = None
+        self._handler_class = handler_class
+        self._timeout = timeout
+        self._sessions = {}
+        # локи чатов, по которым сейчас идут апдейты: chat_id ->
+        # [лок, сколько апдейтов его ждут или держат]
+        self._locks = {}
+        self._idle = IdleScheduler(
+            self._sessions, timeout,
+            settings.BOT_SESSION_COMPACT_AFTER if compact_after is None
+            else compact_after,
+            is_busy=self._locks.__contains__)
+        self._sweeper = None
+        self.dedup = UpdateDedup(settings.BOT_UPDATE_DEDUP_SIZE)
+        self.inbound = InboundLimiter(settings.BOT_INBOUND_RATE_PER_CHAT,
+                                      settings.BOT_INBOUND_BURST_PER_CHAT,
+                                      coalesce=settings.BOT_INBOUND_COALESCE)
+        self._tasks = set()
+        self.handled = 0
+        self.handle_latency = LatencyStats()
+        self._executor = ThreadPoolExecutor(
+            max_workers=db_workers or settings.BOT_DB_WORKERS,
+            thread_name_prefix='bot-db')
+        metrics.register('runtime', self.gauges)
+
+    def run_sync(self, fn, *args, **kwargs):
+        # контекст копируется, чтобы запросы к БД из пула потоков
+        # засчитывались апдейту, который их сделал
+        ctx = contextvars.copy_context()
+        return self.loop.run_in_executor(
+            self._executor,
+            functools.partial(ctx.run, _call_db, fn, *args, **kwargs))
+
+    def get_session(self, chat_id: int) -> ChatHandler:
+        now = self.loop.time()
+        handler = self._sessions.get(chat_id)
+        if handler is None:
+            handler = self._handler_class(self, chat_id)
+            handler.last_seen = now
+            self._sessions[chat_id] = handler
+            self._idle.add(handler)
+            if self._sweeper is None:
+                self._sweeper = self.spawn(self._idle.run(self.loop))
+        else:
+            handler.last_seen = now
+            handler.compacted = False
+        return handler
+
+    def close_session(self, chat_id: int) -> None:
+        # запись в куче планировщика станет ничьей и отбросится
+        self._sessions.pop(chat_id, None)
+
+    def sweep_idle(self, ahead: float = 0.0) -> int:
+        '''
+        Сжимает и закрывает простаивающие сессии так, будто прошло
+        еще ahead секунд (для стенда), вызывать в loop рантайма
+        '''
+        return self._idle.sweep(self.loop.time() + ahead)
+
+    @contextlib.asynccontextmanager
+    async def _chat_lock(self, chat_id: int):
+        '''
+        Апдейты одного чата - строго по очереди. Лок живет, только
+        пока у чата есть апдейты в работе, простаивающим он не нужен
+        '''
+        entry = self._locks.get(chat_id)
+        if entry is None:
+            entry = self._locks[chat_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[chat_id]
+
+    @property
+    def shed(self) -> int:
+        '''Сколько апдейтов отброшено до хендлеров'''
+        return (self.dedup.duplicates + self.inbound.coalesced
+                + self.inbound.throttled)
+
+    def admit(self, update: dict) -> bool:
+        '''
+        Пропускать ли апдейт дальше: False - повторная доставка
+        или команда, отброшенная лимитом чата. Вызывать в loop
+        рантайма, до того как апдейт встанет в очередь.
+        '''
+        msg = extract_message(update)
+        if self.dedup.seen(update.get('update_id')):
+            # повтор того же нажатия: хендлер оригинала ответит сам,
+            # лишний ответ Telegram просто отклонит
+            self._answer_shed(msg)
+            return False
+        chat_id = get_chat_id(msg) if msg is not None else None
+        if chat_id is None:
+            return True
+        key = self.inbound.command_key(msg)
+        if key is None or self.inbound.admit(chat_id, key):
+            return True
+        self._answer_shed(msg, msgs.TOO_FAST)
+        return False
+
+    def _answer_shed(self, msg, text: str = None) -> None:
+        '''
+        Отвечает на отброшенное нажатие кнопки, иначе у нее крутятся
+        часики, пока Telegram не сдастся сам
+        '''
+        if msg is None or 'data' not in msg or 'id' not in msg:
+            return
+        kwargs = {'text': text} if text else {}
+        self.spawn(self._answer_quietly(msg['id'], kwargs))
+
+    async def _answer_quietly(self, query_id: str, kwargs: dict) -> None:
+        try:
+            await self.outbox.answerCallbackQuery(query_id, **kwargs)
+        except Exception as e:
+            logger.debug(f'Answer to shed callback query failed: {e}')
+
+    async def handle(self, update: dict, admitted: bool = False) -> None:
+        '''
+        Отдает апдейт в сессию его чата. admitted - апдейт уже
+        прошел admit при постановке в очередь.
+        '''
+        if not admitted and not self.admit(update):
+            return
+        msg = extract_message(update)
+        if msg is None:
+            return
+        chat_id = get_chat_id(msg)
+        if chat_id is None:
+            return
+        key = self.inbound.command_key(msg)
+        handler = self.get_session(chat_id)
+        async with self._chat_lock(chat_id):
+            if key is not None:
+                self.inbound.started(chat_id, key)
+            started = time.monotonic()
+            token = metrics.start_update()
+            try:
+                await handler.on_message(msg)
+            except Exception:
+                logger.exception(f'Error while handling update for {chat_id}')
+            elapsed = time.monotonic() - started
+            metrics.finish_update(token, elapsed)
+            self.handle_latency.observe(elapsed)
+            self.handled += 1
+
+    def gauges(self) -> dict:
+        '''Состояние рантайма для /metrics'''
+        outbox = self.outbox
+        return {'sessions': len(self._sessions),
+                'sessions_busy': len(self._locks),
+                'tasks': len(self._tasks),
+                'db_threads': len(self._executor._threads),
+                'updates_handled_total': self.handled,
+                'updates_duplicate_total': self.dedup.duplicates,
+                'updates_coalesced_total': self.inbound.coalesced,
+                'updates_throttled_total': self.inbound.throttled,
+                'outbox_depth': outbox.depth,
+                'outbox_sent_total': outbox.sent,
+                'outbox_failed_total': outbox.failed,
+                'outbox_retries_total': outbox.retries,
+                'outbox_throttled_total': outbox.throttled}
+
+    def feed(self, update: dict):
+        '''Потокобезопасно передает апдейт в event loop рантайма'''
+        return asyncio.run_coroutine_threadsafe(self.handle(update),
+                                                self.loop)
+
+    def spawn(self, coro) -> asyncio.Task:
+        '''Создает задачу и держит на нее ссылку до завершения'''
+        task = self.loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def submit(self, coro):
+        '''Запускает корутину в loop рантайма из другого потока'''
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run_as_thread(self) -> threading.Thread:
+        self.loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=self.loop.run_forever,
+                                  name='bot-loop', daemon=True)
+        thread.start()
+        return thread
+
+    async def poll(self) -> None:
+        '''Получает апдейты через long polling'''
+        self.loop = asyncio.get_running_loop()
+        offset = None
+        while True:
+            try:
+                updates = await self.api.getUpdates(offset=offset)
+            except Exception:
+                logger.exception('Error while polling updates')
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                offset = update['update_id'] + 1
+                self.spawn(self.handle(update))
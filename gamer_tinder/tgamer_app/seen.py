@@ -0,0 +1,187 @@
+'''
+История показов в поиске: кого игроку уже показывали, чтобы
+новый /find не выдавал те же анкеты. На игрока хранятся два фильтра
+Блума фиксированного размера: в текущий добавляются новые показы,
+а когда он заполнился или устарел, он становится предыдущим, а самый
+старый выбрасывается. Поэтому показ забывается через время от
+SEEN_WINDOW / 2 до SEEN_WINDOW, а ложные срабатывания (анкету
+не покажут, хотя ее не видели) ограничены SEEN_FILTER_CAPACITY.
+'''
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from loguru import logger
+from django.conf import settings
+from .models import Player, SeenHistory
+from .writeback import WriteBehind
+
+MASK64 = (1 << 64) - 1
+
+
+def _mix(value: int) -> int:
+    '''splitmix64: хорошо перемешивает последовательные tg_id'''
+    value = (value + 0x9E3779B97F4A7C15) & MASK64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK64
+    return value ^ (value >> 31)
+
+
+class BloomFilter:
+    __slots__ = ('bits', 'size', 'hashes')
+
+    def __init__(self, size_bytes: int, hashes: int, data: bytes = None):
+        self.bits = bytearray(data) if data else bytearray(size_bytes)
+        self.size = len(self.bits) * 8
+        self.hashes = hashes
+
+    def _positions(self, item: int):
+        # двойное хэширование: k позиций из одного 64-битного хэша
+        value = _mix(item)
+        h1, h2 = value & 0xFFFFFFFF, (value >> 32) | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item: int) -> None:
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item: int) -> bool:
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(item))
+
+
+class SeenSet:
+    '''Показанные игроку tg_id: текущий и предыдущий фильтры'''
+    def __init__(self, current: BloomFilter, previous: BloomFilter = None,
+                 count: int = 0, rotated_at: datetime = None):
+        self.current = current
+        self.previous = previous
+        self.count = count
+        self.rotated_at = rotated_at or datetime.now(timezone.utc)
+
+    @classmethod
+    def empty(cls) -> 'SeenSet':
+        return cls(BloomFilter(settings.SEEN_FILTER_BYTES,
+                               settings.SEEN_FILTER_HASHES))
+
+    def _rotate_if_needed(self) -> None:
+        now = datetime.now(timezone.utc)
+        if (self.count < settings.SEEN_FILTER_CAPACITY and
+                now - self.rotated_at < timedelta(
+                    seconds=settings.SEEN_WINDOW / 2)):
+            return
+        self.previous = self.current
+        self.current = BloomFilter(settings.SEEN_FILTER_BYTES,
+                                   settings.SEEN_FILTER_HASHES)
+        self.count = 0
+        self.rotated_at = now
+
+    def add(self, tg_id: int) -> None:
+        self._rotate_if_needed()
+        if tg_id not in self.current:
+            self.current.add(tg_id)
+            self.count += 1
+
+    def __contains__(self, tg_id: int) -> bool:
+        return tg_id in self.current or (
+            self.previous is not None and tg_id in self.previous)
+
+
+class SeenHistoryStore(WriteBehind):
+    '''
+    Истории показов игроков, которые сейчас ищут: LRU в памяти
+    процесса, подгружается из SeenHistory при промахе, изменения
+    пишутся пачкой. Чаты закреплены за процессом (см. cluster.py),
+    так что историю игрока меняет только один процесс.
+    '''
+    def __init__(self, interval: float, maxsize: int):
+        super().__init__(interval)
+        self._maxsize = maxsize
+        self._cache = OrderedDict()
+        self._created = set()
+
+    def get(self, tg_id: int) -> SeenSet:
+        '''Может сходить в БД, вызывать вне event loop'''
+        with self._lock:
+            seen = self._cache.get(tg_id)
+            if seen is not None:
+                self._cache.move_to_end(tg_id)
+                return seen
+        seen = self._load(tg_id)
+        with self._lock:
+            # пока грузили, историю мог подгрузить другой поток
+            seen = self._cache.setdefault(tg_id, seen)
+            self._cache.move_to_end(tg_id)
+            while len(self._cache) > self._maxsize:
+                self._cache.popitem(last=False)
+        return seen
+
+    def _load(self, tg_id: int) -> SeenSet:
+        row = SeenHistory.objects.filter(pk=tg_id).first()
+        if row is None:
+            with self._lock:
+                self._created.add(tg_id)
+            return SeenSet.empty()
+        size, hashes = settings.SEEN_FILTER_BYTES, settings.SEEN_FILTER_HASHES
+        current = BloomFilter(size, hashes, row.current)
+        previous = (BloomFilter(size, hashes, row.previous)
+                    if row.previous else None)
+        if current.size != size * 8:
+            # размер фильтра поменяли в настройках: старые не читаются
+            return SeenSet.empty()
+        return SeenSet(current, previous, row.count, row.rotated_at)
+
+    def add(self, tg_id: int, seen_id: int) -> None:
+        seen = self.get(tg_id)
+        with self._lock:
+            seen.add(seen_id)
+            self._dirty[tg_id] = seen
+        self._ensure_started()
+
+    def flush(self) -> int:
+        with self._lock:
+            entries, self._dirty = self._dirty, {}
+            created = self._created & entries.keys()
+            self._created -= created
+        if not entries:
+            return 0
+        if created:
+            # игрока могли удалить, пока история ждала записи
+            created = set(Player.objects.filter(pk__in=created).values_list(
+                'pk', flat=True))
+        rows = [SeenHistory(player_id=tg_id, current=bytes(seen.current.bits),
+                            previous=(bytes(seen.previous.bits)
+                                      if seen.previous else None),
+                            count=seen.count, rotated_at=seen.rotated_at)
+                for tg_id, seen in entries.items()]
+        try:
+            SeenHistory.objects.bulk_create(
+                [row for row in rows if row.player_id in created],
+                ignore_conflicts=True)
+            SeenHistory.objects.bulk_update(
+                rows, ['current', 'previous', 'count', 'rotated_at'])
+        except Exception:
+            logger.exception('Error while writing seen history, will retry')
+            with self._lock:
+                for tg_id, seen in entries.items():
+                    self._dirty.setdefault(tg_id, seen)
+                self._created |= created
+            raise
+        return len(entries)
+
+
+class Excluded:
+    '''
+    Объединение множеств для exclude в GameIndex.top: кандидаты,
+    показанные в этом поиске, и история показов
+    '''
+    __slots__ = ('_parts',)
+
+    def __init__(self, *parts):
+        self._parts = parts
+
+    def __contains__(self, tg_id: int) -> bool:
+        return any(tg_id in part for part in self._parts)
+
+
+seen_history = SeenHistoryStore(settings.PLAYER_WRITE_INTERVAL,
+                                settings.SEEN_CACHE_SIZE)
@@ -0,0 +1,88 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_save, post_delete, pre_save
+from django.dispatch import receiver
+from .models import Game, Player, PlayerGame
+from .matchmaking import game_index
+from .cache import player_cache
+
+
+@receiver(post_save, sender=Player)
+def update_game_index(sender, instance: Player, **kwargs):
+    '''Поддерживает индекс поиска в актуальном состоянии'''
+    game_index.update(instance.tg_id, instance.is_searchable())
+    player_cache.on_saved(instance)
+
+
+@receiver(post_delete, sender=Player)
+def remove_from_game_index(sender, instance: Player, **kwargs):
+    game_index.remove(instance.tg_id)
+    player_cache.invalidate(instance.tg_id)
+
+
+@receiver(post_save, sender=PlayerGame)
+def add_player_game(sender, instance: PlayerGame, **kwargs):
+    game_index.add_game(instance.player_id, instance.game_id)
+
+
+@receiver(post_delete, sender=PlayerGame)
+def remove_player_game(sender, instance: PlayerGame, **kwargs):
+    game_index.remove_game(instance.player_id, instance.game_id)
+
+
+@receiver(post_save, sender=Game)
+@receiver(post_delete, sender=Game)
+def invalidate_games_catalogue(sender, **kwargs):
+    # markups (telepot) и posters (Pillow) импортируются при первом
+    # сигнале, а не при старте каждого процесса
+    from .markups import games_catalogue
+    games_catalogue.invalidate()
+
+
+@receiver(post_save, sender=Game)
+def update_game_genres(sender, instance: Game, **kwargs):
+    game_index.set_genres(instance.pk, instance.genre)
+
+
+@receiver(post_delete, sender=Game)
+def remove_game_genres(sender, instance: Game, **kwargs):
+    game_index.set_genres(instance.pk)
+
+
+@receiver(pre_save, sender=Game)
+def reset_poster_copies(sender, instance: Game, **kwargs):
+    '''Новый постер: старые миниатюра и file_id больше не подходят'''
+    if instance.pk is None:
+        return
+    old = Game.objects.filter(pk=instance.pk).values_list(
+        'poster', 'thumbnail').first()
+    if old is None or old[0] == instance.poster.name:
+        return
+    if old[1]:
+        storage = instance.thumbnail.storage
+        transaction.on_commit(lambda: storage.delete(old[1]))
+    instance.thumbnail = ''
+    instance.poster_file_id = ''
+
+
+@receiver(post_save, sender=Game)
+def make_game_thumbnail(sender, instance: Game, **kwargs):
+    if instance.poster and not instance.thumbnail:
+        from .posters import thumbnail_worker
+        thumbnail_worker.submit(instance.pk)
+
+
+@receiver(connection_created)
+def setup_sqlite(sender, connection, **kwargs):
+    '''
+    В SQLite включает WAL: читатели не блокируют писателя и наоборот,
+    так что регистрации и поиск не выстраиваются в одну очередь.
+    Режим записывается в сам файл БД, поэтому только по DB_SQLITE_WAL,
+    а не при каждой команде manage.py.
+    '''
+    if connection.vendor != 'sqlite' or not settings.DB_SQLITE_WAL:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
@@ -1,38 +1,396 @@
-from .models import Game, Player
+import json
 import random
+import threading
+import zlib
+from collections import OrderedDict
+from django.conf import settings
+from django.utils.module_loading import import_string
+from .models import ChatState, Player
+from .matchmaking import GameIndex, game_index
+from .seen import Excluded, seen_history
+
+
+class TeammateCursor:
+    '''
+    Lazily walks possible teammates page by page.
+    Starts from a random tg_id, goes up to the largest one and then
+    wraps around to the smallest, so every candidate is shown once
+    and only page_size players are held in memory.
+    Candidates must play every game of game_ids.
+    The position is plain data (see to_state), so the cursor can be
+    stored in a state backend and restored in another process.
+    '''
+    kind = 'keyset'
+
+    def __init__(self, player_id: int, game_ids: list, page_size: int):
+        # an unsaved stub is enough to build the candidate queries
+        self._player = Player(tg_id=player_id)
+        self._game_ids = list(game_ids)
+        self._page_size = page_size
+        self._queue = []
+        self._players = {}
+        self._pivot = None
+        self._start = None
+        self._stop = None
+        self._wrapped = False
+        self._exhausted = False
+
+    def to_state(self) -> dict:
+        return {'kind': self.kind,
+                'player': self._player.tg_id,
+                'games': self._game_ids,
+                'queue': list(self._queue),
+                'pivot': self._pivot,
+                'start': self._start,
+                'stop': self._stop,
+                'wrapped': self._wrapped,
+                'exhausted': self._exhausted}
+
+    def _restore(self, state: dict) -> None:
+        self._queue = list(state['queue'])
+        self._pivot = state['pivot']
+        self._start = state['start']
+        self._stop = state['stop']
+        self._wrapped = state['wrapped']
+        self._exhausted = state['exhausted']
+
+    @classmethod
+    def from_state(cls, state: dict, page_size: int, players: dict = None):
+        '''
+        players - already loaded Player objects which may be reused
+        instead of querying them again
+        '''
+        # cursors saved before multi-game search have a single 'game'
+        game_ids = state.get('games') or [state['game']]
+        cursor = cls(state['player'], game_ids, page_size)
+        cursor._restore(state)
+        if players:
+            cursor._players = {tg_id: players[tg_id]
+                               for tg_id in cursor._queue if tg_id in players}
+        return cursor
+
+    def _init_pivot(self) -> None:
+        lo, hi = self._player.get_teammates_id_range(self._game_ids)
+        if lo is None:
+            self._exhausted = True
+            return
+        self._pivot = random.randint(lo, hi)
+        self._start = self._pivot
+
+    def _next_page(self) -> list:
+        if self._pivot is None:
+            self._init_pivot()
+            if self._exhausted:
+                return []
+        page = self._player.get_teammates_page(
+            self._game_ids, self._page_size, self._start, self._stop)
+        if len(page) < self._page_size:
+            if self._wrapped:
+                self._exhausted = True
+            else:
+                self._wrapped = True
+                self._start, self._stop = None, self._pivot
+        else:
+            self._start = page[-1].tg_id + 1
+        return page
+
+    def _order(self, page: list) -> list:
+        '''returns the page in the order it is shown, first to last'''
+        random.shuffle(page)
+        return page
+
+    def _unseen(self, page: list) -> list:
+        '''drops candidates already shown to the player in earlier searches'''
+        seen = seen_history.get(self._player.tg_id)
+        return [player for player in page if player.tg_id not in seen]
+
+    def _fetch_page(self) -> None:
+        while not self._queue and not self._exhausted:
+            page = self._order(self._unseen(self._next_page()))
+            # pop() takes candidates from the end
+            self._queue = [player.tg_id for player in reversed(page)]
+            self._players = {player.tg_id: player for player in page}
+
+    def peek(self) -> list:
+        '''returns tg_ids of the current page, loading it if needed'''
+        self._fetch_page()
+        return self._queue
+
+    def pop(self) -> Player:
+        while True:
+            self._fetch_page()
+            tg_id = self._queue.pop()
+            player = self._players.pop(tg_id, None)
+            if player is None:
+                # restored from a backend: the page objects are gone,
+                # the rest of the page is loaded at once
+                self._players = {
+                    player.tg_id: player
+                    for player in Player.objects.select_related(
+                        'prefered_game').prefetch_related(
+                        'player_games__game').filter(
+                        pk__in=self._queue + [tg_id])}
+                player = self._players.pop(tg_id, None)
+            if player is not None:
+                return player
+
+    @property
+    def players(self) -> dict:
+        return self._players
+
+
+class IndexedTeammateCursor(TeammateCursor):
+    '''
+    Same interface, but candidates come from the in-memory GameIndex
+    ranked by activity (best first) and the database is only asked
+    for the page itself. viewer_games are the searching player's own
+    games, their genres boost candidates with shared genres.
+    '''
+    kind = 'indexed'
+
+    def __init__(self, player_id: int, game_ids: list, page_size: int,
+                 viewer_games=(), index: GameIndex = game_index):
+        super().__init__(player_id, game_ids, page_size)
+        self._index = index
+        self._viewer_games = list(viewer_games)
+        self._shown = {player_id}
+        self._ranked = []
+
+    def to_state(self) -> dict:
+        state = super().to_state()
+        state['shown'] = list(self._shown)
+        state['viewer_games'] = self._viewer_games
+        return state
+
+    def _restore(self, state: dict) -> None:
+        super()._restore(state)
+        self._shown = set(state['shown'])
+        viewer_game = state.get('viewer_game')
+        self._viewer_games = state.get(
+            'viewer_games', [viewer_game] if viewer_game else [])
+
+    def _next_page(self) -> list:
+        exclude = Excluded(self._shown, seen_history.get(self._player.tg_id))
+        ids = self._index.top(self._game_ids, self._page_size,
+                              exclude=exclude,
+                              viewer_games=self._viewer_games)
+        if not ids:
+            self._exhausted = True
+            return []
+        self._shown.update(ids)
+        self._ranked = ids
+        # the index may lag behind the database, so filter again
+        return list(self._player.get_possible_teammates(
+            self._game_ids).filter(pk__in=ids).select_related(
+                'prefered_game').prefetch_related('player_games__game'))
+
+    def _unseen(self, page: list) -> list:
+        # the index has already skipped them
+        return page
+
+    def _order(self, page: list) -> list:
+        rank = {tg_id: pos for pos, tg_id in enumerate(self._ranked)}
+        return sorted(page, key=lambda player: rank[player.tg_id])
+
+
+CURSORS = {cursor.kind: cursor
+           for cursor in (TeammateCursor, IndexedTeammateCursor)}
+
+
+class InMemoryStateBackend:
+    '''
+    Keeps conversation states in a process-wide LRU.
+    States survive closing the chat session, but not a restart.
+    They are kept as zlib-compressed JSON: an idle chat costs a few
+    hundred bytes instead of a tree of dicts and lists.
+    '''
+    def __init__(self, maxsize: int = 100000):
+        self._maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, chat_id: int):
+        with self._lock:
+            state = self._data.get(chat_id)
+            if state is not None:
+                self._data.move_to_end(chat_id)
+        if state is None:
+            return None
+        return json.loads(zlib.decompress(state))
+
+    def save(self, chat_id: int, state: dict) -> None:
+        state = zlib.compress(
+            json.dumps(state, separators=(',', ':')).encode(), 1)
+        with self._lock:
+            self._data[chat_id] = state
+            self._data.move_to_end(chat_id)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, chat_id: int) -> None:
+        with self._lock:
+            self._data.pop(chat_id, None)
+
+
+class DatabaseStateBackend:
+    '''
+    Keeps conversation states in the ChatState table, so several
+    bot processes can share them and a restart loses nothing.
+    '''
+    def load(self, chat_id: int):
+        return ChatState.objects.filter(pk=chat_id).values_list(
+            'data', flat=True).first()
+
+    def save(self, chat_id: int, state: dict) -> None:
+        ChatState.objects.update_or_create(tg_id=chat_id,
+                                           defaults={'data': state})
+
+    def delete(self, chat_id: int) -> None:
+        ChatState.objects.filter(pk=chat_id).delete()
+
+
+def get_state_backend():
+    '''builds the backend configured in settings.BOT_STATE_BACKEND'''
+    config = settings.BOT_STATE_BACKEND
+    return import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+
+
+state_backend = get_state_backend()
 
 
 class StateStorage:
-    def __init__(self):
-        self._possible_teammates = []
+    '''
+    Conversation state of one chat. Handlers work with it in memory,
+    load() and save() sync it with the state backend and must be
+    called outside of the event loop since they may hit the database.
+    Only ids are stored, Player objects are kept as
+    a per-process cache of what those ids point to.
+    '''
+    __slots__ = ('_chat_id', '_backend', '_possible_teammates',
+                 '_current_teammate', '_current_games', '_game_action',
+                 '_search_status', '_search_id', '_saved')
+
+    def __init__(self, chat_id: int, backend=None):
+        self._chat_id = chat_id
+        self._backend = backend or state_backend
+        self._possible_teammates = None
         self._current_teammate = None
-        self._current_game = None
+        self._current_games = []
+        self._game_action = None
         self._search_status = False
+        # bumped by every new search, inline buttons of older
+        # cards carry an older id
+        self._search_id = 0
+        self._saved = None
+
+    def _dump(self) -> dict:
+        cursor = self._possible_teammates
+        return {
+            'search': self._search_status,
+            'games': list(self._current_games),
+            'game_action': self._game_action,
+            'search_id': self._search_id,
+            'teammate': (self._current_teammate.tg_id
+                         if self._current_teammate else None),
+            'cursor': cursor.to_state() if cursor is not None else None,
+        }
+
+    def load(self) -> None:
+        state = self._backend.load(self._chat_id)
+        if state is None or state == self._saved:
+            return
+        self._search_status = state['search']
+        self._game_action = state.get('game_action')
+        self._search_id = state.get('search_id', 0)
+
+        if 'games' in state:
+            self._current_games = list(state['games'])
+        else:
+            # states saved before multi-game search have a single 'game'
+            game_id = state.get('game')
+            self._current_games = [game_id] if game_id is not None else []
+
+        teammate_id = state['teammate']
+        if teammate_id is None:
+            self._current_teammate = None
+        elif (self._current_teammate is None
+              or self._current_teammate.tg_id != teammate_id):
+            self._current_teammate = Player.objects.filter(
+                pk=teammate_id).first()
+
+        cursor_state = state['cursor']
+        if cursor_state is None:
+            self._possible_teammates = None
+        else:
+            players = (self._possible_teammates.players
+                       if self._possible_teammates else None)
+            cursor_class = CURSORS[cursor_state['kind']]
+            self._possible_teammates = cursor_class.from_state(
+                cursor_state, settings.TEAMMATES_PAGE_SIZE, players)
+        self._saved = state
+
+    def save(self) -> None:
+        state = self._dump()
+        if state != self._saved:
+            self._backend.save(self._chat_id, state)
+            self._saved = state
 
     def get_current_teammate(self) -> Player:
         return self._current_teammate
 
     def get_next_teammate(self) -> Player:
+        '''
+        may hit the database when the current page runs out
+        '''
+        if self._possible_teammates is None:
+            raise IndexError('no search in progress')
         teammate = self._possible_teammates.pop()
+        seen_history.add(self._chat_id, teammate.tg_id)
         self._current_teammate = teammate
         return teammate
 
-    def update_possible_teammates(self, player: Player, game: Game) -> list:
+    def update_possible_teammates(self, player: Player,
+                                  game_ids: list) -> list:
         '''
-        loads possible teammates from the database
+        starts a new candidate cursor over players who play every
+        game of game_ids and loads its first page
         '''
-        self._possible_teammates = list(player.get_possible_teammates(game))
-        random.shuffle(self._possible_teammates)
-        return self._possible_teammates
+        self._search_id += 1
+        if game_index.is_warm:
+            viewer_games = (game_index.games_of(player.tg_id)
+                            or [player.prefered_game_id])
+            self._possible_teammates = IndexedTeammateCursor(
+                player.tg_id, game_ids, settings.TEAMMATES_PAGE_SIZE,
+                viewer_games=viewer_games)
+        else:
+            self._possible_teammates = TeammateCursor(
+                player.tg_id, game_ids, settings.TEAMMATES_PAGE_SIZE)
+        return self._possible_teammates.peek()
 
     def get_possible_teammates(self) -> list:
-        return self._possible_teammates
+        if self._possible_teammates is None:
+            return []
+        return self._possible_teammates.peek()
+
+    def get_search_id(self) -> int:
+        return self._search_id
+
+    def set_current_games(self, game_ids: list) -> None:
+        self._current_games = list(game_ids)
 
-    def set_current_game(self, game: Game) -> None:
-        self._current_game = game
+    def get_current_games(self) -> list:
+        '''ids of the games the current search is for'''
+        return self._current_games
+
+    def set_game_action(self, action) -> None:
+        '''
+        'add' or 'remove' while waiting for the game to add to or
+        remove from the player's list, None otherwise
+        '''
+        self._game_action = action
 
-    def get_current_game(self, player: Player) -> Game:
-        return self._current_game
+    def get_game_action(self):
+        return self._game_action
 
     def set_search_status(self, value: bool) -> None:
         self._search_status = value
@@ -0,0 +1,356 @@
+'''
+Проверки работы с БД, которые должны проходить и на SQLite,
+и на PostgreSQL: python manage.py test tgamer_app
+(с DB_ENGINE=postgresql - на PostgreSQL), и защиты на входе
+рантайма бота, которой БД не нужна.
+'''
+import asyncio
+import io
+import os
+import tempfile
+from unittest import mock
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.utils import timezone
+from .gamer_bot import GamerBot
+from .inbound import InboundLimiter
+from .invites import InviteDelivery, pending_recipients, record_invite
+from .markups import GamesCatalogue
+from .models import Game, Invite, Player, PlayerActivity, PlayerGame
+from .posters import photo_file_id, poster_source, remember_file_id
+from .runtime import BotRuntime
+from .storage import StateStorage
+from .transfer import GameImporter, PlayerImporter, read_records, upsert
+from .writeback import PlayerActivityBuffer
+from . import msgs
+
+
+class PlayerModelTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.game = Game.objects.create(title='Dota', description='moba')
+        cls.other = Game.objects.create(title='Quake', description='fps')
+
+    def make_player(self, tg_id: int, games=(), **kwargs) -> Player:
+        fields = {'steam_name': f's{tg_id}', 'about': 'a',
+                  'prefered_game': self.game}
+        fields.update(kwargs)
+        player = Player.objects.create(tg_id=tg_id, **fields)
+        for game in games:
+            player.add_game(game)
+        return player
+
+    def test_sign_up_status(self):
+        self.assertEqual(self.make_player(1).sign_up,
+                         Player.RegistrationSteps.DONE)
+        self.assertEqual(self.make_player(2, about='').sign_up,
+                         Player.RegistrationSteps.ABOUT)
+
+    def test_teammates_page(self):
+        me = self.make_player(1, games=[self.game])
+        self.make_player(2, games=[self.game, self.other])
+        self.make_player(3, games=[self.game])
+        self.make_player(4, games=[self.game], search_enabled=False)
+        self.make_player(5, games=[self.other])
+        page = me.get_teammates_page([self.game], limit=10)
+        self.assertEqual([player.tg_id for player in page], [2, 3])
+        page = me.get_teammates_page([self.game, self.other], limit=10)
+        self.assertEqual([player.tg_id for player in page], [2])
+        self.assertEqual(me.get_teammates_id_range([self.game]), (2, 3))
+
+
+class CursorTests(TestCase):
+    def test_raw_cursor(self):
+        Game.objects.create(title='Dota', description='moba')
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT COUNT(*) FROM {Game._meta.db_table} '
+                           'WHERE title = %s', ['Dota'])
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+
+class UpsertTests(TestCase):
+    def test_insert_then_update(self):
+        game = Game.objects.create(title='Dota', description='moba')
+        upsert(Player, [Player(tg_id=1, steam_name='old', about='a',
+                               prefered_game=game)],
+               ['tg_id'], PlayerImporter.update_fields)
+        upsert(Player, [Player(tg_id=1, steam_name='new', about='b',
+                               prefered_game=game),
+                        Player(tg_id=2, steam_name='two', about='c')],
+               ['tg_id'], PlayerImporter.update_fields)
+        self.assertEqual(
+            list(Player.objects.order_by('tg_id').values_list(
+                'tg_id', 'steam_name', 'about')),
+            [(1, 'new', 'b'), (2, 'two', 'c')])
+
+    def test_upsert_links(self):
+        game = Game.objects.create(title='Dota', description='moba')
+        player = Player.objects.create(tg_id=1, steam_name='s', about='a',
+                                       prefered_game=game)
+        for skill in (1, 5):
+            upsert(PlayerGame, [PlayerGame(player=player, game=game,
+                                           skill=skill)],
+                   ['player', 'game'], ['skill', 'role'])
+        self.assertEqual(list(PlayerGame.objects.values_list('skill',
+                                                             flat=True)),
+                         [5])
+
+
+class GameImporterTests(TestCase):
+    def test_import_with_explicit_ids(self):
+        Game.objects.create(id=1, title='Old', description='d')
+        records = [{'id': 1, 'title': 'Dota'}, {'id': 50, 'title': 'CS'},
+                   {'title': 'Quake'}, {'id': 51, 'title': ''}]
+        result = GameImporter(batch_size=2).run(records)
+        self.assertEqual(result, {'created': 2, 'updated': 1, 'errors': 1})
+        self.assertEqual(Game.objects.get(pk=1).title, 'Dota')
+        # счетчик id сдвинут за импортированные id
+        self.assertGreater(Game.objects.create(title='New').pk, 50)
+
+
+class ReadRecordsTests(TestCase):
+    def test_bad_jsonl_lines_are_skipped(self):
+        Game.objects.create(id=1, title='Dota', description='moba')
+        stream = io.StringIO('{"tg_id": 1, "steam_name": "one"}\n'
+                             '{"tg_id": 2, \n'
+                             '[]\n'
+                             '1\n'
+                             '{"tg_id": 3, "steam_name": "three"}\n')
+        result = PlayerImporter(batch_size=2).run(
+            read_records(stream, 'jsonl'))
+        self.assertEqual(result, {'created': 2, 'updated': 0, 'errors': 3})
+        result = GameImporter().run(read_records(
+            io.StringIO('{"id": 1, "title": "Dota 2"}\nnot json\n'),
+            'jsonl'))
+        self.assertEqual(result, {'created': 0, 'updated': 1, 'errors': 1})
+
+
+class AdminSearchTests(TestCase):
+    def test_prefix_search(self):
+        from django.contrib.admin.sites import site
+        for tg_id, name in ((1, 'JoJo'), (2, 'jojo2'), (3, 'Dio'), (12, 'x')):
+            Player.objects.create(tg_id=tg_id, steam_name=name, about='a')
+        player_admin = site._registry[Player]
+
+        def search(term):
+            found, _ = player_admin.get_search_results(
+                None, Player.objects.all(), term)
+            return sorted(found.values_list('tg_id', flat=True))
+        self.assertEqual(search('jo'), [1, 2])
+        self.assertEqual(search('12'), [12])
+        self.assertEqual(search(chr(0x10FFFF)), [])
+
+
+class GamesCatalogueTests(TestCase):
+    def test_sees_changes_from_other_processes(self):
+        game = Game.objects.create(title='Dota', description='moba')
+        catalogue = GamesCatalogue(per_line=3, page_size=10,
+                                   check_interval=0)
+        self.assertEqual(catalogue.get_game(game.pk).title, 'Dota')
+        # bulk_create и update() не шлют сигналов, как и правки
+        # из другого процесса: каталог замечает их по БД
+        Game.objects.bulk_create([Game(title='CS', description='')])
+        new = Game.objects.get(title='CS')
+        self.assertEqual(catalogue.get_game(new.pk).title, 'CS')
+        Game.objects.filter(pk=game.pk).update(title='Dota 2',
+                                               updated_at=timezone.now())
+        self.assertEqual(catalogue.get_game(game.pk).title, 'Dota 2')
+        self.assertIn('Dota 2', catalogue.get_markup())
+
+
+class PosterSourceTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        override = self.settings(MEDIA_ROOT=media.name)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_stale_catalogue_object(self):
+        # файлы пишутся через update(), чтобы не запускать поток миниатюр
+        game = Game.objects.create(title='Dota', description='moba')
+        game.poster.save('dota.png', ContentFile(b'original'), save=False)
+        Game.objects.filter(pk=game.pk).update(poster=game.poster.name)
+        cached = Game.objects.get(pk=game.pk)
+        # миниатюру сделал поток админки, в каталоге бота ее еще нет
+        game.thumbnail.save('dota.jpg', ContentFile(b'thumb'), save=False)
+        Game.objects.filter(pk=game.pk).update(thumbnail=game.thumbnail.name)
+        upload = poster_source(cached)
+        self.assertEqual(upload[1], b'thumb')
+        remember_file_id(cached, photo_file_id(
+            {'photo': [{'file_id': 'small'}, {'file_id': 'big'}]}), upload)
+        self.assertEqual(Game.objects.get(pk=game.pk).poster_file_id, 'big')
+        self.assertEqual(poster_source(cached), 'big')
+
+
+class RecordingOutbox:
+    '''
+    Вместо OutboundDispatcher: запоминает сообщения и ответы
+    на нажатия, fail - исключение, с которым падает sendMessage
+    '''
+    def __init__(self):
+        self.answers = []
+        self.messages = []
+        self.fail = None
+
+    async def answerCallbackQuery(self, callback_query_id: str, **kwargs):
+        self.answers.append((callback_query_id, kwargs.get('text')))
+
+    async def sendMessage(self, chat_id: int, text: str, **kwargs):
+        if self.fail is not None:
+            raise self.fail
+        self.messages.append((chat_id, text))
+
+
+class InlineRuntime:
+    '''
+    Рантайм для хендлеров в тестах: вызовы ORM идут в том же потоке,
+    иначе они не увидят данные из транзакции теста
+    '''
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.outbox = RecordingOutbox()
+
+    async def run_sync(self, fn, *args, **kwargs):
+        with mock.patch.dict(os.environ,
+                             {'DJANGO_ALLOW_ASYNC_UNSAFE': 'true'}):
+            return fn(*args, **kwargs)
+
+    def spawn(self, coro) -> asyncio.Task:
+        return self.loop.create_task(coro)
+
+
+class InboundTests(SimpleTestCase):
+    def setUp(self):
+        self.runtime = BotRuntime('123:TEST', handler_class=None,
+                                  db_workers=1)
+        self.runtime.loop = asyncio.new_event_loop()
+        self.runtime.outbox = RecordingOutbox()
+        self.runtime.inbound = InboundLimiter(rate=1, burst=100)
+        self.addCleanup(self.runtime.loop.close)
+        self.update_id = 0
+
+    def message(self, text: str) -> dict:
+        self.update_id += 1
+        return {'update_id': self.update_id,
+                'message': {'message_id': self.update_id,
+                            'chat': {'id': 1}, 'text': text}}
+
+    def callback(self, data: str) -> dict:
+        self.update_id += 1
+        return {'update_id': self.update_id,
+                'callback_query': {'id': f'q{self.update_id}', 'data': data,
+                                   'message': {'chat': {'id': 1}}}}
+
+    def flush(self) -> None:
+        self.runtime.loop.run_until_complete(asyncio.sleep(0))
+
+    def test_redelivered_update_is_dropped(self):
+        update = self.message('/find')
+        self.assertTrue(self.runtime.admit(update))
+        self.assertFalse(self.runtime.admit(update))
+        self.assertEqual(self.runtime.dedup.duplicates, 1)
+
+    def test_queued_command_is_coalesced(self):
+        self.assertTrue(self.runtime.admit(self.message('/next')))
+        self.assertFalse(self.runtime.admit(self.message('/next')))
+        self.assertTrue(self.runtime.admit(self.message('/invite')))
+        self.runtime.inbound.started(1, '/next')
+        self.assertTrue(self.runtime.admit(self.message('/next')))
+        self.assertEqual(self.runtime.inbound.coalesced, 1)
+
+    def test_registration_text_is_never_shed(self):
+        self.runtime.inbound = InboundLimiter(rate=0.001, burst=1)
+        for text in ('steam_name', 'steam_name', 'about me', '1 Dota'):
+            self.assertTrue(self.runtime.admit(self.message(text)))
+
+    def test_shed_callback_is_answered(self):
+        first = self.callback('n:1:2')
+        self.assertTrue(self.runtime.admit(first))
+        self.assertFalse(self.runtime.admit(self.callback('n:1:2')))
+        self.assertFalse(self.runtime.admit(first))
+        self.flush()
+        self.assertEqual(self.runtime.outbox.answers,
+                         [('q2', msgs.TOO_FAST), ('q1', None)])
+
+
+class ActivityBufferTests(TestCase):
+    def test_flush_batches_counters(self):
+        game = Game.objects.create(title='Dota', description='moba')
+        for tg_id in (1, 2, 3):
+            Player.objects.create(tg_id=tg_id, steam_name=f's{tg_id}',
+                                  about='a', prefered_game=game)
+        PlayerActivity.objects.create(player_id=3, invites_received=1,
+                                      awaiting_reply=True)
+        buffer = PlayerActivityBuffer(interval=3600)
+        buffer.shown(1)
+        buffer.shown(1)
+        buffer.invited(2)
+        buffer.active(3)
+        with self.assertNumQueries(5):
+            # savepoint, существующие игроки, bulk_create, один UPDATE,
+            # release savepoint
+            self.assertEqual(buffer.flush(), 3)
+        rows = {row.player_id: row for row in PlayerActivity.objects.all()}
+        self.assertEqual(rows[1].times_shown, 2)
+        self.assertEqual((rows[2].invites_received, rows[2].awaiting_reply),
+                         (1, True))
+        self.assertEqual((rows[3].invites_answered, rows[3].awaiting_reply),
+                         (1, False))
+        self.assertIsNotNone(rows[3].last_active_at)
+
+
+class PlayerCardTests(TestCase):
+    def test_card_without_prefered_game(self):
+        game = Game.objects.create(title='Dota', description='moba')
+        other = Game.objects.create(title='Quake', description='fps')
+        player = Player.objects.create(tg_id=1, steam_name='s', about='a',
+                                       prefered_game=game)
+        player.add_game(other)
+        game.delete()
+        player = Player.objects.select_related(
+            'prefered_game').prefetch_related('player_games__game').get(pk=1)
+        # карточке не нужна сессия чата
+        card = GamerBot.__new__(GamerBot).prepare_player_card(player)
+        self.assertNotIn('Любимая игра', card)
+        self.assertIn('Игры: Quake.', card)
+        self.assertEqual(GamerBot.card_game(player), other)
+
+    def test_invite_without_current_teammate(self):
+        runtime = InlineRuntime()
+        self.addCleanup(runtime.loop.close)
+        bot = GamerBot(runtime, 1)
+        bot._state = StateStorage(1)
+        player = Player.objects.create(tg_id=1, steam_name='s', about='a')
+        runtime.loop.run_until_complete(bot.invite(
+            player, {'from': {'id': 1, 'username': 'u'}, 'chat': {'id': 1}}))
+        self.assertEqual(runtime.outbox.messages, [(1, msgs.CARD_EXPIRED)])
+        self.assertFalse(Invite.objects.exists())
+
+
+class InviteDeliveryTests(TransactionTestCase):
+    # вызовы из event loop идут через свое соединение с БД,
+    # данные теста должны быть закоммичены
+    def test_failed_notification_is_retried(self):
+        runtime = InlineRuntime()
+        self.addCleanup(runtime.loop.close)
+        delivery = InviteDelivery(window=60, limit=5, lease=300)
+        # attach() запустил бы фоновые задачи, здесь хватает _deliver
+        delivery._runtime = runtime
+        delivery._wakeup = asyncio.Event()
+        for tg_id in (1, 2):
+            Player.objects.create(tg_id=tg_id, steam_name=f's{tg_id}',
+                                  about='a')
+        record_invite(1, 2, 'u1')
+        runtime.outbox.fail = ConnectionError('network is down')
+        runtime.loop.run_until_complete(delivery._deliver(2))
+        invite = Invite.objects.get()
+        self.assertIsNone(invite.delivered_at)
+        self.assertIsNone(invite.claimed_at)
+        self.assertIn(2, delivery._due)
+        runtime.outbox.fail = None
+        runtime.loop.run_until_complete(delivery._deliver(2))
+        self.assertIsNotNone(Invite.objects.get().delivered_at)
+        self.assertEqual(len(runtime.outbox.messages), 1)
+        self.assertEqual(pending_recipients(300), [])
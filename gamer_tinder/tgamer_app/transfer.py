@@ -0,0 +1,360 @@
+'''
+Выгрузка и загрузка игроков и игр в JSONL и CSV. Обе стороны
+потоковые: вход читается построчно и пишется пачками, выход читается
+из БД через iterator() (на PostgreSQL - серверным курсором), так что
+память не зависит от числа записей.
+Пачки пишутся через bulk_create/bulk_update, сигналы не срабатывают:
+работающие процессы бота увидят изменения после перезапуска
+или обновления индекса (BOT_INDEX_REFRESH).
+'''
+import csv
+import json
+from itertools import islice
+from django.conf import settings
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.utils import timezone
+from loguru import logger
+from .models import Game, Player, PlayerGame
+from .validators import validate_steam_name
+
+FORMATS = ('jsonl', 'csv')
+
+PLAYER_FIELDS = ['tg_id', 'steam_name', 'about', 'prefered_game',
+                 'search_enabled', 'games']
+GAME_FIELDS = ['id', 'title', 'genre', 'description', 'poster']
+
+
+class RecordError(ValueError):
+    '''Запись, которую нельзя загрузить'''
+
+
+def guess_format(path: str, default: str = 'jsonl') -> str:
+    for fmt in FORMATS:
+        if path.endswith(f'.{fmt}'):
+            return fmt
+    return default
+
+
+def read_records(stream, fmt: str):
+    '''
+    Построчно читает записи: из CSV - словари, из JSONL - строки,
+    их разбирает parse_record уже в импорте, чтобы битая строка
+    пропускалась, а не обрывала загрузку
+    '''
+    if fmt == 'csv':
+        for record in csv.DictReader(stream):
+            yield record
+        return
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield line
+
+
+def parse_record(record) -> dict:
+    '''Запись-словарь из строки JSONL, словари возвращаются как есть'''
+    if isinstance(record, str):
+        record = json.loads(record)
+    if not isinstance(record, dict):
+        raise RecordError('record is not a JSON object')
+    return record
+
+
+class RecordWriter:
+    '''Пишет словари в JSONL или CSV с заголовком'''
+    def __init__(self, stream, fmt: str, fields: list):
+        self._stream = stream
+        self._csv = (csv.DictWriter(stream, fieldnames=fields)
+                     if fmt == 'csv' else None)
+        if self._csv is not None:
+            self._csv.writeheader()
+
+    def write(self, record: dict) -> None:
+        if self._csv is not None:
+            self._csv.writerow(record)
+        else:
+            self._stream.write(json.dumps(record, ensure_ascii=False))
+            self._stream.write('\n')
+
+
+def _parse_bool(value) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() not in ('', '0', 'false', 'no')
+    return bool(value)
+
+
+def _parse_games(value) -> list:
+    '''
+    Игры игрока: в JSONL - список id или словарей
+    {"game": id, "skill": ..., "role": ...}, в CSV - id через ";"
+    '''
+    if value in (None, ''):
+        return []
+    if isinstance(value, str):
+        return [{'game': int(game_id)} for game_id in value.split(';')
+                if game_id.strip()]
+    return [item if isinstance(item, dict) else {'game': item}
+            for item in value]
+
+
+def upsert(model, objs: list, unique_fields: list, update_fields: list):
+    '''
+    INSERT ... ON CONFLICT DO UPDATE для SQLite и PostgreSQL.
+    В Django 4.0 еще нет bulk_create(update_conflicts=True),
+    а bulk_update собирает CASE на каждое поле и медленнее в разы.
+    '''
+    opts = model._meta
+    fields = [opts.get_field(name) for name in unique_fields + update_fields]
+    qn = connection.ops.quote_name
+    columns = ', '.join(qn(field.column) for field in fields)
+    conflict = ', '.join(qn(opts.get_field(name).column)
+                         for name in unique_fields)
+    updates = ', '.join(
+        f'{qn(field.column)} = EXCLUDED.{qn(field.column)}'
+        for field in fields[len(unique_fields):])
+    sql = (f'INSERT INTO {qn(opts.db_table)} ({columns}) '
+           f'VALUES ({", ".join(["%s"] * len(fields))}) '
+           f'ON CONFLICT ({conflict}) DO UPDATE SET {updates}')
+    rows = [[field.get_db_prep_save(getattr(obj, field.attname), connection)
+             for field in fields] for obj in objs]
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, rows)
+
+
+class PlayerImporter:
+    '''
+    Upsert игроков пачками одним INSERT ... ON CONFLICT (см. upsert).
+    Какие tg_id уже были, спрашивается одним запросом на пачку -
+    для отчета и чтобы не трогать игры новых игроков. Если у записи
+    есть поле games, список игр игрока заменяется, иначе к нему только
+    добавляется любимая игра.
+    '''
+    update_fields = ['steam_name', 'about', 'prefered_game', 'search_enabled',
+                     'sign_up']
+
+    def __init__(self, batch_size: int = 1000):
+        self.batch_size = batch_size
+        self.created = 0
+        self.updated = 0
+        self.errors = 0
+        self._game_ids = set(Game.objects.values_list('id', flat=True))
+
+    def _build(self, record: dict):
+        try:
+            tg_id = int(record['tg_id'])
+        except (KeyError, TypeError, ValueError):
+            raise RecordError('tg_id is missing or not a number')
+        steam_name = record.get('steam_name') or ''
+        # пустой ник - игрок не закончил регистрацию
+        if steam_name:
+            is_valid, message = validate_steam_name(steam_name)
+            if not is_valid:
+                raise RecordError(message)
+        about = record.get('about') or ''
+        if len(about) > Player._meta.get_field('about').max_length:
+            raise RecordError('about is too long')
+        prefered_game = record.get('prefered_game') or None
+        if prefered_game is not None:
+            prefered_game = int(prefered_game)
+            if prefered_game not in self._game_ids:
+                raise RecordError(f'unknown game {prefered_game}')
+        player = Player(tg_id=tg_id, steam_name=steam_name, about=about,
+                        prefered_game_id=prefered_game,
+                        search_enabled=_parse_bool(
+                            record.get('search_enabled', True)))
+        player.update_sign_up_status()
+        replace = 'games' in record
+        games = _parse_games(record.get('games'))
+        unknown = {item['game'] for item in games} - self._game_ids
+        if unknown:
+            raise RecordError(f'unknown games {sorted(unknown)}')
+        if prefered_game is not None and prefered_game not in {
+                item['game'] for item in games}:
+            games.append({'game': prefered_game})
+        return player, games, replace
+
+    def _write(self, batch: dict) -> None:
+        existing = set(Player.objects.filter(pk__in=batch).values_list(
+            'pk', flat=True))
+        links = [PlayerGame(player_id=tg_id, game_id=item['game'],
+                            skill=item.get('skill'),
+                            role=item.get('role') or '')
+                 for tg_id, (_, games, _) in batch.items() for item in games]
+        replaced = {tg_id for tg_id, (_, _, replace) in batch.items()
+                    if replace and tg_id in existing}
+        with transaction.atomic():
+            upsert(Player, [player for player, _, _ in batch.values()],
+                   ['tg_id'], self.update_fields)
+            if replaced:
+                # удаляются только игры, которых нет в новом списке
+                keep = {(link.player_id, link.game_id) for link in links}
+                stale = [pk for pk, player_id, game_id
+                         in PlayerGame.objects.filter(
+                             player_id__in=replaced).values_list(
+                             'pk', 'player_id', 'game_id')
+                         if (player_id, game_id) not in keep]
+                if stale:
+                    PlayerGame.objects.filter(pk__in=stale).delete()
+            upsert(PlayerGame, links, ['player', 'game'], ['skill', 'role'])
+        self.created += len(batch) - len(existing)
+        self.updated += len(existing)
+
+    def run(self, records) -> dict:
+        '''records - итерируемое словарей, читается пачками'''
+        records = iter(records)
+        line = 0
+        while True:
+            chunk = list(islice(records, self.batch_size))
+            if not chunk:
+                break
+            batch = {}
+            for record in chunk:
+                line += 1
+                try:
+                    entry = self._build(parse_record(record))
+                except (RecordError, ValueError, TypeError) as e:
+                    self.errors += 1
+                    logger.warning(f'Skipping player at line {line}: {e}')
+                    continue
+                # повтор tg_id в пачке: побеждает последняя запись
+                batch[entry[0].tg_id] = entry
+            if batch:
+                self._write(batch)
+        return {'created': self.created, 'updated': self.updated,
+                'errors': self.errors}
+
+
+class GameImporter:
+    '''
+    Upsert игр по id пачками, как и у игроков; записи без id
+    создаются. После вставки с явными id счетчик id в PostgreSQL
+    сдвигается за максимальный, иначе следующая игра без id
+    (из этого же файла или из админки) получит уже занятый id.
+    '''
+    # bulk_update не выставляет auto_now, updated_at пишется явно,
+    # чтобы процессы бота заметили изменения каталога
+    update_fields = ['title', 'genre', 'description', 'poster', 'updated_at']
+
+    def __init__(self, batch_size: int = 1000):
+        self.batch_size = batch_size
+        self.created = 0
+        self.updated = 0
+        self.errors = 0
+
+    def _build(self, record: dict) -> Game:
+        title = record.get('title') or ''
+        if not title or len(title) > Game._meta.get_field(
+                'title').max_length:
+            raise RecordError('bad title')
+        game = Game(title=title, genre=record.get('genre') or '',
+                    description=record.get('description') or '',
+                    poster=record.get('poster') or '',
+                    updated_at=timezone.now())
+        if record.get('id'):
+            game.pk = int(record['id'])
+        return game
+
+    def _write(self, games: dict, new: list) -> None:
+        existing = set(Game.objects.filter(pk__in=games).values_list(
+            'pk', flat=True))
+        created = [game for pk, game in games.items() if pk not in existing]
+        with transaction.atomic():
+            if created:
+                Game.objects.bulk_create(created)
+                # до вставки игр без id, иначе они получат занятые id
+                self._reset_sequence()
+            Game.objects.bulk_create(new)
+            Game.objects.bulk_update(
+                [game for pk, game in games.items() if pk in existing],
+                self.update_fields)
+        self.created += len(created) + len(new)
+        self.updated += len(existing)
+
+    def _reset_sequence(self) -> None:
+        # на SQLite список пустой: там id берется из max(id)
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [Game]):
+                cursor.execute(sql)
+
+    def run(self, records) -> dict:
+        '''records - итерируемое словарей, читается пачками'''
+        records = iter(records)
+        line = 0
+        while True:
+            chunk = list(islice(records, self.batch_size))
+            if not chunk:
+                break
+            games = {}
+            new = []
+            for record in chunk:
+                line += 1
+                try:
+                    game = self._build(parse_record(record))
+                except (RecordError, ValueError, TypeError) as e:
+                    self.errors += 1
+                    logger.warning(f'Skipping game at line {line}: {e}')
+                    continue
+                if game.pk is None:
+                    new.append(game)
+                else:
+                    games[game.pk] = game
+            if games or new:
+                self._write(games, new)
+        return {'created': self.created, 'updated': self.updated,
+                'errors': self.errors}
+
+
+def export_players(writer: RecordWriter, fmt: str,
+                   chunk_size: int = 2000) -> int:
+    '''
+    Игроки и их игры читаются двумя потоками, упорядоченными по tg_id,
+    и склеиваются слиянием, так что в памяти только текущий игрок
+    '''
+    players = Player.objects.order_by('tg_id').values_list(
+        'tg_id', 'steam_name', 'about', 'prefered_game_id',
+        'search_enabled').iterator(chunk_size=chunk_size)
+    links = PlayerGame.objects.order_by('player_id', 'game_id').values_list(
+        'player_id', 'game_id', 'skill', 'role').iterator(
+        chunk_size=chunk_size)
+    link = next(links, None)
+    count = 0
+    for tg_id, steam_name, about, prefered_game, search_enabled in players:
+        games = []
+        while link is not None and link[0] <= tg_id:
+            if link[0] == tg_id:
+                games.append(link[1:])
+            link = next(links, None)
+        if fmt == 'csv':
+            games = ';'.join(str(game_id) for game_id, _, _ in games)
+        else:
+            games = [{'game': game_id, 'skill': skill, 'role': role}
+                     for game_id, skill, role in games]
+        writer.write({'tg_id': tg_id, 'steam_name': steam_name,
+                      'about': about, 'prefered_game': prefered_game,
+                      'search_enabled': search_enabled, 'games': games})
+        count += 1
+    return count
+
+
+def export_games(writer: RecordWriter, fmt: str,
+                 chunk_size: int = 2000) -> int:
+    count = 0
+    for record in Game.objects.order_by('id').values(
+            *GAME_FIELDS).iterator(chunk_size=chunk_size):
+        writer.write(record)
+        count += 1
+    return count
+
+
+def synthetic_players(count: int, game_id: int = None):
+    '''
+    Записи синтетических игроков для нагрузочных тестов, tg_id
+    из того же диапазона, что и у manage.py bench
+    '''
+    games = [{'game': game_id}] if game_id is not None else []
+    start = settings.BENCH_PLAYERS_START
+    for idx in range(count):
+        yield {'tg_id': start + idx, 'steam_name': f'p{idx}',
+               'about': 'synthetic player', 'prefered_game': game_id,
+               'search_enabled': True, 'games': games}
@@ -1,7 +1,8 @@
 from django.urls import re_path
-from .views import CommandReceiveView
+from .views import CommandReceiveView, MetricsView
 
 
 urlpatterns = [
+    re_path(r'^metrics/$', MetricsView.as_view(), name='metrics'),
     re_path(r'^(?P<bot_token>.+)/$', CommandReceiveView.as_view(), name='command'),
 ]
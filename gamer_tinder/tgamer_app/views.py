@@ -1,12 +1,12 @@
-import telepot
 import json
-from django.template.loader import render_to_string
-from django.http import HttpResponseForbidden, HttpResponseBadRequest, JsonResponse
+from django.http import HttpResponse, HttpResponseForbidden, \
+    HttpResponseBadRequest, JsonResponse
 from django.views.generic import View
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 from django.conf import settings
-from .gamer_bot import webhook 
+from .bot_app import bot_app
+from .metrics import metrics
 from loguru import logger
 
 
@@ -16,13 +16,24 @@ class CommandReceiveView(View):
         if bot_token != settings.TELEGRAM_TOKEN:
             return HttpResponseForbidden('Invalid token')
 
-        raw = request.body.decode('utf-8')
-        print(raw)
-        payload = json.loads(raw)
-        print(payload)
-        webhook.feed(payload)
+        try:
+            payload = json.loads(request.body)
+        except ValueError:
+            return HttpResponseBadRequest('Invalid JSON')
+        if not bot_app.get_update_queue().put(payload):
+            # очередь переполнена: Telegram повторит доставку позже
+            return HttpResponse(status=503)
         return JsonResponse({}, status=200)
 
     @method_decorator(csrf_exempt)
     def dispatch(self, request, *args, **kwargs):
         return super(CommandReceiveView, self).dispatch(request, *args, **kwargs)
+
+
+class MetricsView(View):
+    '''Метрики бота для Prometheus, доступны только с METRICS_ALLOWED_IPS'''
+    def get(self, request):
+        if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+            return HttpResponseForbidden()
+        return HttpResponse(metrics.render(),
+                            content_type='text/plain; version=0.0.4')
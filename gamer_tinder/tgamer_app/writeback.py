@@ -0,0 +1,274 @@
+'''
+Отложенная запись: хендлеры меняют объекты в памяти и помечают,
+что нужно записать, а буферы раз в несколько секунд пишут все
+накопившееся пачкой из фонового потока. Несколько изменений одной
+записи между сбросами превращаются в одну запись в БД.
+'''
+import abc
+import atexit
+import threading
+from datetime import datetime, timezone
+from loguru import logger
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Case, ExpressionWrapper, F, Value, When
+from .models import Player, PlayerActivity
+from .matchmaking import game_index
+from .signals import update_game_index
+
+
+class WriteBehind(abc.ABC):
+    '''
+    Фоновый поток, который раз в interval секунд вызывает flush().
+    Поток запускается при первой записи, при выходе из процесса
+    буфер дописывается.
+    '''
+    def __init__(self, interval: float):
+        self._interval = interval
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    @abc.abstractmethod
+    def flush(self) -> int:
+        '''Пишет накопившееся в БД, возвращает число записей'''
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run, name=type(self).__name__, daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self._interval):
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception:
+                # уже залогировано, записи вернулись в буфер
+                pass
+
+    def stop(self) -> None:
+        '''Останавливает фоновый сброс и дописывает остатки'''
+        self._stopped.set()
+        self.flush()
+
+    def __len__(self) -> int:
+        return len(self._dirty)
+
+
+class PlayerWriteBuffer(WriteBehind):
+    '''
+    Изменения профилей игроков, пишутся одним bulk_update на каждый
+    набор полей. bulk_update не вызывает save() и сигналы, поэтому
+    статус регистрации пересчитывается при пометке, а индекс поиска
+    и кэш обновляются после записи тем же обработчиком, что и по
+    post_save.
+    '''
+    def __init__(self, interval: float):
+        super().__init__(interval)
+        # сбросы идут по одному: иначе фоновый сброс со старыми значениями
+        # может закоммититься после свежего и затереть его
+        self._flush_lock = threading.Lock()
+        # записи, которые пишутся прямо сейчас, их еще нет в БД
+        self._writing = {}
+
+    def mark(self, player: Player, *fields: str) -> None:
+        '''Запоминает, что поля fields игрока нужно записать в БД'''
+        player.update_sign_up_status()
+        with self._lock:
+            entry = self._dirty.get(player.tg_id)
+            if entry is None or entry[0] is not player:
+                # тот же игрок, перечитанный из БД: пишем последний объект
+                dirty = entry[1] if entry is not None else set()
+                entry = self._dirty[player.tg_id] = (player, dirty)
+            entry[1].update(fields)
+        self._ensure_started()
+
+    def pending(self, tg_id: int):
+        '''Игрок с еще не записанными изменениями или None'''
+        with self._lock:
+            entry = self._dirty.get(tg_id) or self._writing.get(tg_id)
+        return entry[0] if entry is not None else None
+
+    def flush(self, tg_id: int = None) -> int:
+        '''
+        Пишет изменения одного игрока (или всех, если tg_id не передан),
+        возвращает число записанных игроков
+        '''
+        with self._flush_lock:
+            with self._lock:
+                if tg_id is None:
+                    entries, self._dirty = self._dirty, {}
+                else:
+                    entry = self._dirty.pop(tg_id, None)
+                    entries = {tg_id: entry} if entry is not None else {}
+                self._writing = entries
+            if not entries:
+                return 0
+            groups = {}
+            for player, fields in entries.values():
+                groups.setdefault(frozenset(fields), []).append(player)
+            try:
+                for fields, players in groups.items():
+                    Player.objects.bulk_update(players, sorted(fields))
+            except Exception:
+                logger.exception('Error while writing players, will retry')
+                self._requeue(entries)
+                raise
+            finally:
+                with self._lock:
+                    self._writing = {}
+        for player, _ in entries.values():
+            update_game_index(Player, player)
+        return len(entries)
+
+    def _requeue(self, entries: dict) -> None:
+        with self._lock:
+            for tg_id, (player, fields) in entries.items():
+                entry = self._dirty.get(tg_id)
+                if entry is None:
+                    self._dirty[tg_id] = (player, set(fields))
+                elif entry[0] is player:
+                    entry[1].update(fields)
+
+
+class ActivityDelta:
+    '''Что произошло с игроком с последнего сброса'''
+    __slots__ = ('active_at', 'shown', 'invited', 'invited_at')
+
+    def __init__(self):
+        self.active_at = None
+        self.shown = 0
+        self.invited = 0
+        self.invited_at = None
+
+
+class PlayerActivityBuffer(WriteBehind):
+    '''
+    События, из которых складывается рейтинг игрока в поиске.
+    Сразу обновляет рейтинг в game_index, а в PlayerActivity пишет
+    приращения через F(), поэтому несколько процессов бота
+    не затирают счетчики друг друга.
+    Приглашение считается отвеченным, если приглашенный после него
+    написал боту.
+    '''
+    fields = ('last_active_at', 'times_shown', 'invites_received',
+              'invites_answered', 'awaiting_reply')
+
+    def active(self, tg_id: int) -> None:
+        now = datetime.now(timezone.utc)
+        game_index.record_active(tg_id, now.timestamp())
+        with self._lock:
+            delta = self._delta(tg_id)
+            delta.active_at = now
+            delta.shown = 0
+        self._ensure_started()
+
+    def shown(self, tg_id: int) -> None:
+        game_index.record_shown(tg_id)
+        with self._lock:
+            self._delta(tg_id).shown += 1
+        self._ensure_started()
+
+    def invited(self, tg_id: int) -> None:
+        game_index.record_invite(tg_id)
+        with self._lock:
+            delta = self._delta(tg_id)
+            delta.invited += 1
+            delta.invited_at = datetime.now(timezone.utc)
+        self._ensure_started()
+
+    def _delta(self, tg_id: int) -> ActivityDelta:
+        delta = self._dirty.get(tg_id)
+        if delta is None:
+            delta = self._dirty[tg_id] = ActivityDelta()
+        return delta
+
+    @staticmethod
+    def _changes(delta: ActivityDelta) -> dict:
+        changes = {}
+        answered_pending = Case(When(awaiting_reply=True, then=Value(1)),
+                                default=Value(0))
+        if delta.active_at is not None:
+            changes['last_active_at'] = delta.active_at
+            changes['times_shown'] = Value(delta.shown)
+            if delta.invited_at is None or delta.invited_at < delta.active_at:
+                # ответил на все приглашения, включая полученные сейчас
+                answered = Value(1) if delta.invited else answered_pending
+                changes['invites_answered'] = F('invites_answered') + answered
+                changes['awaiting_reply'] = False
+            else:
+                changes['invites_answered'] = (F('invites_answered')
+                                               + answered_pending)
+        elif delta.shown:
+            changes['times_shown'] = F('times_shown') + delta.shown
+        if delta.invited:
+            changes['invites_received'] = (F('invites_received')
+                                           + delta.invited)
+            if 'awaiting_reply' not in changes:
+                changes['awaiting_reply'] = True
+        return changes
+
+    def flush(self) -> int:
+        with self._lock:
+            entries, self._dirty = self._dirty, {}
+        if not entries:
+            return 0
+        try:
+            with transaction.atomic():
+                existing = set(Player.objects.filter(
+                    pk__in=entries).values_list('pk', flat=True))
+                PlayerActivity.objects.bulk_create(
+                    [PlayerActivity(player_id=pk) for pk in existing],
+                    ignore_conflicts=True)
+                # одно UPDATE ... CASE на пачку: поля, которые у игрока
+                # не менялись, присваиваются сами себе
+                rows = []
+                touched = set()
+                for pk in existing:
+                    changes = self._changes(entries[pk])
+                    touched.update(changes)
+                    row = PlayerActivity(player_id=pk)
+                    for field in self.fields:
+                        # в Django 4.0 bulk_update берет только Expression,
+                        # голый F() для него - значение
+                        setattr(row, field, changes.get(
+                            field, ExpressionWrapper(F(field), output_field=(
+                                PlayerActivity._meta.get_field(field)))))
+                    rows.append(row)
+                if rows:
+                    PlayerActivity.objects.bulk_update(
+                        rows, [field for field in self.fields
+                               if field in touched],
+                        batch_size=settings.ACTIVITY_WRITE_BATCH)
+        except Exception:
+            # счетчики не критичны: не повторяем, чтобы не копить их
+            logger.exception('Error while writing player activity')
+            raise
+        return len(entries)
+
+
+player_writes = PlayerWriteBuffer(settings.PLAYER_WRITE_INTERVAL)
+activity_writes = PlayerActivityBuffer(settings.ACTIVITY_WRITE_INTERVAL)
+
+
+def refresh_game_index() -> None:
+    '''
+    Заново заполняет индекс поиска из БД. Сначала дописывает буферы:
+    иначе счетчики активности, которые этот процесс еще не записал,
+    откатились бы к значениям из БД.
+    '''
+    for buffer in (player_writes, activity_writes):
+        try:
+            buffer.flush()
+        except Exception:
+            # уже залогировано, индекс все равно перечитываем
+            pass
+    game_index.warm()